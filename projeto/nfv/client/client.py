@@ -1,15 +1,12 @@
-import pika as pk
 import json
 import os
 import time
 import sys
 from tabulate import tabulate #type: ignore
-from config import RABBITMQ_SERVER, NFVO_EXCHANGE, VNFM_EXCHANGE, VIM_EXCHANGE, IDS_EXCHANGE
+from config import NFVO_EXCHANGE, VNFM_EXCHANGE, VIM_EXCHANGE, IDS_EXCHANGE
+from rpc import RpcClient
 
-connection = pk.BlockingConnection(pk.ConnectionParameters(RABBITMQ_SERVER))
-channel = connection.channel()
-result = channel.queue_declare(queue="", exclusive = True)
-queue = result.method.queue
+rpc = RpcClient()
 
 
 # ASCII color codes
@@ -17,17 +14,6 @@ RED = "\033[91m"
 GREEN = "\033[92m"
 RESET = "\033[0m"
 
-def wait_for_message(timeout=None):
-    start_time = time.time()
-    while True:
-        method_frame, header_frame, body = channel.basic_get(queue=queue, auto_ack=True)
-        if method_frame:
-            return body.decode()
-        if timeout is not None and (time.time() - start_time) >= timeout:
-
-            return None
-        time.sleep(0.1)
-
 def get_status():
     """Get the status of each NFV module + IDS"""
     modules = {
@@ -37,17 +23,16 @@ def get_status():
         "IDS": IDS_EXCHANGE
     }
     
-    msg = json.dumps({
-        "action": "heartbeat",
-        "rqueue": queue
-    })
+    # All modules are asked at once, a module that is off costs 2s in total
+    pending = {module: rpc.call_async(exchange, {"action": "heartbeat"})
+               for module, exchange in modules.items()}
+    deadline = time.time() + 2
 
     table = []
-    for module, exchange in modules.items():
+    for module, future in pending.items():
         status = "OFF"
         try:
-            channel.basic_publish(exchange=exchange, routing_key="", body=msg)
-            response = wait_for_message(timeout=2)
+            response = rpc.result(future, timeout=max(deadline - time.time(), 0))
             if response == "ok":
                 status = "OK"
         except Exception as e:
@@ -72,16 +57,12 @@ def show_commands():
     print(tabulate(table, headers=["Command", "Description"], tablefmt="pretty"))
 
 def get_sfc_list():
-    msg = json.dumps({
-        "action": "list_sfc",
-        "return_queue" : queue
-    })
-    channel.basic_publish(exchange=NFVO_EXCHANGE,
-                            routing_key="", body=msg)
-    body = wait_for_message()
     try:
-        msg = json.loads(body)
-    except:
+        msg = rpc.call(NFVO_EXCHANGE, {"action": "list_sfc"})
+    except TimeoutError:
+        print("NFVO did not answer")
+        return
+    if not isinstance(msg, dict):
         print("Error decoding response from NFVO")
         return
     return msg
@@ -96,19 +77,25 @@ def read_command():
         if vnf_num > 8 or vnf_num < 1:
             print("Invalid value for vnf")
             return
-        msg = json.dumps({
+        fuse = int(input("VNFs per container (1-8, default 1): ") or 1)
+        if fuse > 8 or fuse < 1:
+            print("Invalid value for VNFs per container")
+            return
+        msg = {
             "action": "create_sfc",
             "sfc_id": sfc_id,
-            "sfc_size": vnf_num
-        })
-        print(msg)
-        channel.basic_publish(exchange=NFVO_EXCHANGE,
-                              routing_key="", body=msg)
+            "sfc_size": vnf_num,
+            "fuse": fuse
+        }
+        print(json.dumps(msg))
+        rpc.send(NFVO_EXCHANGE, msg)
         print(f"{sfc_id} created.")
     elif command == "status":
         get_status()
     elif command == "purge_sfc":
         msg = get_sfc_list()
+        if msg is None:
+            return
         sfcs = list(msg.keys())
         if len(command.split()) == 1:
             sfc_id = input("SFC ID: ")
@@ -119,16 +106,17 @@ def read_command():
             print("SFC not in the list of SFC's.")
             print(sfcs)
         else:
-            delete_msg = json.dumps({
+            delete_msg = {
                 "action": "delete_sfc",
                 "sfc_id" : sfc_id
-            })
-            channel.basic_publish(exchange=NFVO_EXCHANGE,
-                                    routing_key="", body=delete_msg)
+            }
+            rpc.send(NFVO_EXCHANGE, delete_msg)
             print(f"{sfc_id} purged.")
 
     elif command == "list_sfc":
         msg = get_sfc_list()
+        if msg is None:
+            return
         table = []
         sfcs = list(msg.keys())
         counter = 0
@@ -2,14 +2,12 @@ import sys
 import json
 import time
 import os
-import pika as pk  # type: ignore
 import argparse
 import pandas as pd
 import socket
-import threading
-import queue
 from sklearn.model_selection import train_test_split
-from config import RABBITMQ_SERVER, IDS_EXCHANGE, GATEWAY_PORT
+from config import IDS_EXCHANGE, GATEWAY_PORT
+from rpc import RpcClient
 from datetime import datetime
 
 class TCPClient:
@@ -25,40 +23,6 @@ class TCPClient:
     def close(self):
         self.socket.close()
 
-class PikaManager:
-    def __init__(self, server, exchange):
-        self.recv_queue = queue.Queue()
-        self.send_queue = queue.Queue()
-        self.connection = pk.BlockingConnection(pk.ConnectionParameters(server))
-        self.channel = self.connection.channel()
-        result = self.channel.queue_declare(queue="", exclusive=True)
-        self.queue_name = result.method.queue
-        self.exchange = exchange
-
-        threading.Thread(target=self._pika_thread, daemon=True).start()
-
-    def _callback(self, ch, method, properties, body):
-        self.recv_queue.put(body.decode())
-
-    def _pika_thread(self):
-        self.channel.basic_consume(queue=self.queue_name, on_message_callback=self._callback, auto_ack=True)
-        while True:
-            self.connection.process_data_events(time_limit=1)
-            try:
-                msg = self.send_queue.get_nowait()
-                self.channel.basic_publish(exchange=self.exchange, routing_key="", body=msg)
-            except queue.Empty:
-                pass
-
-    def send(self, msg):
-        self.send_queue.put(json.dumps(msg))
-
-    def wait_for_message(self, timeout=None):
-        try:
-            return self.recv_queue.get(timeout=timeout)
-        except queue.Empty:
-            return None
-
 methods = ["lof", "osvm", "iforest"]
 
 argument_list = {
@@ -77,29 +41,39 @@ argument_list = {
     }
 }
 
-def train_msg(pika_mgr, method, dataset):
+def train_msg(rpc, method, dataset, timeout=30, poll_interval=2):
     msg = {
         "action": "train",
         "dataset": dataset,
         "method": method,
-        "rqueue": pika_mgr.queue_name,
         "argument": argument_list[method]
     }
-    pika_mgr.send(msg)
+    ret = rpc.call(IDS_EXCHANGE, msg, timeout=timeout)
+    # The IDS trains in background, wait until the new model is in use
+    while ret.get("status", ret.get("state")) in ("training started", "training"):
+        time.sleep(poll_interval)
+        ret = train_status(rpc, timeout=timeout)
+    if ret.get("state") in ("failed", "cancelled"):
+        raise RuntimeError(f"Training {ret['state']}: {ret.get('error')}")
+    return ret
+
+def train_status(rpc, timeout=10):
+    msg = {
+        "action": "train_status"
+    }
+    return rpc.call(IDS_EXCHANGE, msg, timeout=timeout)
 
-def summary(pika_mgr):
+def summary(rpc, timeout=30):
     msg = {
-        "action": "fetch_summary",
-        "rqueue": pika_mgr.queue_name
+        "action": "fetch_summary"
     }
-    pika_mgr.send(msg)
+    return rpc.call(IDS_EXCHANGE, msg, timeout=timeout)
 
-def clean_summary(pika_mgr):
+def clean_summary(rpc, timeout=10):
     msg = {
-        "action": "clean_summary",
-        "rqueue": pika_mgr.queue_name
+        "action": "clean_summary"
     }
-    pika_mgr.send(msg)
+    return rpc.call(IDS_EXCHANGE, msg, timeout=timeout)
 
 def get_train_set(df, p=0.05, random_num=22):
     if 1.0 < p <= 100.0:
@@ -123,7 +97,7 @@ def main():
     df = pd.read_csv(args.dataset)
     time_started = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     gateway = TCPClient("192.168.18.11", GATEWAY_PORT)
-    pika_mgr = PikaManager(RABBITMQ_SERVER, IDS_EXCHANGE)
+    rpc = RpcClient()
 
     path = os.path.join(args.output, args.method)
     os.makedirs(path, exist_ok=True)
@@ -136,10 +110,9 @@ def main():
         i += 1
 
     results = []
-    train_msg(pika_mgr, args.method, args.dataset_name)
-    saida = pika_mgr.wait_for_message(timeout=30)
+    saida = train_msg(rpc, args.method, args.dataset_name)
     print(saida)
-    training_time = json.loads(saida)["runtime"]
+    training_time = saida["runtime"]
     time.sleep(2)
 
     for i in range(1, args.num_runs + 1):
@@ -157,18 +130,15 @@ def main():
                 break
             if count > 1000:
                 print("Getting summary (prevent lost connection)")
-                summary(pika_mgr)
-                pika_mgr.wait_for_message(timeout=10)
+                summary(rpc, timeout=10)
                 print("Got summary back")
                 count = 0
             time.sleep(0.1)
 
         print("Round finished. Getting summary back")
-        summary(pika_mgr)
-        saida = json.loads(pika_mgr.wait_for_message(timeout=30))
+        saida = summary(rpc)
         results.append((run_id, saida))
-        clean_summary(pika_mgr)
-        pika_mgr.wait_for_message(timeout=10)
+        clean_summary(rpc)
 
     time_finished_dt = datetime.now()
     time_finished = time_finished_dt.strftime("%Y-%m-%d %H:%M:%S")
@@ -5,7 +5,17 @@ RABBITMQ_SERVER = "172.17.0.1"
 
 # List of exchanges used to communicate
 # Exchange used by all VNFs to receive commands from MANO, NFVO, etc
-VNF_CONTROL_EXCHANGE = "vnf-control"
+# Topic exchange, routing key "<sfc_id>.<vnf_id>": "<sfc_id>.all" reaches all
+# the VNFs of an SFC and "all.all" every VNF
+VNF_CONTROL_EXCHANGE = "vnf-command"
+# Lifecycle events of the VNFs, topic exchange with routing key
+# "<sfc_id>.<vnf_id>.<event>". The VIM publishes vnf-started (container running,
+# IP known) and the VNF publishes vnf-ready (listening and next hop connected)
+VNF_EVENTS_EXCHANGE = "vnf-events"
+# Seconds the VNFM waits for the VNFs of an SFC to be ready before announcing it
+VNF_READY_TIMEOUT = 60
+# Seconds a request/reply (rpc.py) waits for the reply
+RPC_TIMEOUT = 10
 
 VIM_EXCHANGE = "vim-exchange"
 NFVO_EXCHANGE = "nfvo-exchange"
@@ -21,14 +31,72 @@ DOCKERFILE_DIR = "/".join([part for part
                            in DOCKERFILE_PATH.split("/")[:-1]])
 
 IMAGE_NAME = "vnf-instance-tcp"
+# Docker operations the VIM runs in parallel (the operations of one VNF run in order)
+VIM_WORKERS = 8
+# Idle containers the VIM keeps started, a start action claims one of them (0 disables)
+VIM_WARM_POOL_SIZE = 4
 GATEWAY_PORT = 30000
 ENDPOINT_PORT = 35012
+# Egress forwarder: receives the output of the last VNF of every SFC
+FORWARDER_IP = "192.168.18.11"
+FORWARDER_PORT = 40125
+# sfc_id -> [host, port] of the destination. Other SFCs use the default route
+FORWARDER_ROUTES = {}
+FORWARDER_DEFAULT_ROUTE = ["192.168.18.11", ENDPOINT_PORT]
+# Persistent connections kept open to each destination
+FORWARDER_POOL_SIZE = 4
+# Gateway data plane: "threaded" (one thread per client) or "async" (event loop)
+GATEWAY_MODE = "threaded"
+# Processes of the async gateway, all on GATEWAY_PORT (0: one per core)
+GATEWAY_WORKERS = 1
+# Max bytes buffered in a gateway socket before the writer is paused/dropped
+GATEWAY_WRITE_BUFFER = 256 * 1024
+# Consistent hashing of flows to SFCs: virtual nodes per SFC and lookup table size (2^bits)
+GATEWAY_RING_REPLICAS = 100
+GATEWAY_RING_BITS = 16
+# CSV columns (indexes) used as flow key. Empty: the client address is the flow key
+GATEWAY_FLOW_FIELDS = []
+# How the gateway chooses the SFC: "hash", "least-outstanding" or "p2c"
+GATEWAY_POLICY = "hash"
 
 DEFAULT_IN_PORT = 2323
+# Framing used by every TCP hop: "line" (newline-delimited) or "length" (prefixed)
+FRAMING_MODE = "line"
 DEFAULT_OUT_PORT = 3030
+# TCP VNF data plane: "threaded" (thread per connection) or "loop" (single epoll loop)
+VNF_MODE = "threaded"
+# Max bytes waiting to be sent by a VNF before it stops reading its inbound sockets
+VNF_OUT_BUFFER = 4 * 1024 * 1024
+# Batch NF API: records per NF call (0 disables batching) and max wait (seconds)
+VNF_BATCH_SIZE = 0
+VNF_BATCH_TIMEOUT = 0.005
+# RabbitMQ VNF: messages delivered before an ack (0 keeps auto_ack), messages
+# per multiple ack, outputs coalesced in one published message, publisher
+# confirms and max time (seconds) outputs and acks wait to be flushed
+VNF_PREFETCH = 0
+VNF_ACK_EVERY = 64
+VNF_COALESCE = 1
+VNF_CONFIRM = False
+VNF_FLUSH_INTERVAL = 0.01
+# Data plane processes per TCP VNF (the records of each connection are spread among them)
+VNF_WORKERS = 1
+# Consecutive VNFs of an SFC fused in one VNF process (1 = one container per VNF)
+VNFM_FUSE = 1
+# Links between VNFs on the same host use a shared memory ring instead of TCP
+VNFM_SHM_LINKS = False
+# tmpfs directory of the rings (mounted in every VNF container), ring size
+# (power of two) and how long a VNF waits for the ring of the next hop
+SHM_DIR = "/dev/shm/nfv"
+SHM_RING_SIZE = 4 * 1024 * 1024
+SHM_ATTACH_TIMEOUT = 10
 
 IDS_IP = "192.168.18.11"
 IDS_PORT = 2538
+# Gateway -> IDS mirroring: ring buffer size (writes), writes per sendmsg and
+# what to do when the IDS is behind ("drop" or "block")
+IDS_MIRROR_CAPACITY = 65536
+IDS_MIRROR_BATCH = 512
+IDS_MIRROR_POLICY = "drop"
 
 class NetConfig:
     network_name = "nfv-comm-network"
@@ -0,0 +1,163 @@
+"""
+Message framing used in the TCP path (gateway -> VNFs -> IDS)
+
+A TCP read is not a record: one CSV line can arrive split in two reads and
+several lines can arrive in a single read. RecordBuffer accumulates the
+bytes read from a socket and only hands back complete records.
+
+Two modes are supported:
+    line: every record ends with a newline (what the clients send)
+    length: every record starts with its size as a 4 bytes big-endian integer
+"""
+import struct
+from config import FRAMING_MODE
+
+LENGTH_HEADER = struct.Struct("!I")
+DELIMITER = b"\n"
+# Max number of buffers accepted by one sendmsg call
+IOV_MAX = 1024
+
+def frame(payload, mode=FRAMING_MODE):
+    """Returns payload (bytes) with the framing used in the wire"""
+    if mode == "length":
+        return LENGTH_HEADER.pack(len(payload)) + payload
+    if payload.endswith(DELIMITER):
+        return bytes(payload)
+    return payload + DELIMITER
+
+def split_frames(data, mode=FRAMING_MODE):
+    """Yields the records (without framing) of data, which has only complete records"""
+    if mode == "length":
+        view = memoryview(data)
+        offset = 0
+        while offset + LENGTH_HEADER.size <= len(view):
+            (size,) = LENGTH_HEADER.unpack_from(view, offset)
+            offset += LENGTH_HEADER.size
+            yield view[offset:offset + size]
+            offset += size
+        return
+    for record in bytes(data).split(DELIMITER):
+        if record:
+            yield record
+
+def count_records(data, mode=FRAMING_MODE):
+    """Number of records in data, which has only complete records"""
+    if mode == "length":
+        return sum(1 for _ in split_frames(data, mode))
+    return bytes(data).count(DELIMITER)
+
+def sendmsg_all(sock, buffers):
+    """sendall for a list of buffers, using as few sendmsg (writev) calls as possible"""
+    buffers = [memoryview(b) for b in buffers]
+    while buffers:
+        sent = sock.sendmsg(buffers[:IOV_MAX])
+        while buffers and sent >= len(buffers[0]):
+            sent -= len(buffers[0])
+            buffers.pop(0)
+        if buffers and sent:
+            buffers[0] = buffers[0][sent:]
+
+class RecordBuffer:
+    """Reusable receive buffer that yields complete records
+
+    Records are returned as memoryviews of the internal buffer (no copy),
+    so they are only valid until the next call to recv_into or feed.
+    Whoever needs to keep a record must copy it with bytes(record)."""
+    def __init__(self, mode=FRAMING_MODE, size=64 * 1024, max_size=16 * 1024 * 1024):
+        if mode not in ("line", "length"):
+            raise ValueError(f"Invalid framing mode: {mode}")
+        self.mode = mode
+        self.max_size = max_size
+        self._buf = bytearray(size)
+        self._view = memoryview(self._buf)
+        self._start = 0 # First byte not consumed
+        self._end = 0   # End of the received data
+
+    def pending(self):
+        """Number of bytes received that are not part of a complete record"""
+        return self._end - self._start
+
+    def _reserve(self, n=1):
+        """Makes room for at least n bytes at the end of the buffer"""
+        if len(self._buf) - self._end >= n:
+            return
+        pending = self._end - self._start
+        size = len(self._buf)
+        while size - pending < n:
+            size *= 2
+        if size > self.max_size:
+            raise ValueError("Record is larger than the receive buffer")
+        if size == len(self._buf):
+            # Move the partial record to the beginning, the size is kept
+            self._buf[:pending] = self._buf[self._start:self._end]
+        else:
+            buf = bytearray(size)
+            buf[:pending] = self._view[self._start:self._end]
+            self._buf = buf
+            self._view = memoryview(buf)
+        self._start = 0
+        self._end = pending
+
+    def recv_into(self, sock):
+        """Reads from sock directly into the buffer. Returns 0 on EOF"""
+        self._reserve()
+        n = sock.recv_into(self._view[self._end:])
+        self._end += n
+        return n
+
+    def feed(self, data):
+        """Appends data that was already read (e.g. by an asyncio stream)"""
+        self._reserve(len(data))
+        self._buf[self._end:self._end + len(data)] = data
+        self._end += len(data)
+
+    def _next(self):
+        """Returns the (start, end, next) offsets of the next complete record"""
+        if self.mode == "line":
+            idx = self._buf.find(DELIMITER, self._start, self._end)
+            if idx < 0:
+                return None
+            return self._start, idx, idx + 1
+        if self._end - self._start < LENGTH_HEADER.size:
+            return None
+        (size,) = LENGTH_HEADER.unpack_from(self._buf, self._start)
+        begin = self._start + LENGTH_HEADER.size
+        if self._end - begin < size:
+            if LENGTH_HEADER.size + size > self.max_size:
+                raise ValueError("Record is larger than the receive buffer")
+            return None
+        return begin, begin + size, begin + size
+
+    def _consumed(self):
+        if self._start == self._end:
+            self._start = self._end = 0
+
+    def records(self):
+        """Yields every complete record (without framing) and consumes it"""
+        while True:
+            offsets = self._next()
+            if offsets is None:
+                break
+            begin, end, self._start = offsets
+            if end > begin:
+                yield self._view[begin:end]
+        self._consumed()
+
+    def frames(self):
+        """Returns a single memoryview with all complete records, framing included
+
+        Used to forward many records with one send without parsing them."""
+        begin = self._start
+        if self.mode == "line":
+            idx = self._buf.rfind(DELIMITER, self._start, self._end)
+            if idx >= 0:
+                self._start = idx + 1
+        else:
+            while True:
+                offsets = self._next()
+                if offsets is None:
+                    break
+                self._start = offsets[2]
+        view = self._view[begin:self._start]
+        self._consumed()
+        return view
@@ -0,0 +1,221 @@
+"""
+Implementation of the NFV egress FORWARDER
+The last VNF of every SFC sends its output to the forwarder, which finds
+the SFC of each connection and forwards the records to the destination
+configured for that SFC
+"""
+import sys
+import asyncio
+import threading
+import logging
+import json
+import pika as pk
+from config import RABBITMQ_SERVER, FORWARDER_EXCHANGE, FORWARDER_PORT
+from config import FORWARDER_ROUTES, FORWARDER_DEFAULT_ROUTE, FORWARDER_POOL_SIZE
+from config import GATEWAY_WRITE_BUFFER
+from framing import RecordBuffer
+from rpc import reply
+
+def rabbit_connect():
+    connection = pk.BlockingConnection(pk.ConnectionParameters(RABBITMQ_SERVER))
+    return connection.channel()
+
+class UpstreamPool:
+    """Persistent connections to one destination
+
+    The connections are opened on demand and reused by every SFC sent to
+    the destination. An inbound connection always uses the same upstream
+    connection, so the order of its records is kept. The destinations never
+    send data: each connection is read only to see it close (e.g. the
+    destination restarted) and remove it from the pool."""
+    def __init__(self, host, port, size=FORWARDER_POOL_SIZE):
+        self.host = host
+        self.port = port
+        self.writers = [None] * size
+        self.locks = [asyncio.Lock() for _ in range(size)]
+        self.watchers = set() # The loop only keeps weak references to tasks
+
+    async def get(self, key):
+        """Returns an open connection for key, connecting if needed"""
+        idx = hash(key) % len(self.writers)
+        writer = self.writers[idx]
+        if writer is not None and not writer.is_closing():
+            return writer
+        async with self.locks[idx]:
+            writer = self.writers[idx]
+            if writer is None or writer.is_closing():
+                reader, writer = await asyncio.open_connection(self.host, self.port)
+                logging.info("Connected to destination %s:%s", self.host, self.port)
+                self.writers[idx] = writer
+                task = asyncio.create_task(self._watch(idx, reader, writer))
+                self.watchers.add(task)
+                task.add_done_callback(self.watchers.discard)
+        return writer
+
+    async def _watch(self, idx, reader, writer):
+        """Removes the connection from the pool when the destination closes it"""
+        try:
+            while await reader.read(4096):
+                pass
+        except ConnectionError:
+            pass
+        if self.writers[idx] is writer:
+            logging.warning("Destination %s:%s closed the connection", self.host, self.port)
+            self.writers[idx] = None
+        writer.close()
+
+    def close(self):
+        for writer in self.writers:
+            if writer is not None:
+                writer.close()
+
+class Forwarder:
+    def __init__(self, host='192.168.18.11', port=FORWARDER_PORT):
+        self.host = host
+        self.port = port
+        self.loop = None
+        self.server = None
+        self.channel = None
+        self.running = False
+        self.peers = {}  # Address of the last VNF -> sfc_id
+        self.routes = {sfc_id: tuple(dest) for sfc_id, dest in FORWARDER_ROUTES.items()}
+        self.pools = {}  # (host, port) -> UpstreamPool
+        self.stats = {}  # sfc_id -> forwarded and dropped writes
+
+    def start(self):
+        self.running = True
+        try:
+            asyncio.run(self._serve())
+        except asyncio.CancelledError:
+            pass
+
+    async def _serve(self):
+        self.loop = asyncio.get_running_loop()
+        threading.Thread(target=self.start_rabbitmq, args=(), daemon=True).start()
+        self.server = await asyncio.start_server(self.handle_vnf, self.host, self.port)
+        logging.info("Forwarder listening on %s:%s", self.host, self.port)
+        async with self.server:
+            await self.server.serve_forever()
+
+    def start_rabbitmq(self):
+        self.channel = rabbit_connect()
+        self.channel.exchange_declare(exchange=FORWARDER_EXCHANGE,
+                                      exchange_type='fanout')
+
+        result = self.channel.queue_declare(queue="", exclusive=True)
+        queue_name = result.method.queue
+        self.channel.queue_bind(queue=queue_name, exchange=FORWARDER_EXCHANGE)
+        self.channel.basic_consume(queue=queue_name,
+                                   on_message_callback=self.treat_forwarder,
+                                   auto_ack=True)
+        logging.info("Started listening to RabbitMQ queues")
+        self.channel.start_consuming()
+
+    def treat_forwarder(self, ch, method, properties, body):
+        msg = None
+        try:
+            msg = json.loads(body.decode())
+        except:
+            return
+
+        action = msg["action"]
+        if action == "sfc-creation":
+            # The forwarder receives the output of the last VNF
+            last_vnf = list(msg["sfc"].items())[-1]
+            logging.info("SFC %s was created. Last VNF: %s", msg["sfc_id"], last_vnf[0])
+            self.peers[last_vnf[1]] = msg["sfc_id"]
+            if "destination" in msg:
+                self.routes[msg["sfc_id"]] = tuple(msg["destination"])
+        elif action == "sfc-delete":
+            logging.info("SFC %s was deleted.", msg["sfc_id"])
+            self.peers = {addr: sfc for addr, sfc in self.peers.items()
+                          if sfc != msg["sfc_id"]}
+            self.routes.pop(msg["sfc_id"], None)
+        elif action == "set-route":
+            logging.info("SFC %s now forwards to %s", msg["sfc_id"], msg["destination"])
+            self.routes[msg["sfc_id"]] = tuple(msg["destination"])
+        elif action == "forwarder-stats":
+            reply(self.channel, msg, json.dumps(self.stats), properties)
+        elif action == "heartbeat":
+            reply(self.channel, msg, "ok", properties)
+        else:
+            logging.info("Command unknown!")
+
+    def get_pool(self, sfc_id):
+        destination = self.routes.get(sfc_id, tuple(FORWARDER_DEFAULT_ROUTE))
+        pool = self.pools.get(destination)
+        if pool is None:
+            pool = self.pools[destination] = UpstreamPool(*destination)
+        return pool
+
+    def count(self, sfc_id, field, n):
+        if sfc_id not in self.stats:
+            self.stats[sfc_id] = {"writes": 0, "bytes": 0, "dropped": 0}
+        self.stats[sfc_id][field] += n
+
+    async def handle_vnf(self, reader, writer):
+        addr = writer.get_extra_info("peername")
+        logging.info("VNF %s connected.", addr)
+        buffer = RecordBuffer()
+        try:
+            while True:
+                chunk = await reader.read(GATEWAY_WRITE_BUFFER)
+                if not chunk:
+                    break
+                buffer.feed(chunk)
+                # Only complete records, the upstream connection is shared
+                data = bytes(buffer.frames())
+                if not data:
+                    continue
+                # Looked up on every read, the SFC may be announced after the VNF connects
+                sfc_id = self.peers.get(addr[0])
+                try:
+                    upstream = await self.get_pool(sfc_id).get(addr)
+                except OSError as e:
+                    logging.warning("Destination of SFC %s unreachable: %s", sfc_id, e)
+                    self.count(sfc_id, "dropped", 1)
+                    continue
+                upstream.write(data)
+                self.count(sfc_id, "writes", 1)
+                self.count(sfc_id, "bytes", len(data))
+                # Slow destinations apply backpressure to the VNF
+                if upstream.transport.get_write_buffer_size() > GATEWAY_WRITE_BUFFER:
+                    await upstream.drain()
+        except ConnectionError:
+            pass
+        finally:
+            logging.info("VNF %s disconnected.", addr)
+            writer.close()
+
+    def stop(self):
+        self.running = False
+        if self.loop is not None and self.server is not None:
+            self.loop.call_soon_threadsafe(self.server.close)
+            for pool in self.pools.values():
+                self.loop.call_soon_threadsafe(pool.close)
+        if self.channel is not None:
+            self.channel.stop_consuming()
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        filename="logs/forwarder.log",
+        filemode="w",
+        level=logging.INFO,
+        format="%(asctime)s | %(levelname)s | FORWARDER | %(message)s",
+        datefmt="%m-%d %H:%M:%S"
+    )
+    port = FORWARDER_PORT
+    if len(sys.argv) >= 2:
+        port = int(sys.argv[1])
+    fwd = Forwarder(port=port)
+    import signal
+
+    def shutdown(signum, frame):
+        logging.info("Shutdown signal received (%s).", signum)
+        fwd.stop()
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    fwd.start()
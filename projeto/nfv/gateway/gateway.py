@@ -3,33 +3,49 @@ Implementation of NFV-GATEWAY
 Listens to clients in a TCP port, and foward the packets to SFCs
 """
 import sys
+import asyncio
+import multiprocessing
+import os
+import signal
 import socket
 import threading
 import logging
 import json
-import time
-import random
 import pika as pk
 from queue import Queue
 from config import RABBITMQ_SERVER, GATEWAY_PORT, GATEWAY_EXCHANGE, NFVIN_EXCHANGE
 from config import DEFAULT_IN_PORT, IDS_IP, IDS_PORT
+from config import GATEWAY_MODE, GATEWAY_WRITE_BUFFER, GATEWAY_FLOW_FIELDS
+from config import GATEWAY_POLICY, GATEWAY_WORKERS, VNF_EVENTS_EXCHANGE
+from framing import RecordBuffer, frame, split_frames
+from gateway.mirror import IDSMirror, MirrorPolicy
+from rpc import reply
+from gateway.routing import LoadBalancer, flow_hash, socket_outstanding, socket_rtt
+
+# Load reported for SFCs whose first VNF is not connected
+NOT_CONNECTED = (float("inf"), 0.0)
 
 def rabbit_connect():
     connection = pk.BlockingConnection(pk.ConnectionParameters(RABBITMQ_SERVER))
     return connection.channel()
 
 class Gateway:
-    def __init__(self, host='192.168.18.11', port=GATEWAY_PORT):
+    def __init__(self, host='192.168.18.11', port=GATEWAY_PORT, policy=GATEWAY_POLICY):
         self.host = host
         self.port = port
         self.server_socket = None
         self.running = False
-        self.sniffing = False
-        self.ids_socket = None
+        self.mirror = None
+        self.mirror_policy = MirrorPolicy()
         self.connect_to_sniffer(address=IDS_IP, port=IDS_PORT)
         self.clients = {}
         self.connections = {}
+        # Client threads share the VNF sockets, a record is written with the lock held
+        self.send_locks = {}
         self.sfc_catalog = {} # Store all the current instantiated SFCs
+        self.balancer = LoadBalancer(self.vnf_load, policy=policy) # SFCs that can receive flows
+        self.flow_keys = {} # Client address -> hash of the flow key
+        self.flow_fields = GATEWAY_FLOW_FIELDS
 
     def start(self):
         # Start consuming RabbitMq queues
@@ -44,6 +60,7 @@ class Gateway:
         while self.running:
             client_socket, addr = self.server_socket.accept()
             self.clients[addr] = client_socket
+            self.flow_keys[addr] = flow_hash(f"{addr[0]}:{addr[1]}".encode())
             logging.info("Client %s connected.", addr)
             threading.Thread(target=self.handle_client, args=(client_socket, addr), daemon=True).start()
         
@@ -58,6 +75,16 @@ class Gateway:
         self.channel.basic_consume(queue=queue_name,
                                    on_message_callback=self.treat_gateway,
                                    auto_ack=True)
+
+        # A VNF that (re)starts announces that it is ready, the gateway connects then
+        self.channel.exchange_declare(exchange=VNF_EVENTS_EXCHANGE, exchange_type='topic')
+        result = self.channel.queue_declare(queue="", exclusive=True)
+        events_queue = result.method.queue
+        self.channel.queue_bind(queue=events_queue, exchange=VNF_EVENTS_EXCHANGE,
+                                routing_key="*.*.vnf-ready")
+        self.channel.basic_consume(queue=events_queue,
+                                   on_message_callback=self.treat_vnf_event,
+                                   auto_ack=True)
         logging.info("Started listening to RabbitMQ queues")
         self.channel.start_consuming()
 
@@ -74,114 +101,347 @@ class Gateway:
             first_vnf = next(iter(msg["sfc"].items()))
             self.connect_to_vnf(vnf_id=first_vnf[0], addr=first_vnf[1])
             self.sfc_catalog[msg["sfc_id"]] = msg["sfc"]
+            # Packets of the SFC go to its first VNF
+            self.balancer.add(msg["sfc_id"], first_vnf[0],
+                              weight=float(msg.get("weight", 1.0)))
         elif action == "sfc-delete":
             logging.info("SFC %s was deleted..", msg["sfc_id"])
-            if self.sfc_catalog[msg["sfc_id"]]:
+            self.balancer.remove(msg["sfc_id"])
+            if msg["sfc_id"] in self.sfc_catalog:
+                first_vnf = next(iter(self.sfc_catalog[msg["sfc_id"]]), None)
+                self.disconnect_vnf(first_vnf)
                 del self.sfc_catalog[msg["sfc_id"]]
+        elif action == "mirror-policy":
+            try:
+                # Replacing the object is atomic for the client threads
+                self.mirror_policy = MirrorPolicy.from_message(msg)
+                logging.info("New IDS mirror policy: %s", msg)
+                response = "ok"
+            except (ValueError, KeyError) as e:
+                logging.error("Invalid mirror policy %s: %s", msg, e)
+                response = f"error: {e}"
+            reply(self.channel, msg, response, properties)
+        elif action == "mirror-stats":
+            stats = self.mirror.stats()
+            stats.update(self.mirror_policy.counters)
+            reply(self.channel, msg, json.dumps(stats), properties)
         elif action == "heartbeat":
             logging.debug("Heartbeat message received")
-            self.channel.basic_publish(exchange="", routing_key=msg["rqueue"],
-                                       body="ok")
+            reply(self.channel, msg, "ok", properties)
         else:
             logging.info("Command unknown!")
 
-    def connect_to_vnf(self, vnf_id, addr, max_attempts=60):
-        """Connects to a VNF at the given address and stores the socket."""
-        counter = 0
-        while counter < max_attempts:
-            try:
-                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                s.connect((addr, 2323))
-                self.connections[vnf_id] = s
-                logging.info("Connected to %s. Address: %s", vnf_id, addr)
-                return
-            except Exception as e:
-                logging.error("Connection to %s at %s failed: %s. Trying again", vnf_id, addr, e)
-            counter += 1
-            time.sleep(1)
-        logging.error("Max attempst at connect to %s", vnf_id)
+    def treat_vnf_event(self, ch, method, properties, body):
+        """vnf-ready: connects to the first VNF of an SFC if it is not connected"""
+        try:
+            msg = json.loads(body.decode())
+        except ValueError:
+            return
+        vnf_id = msg["vnf_id"]
+        sfc = self.sfc_catalog.get(msg.get("sfc_id"))
+        if sfc is None or next(iter(sfc), None) != vnf_id or vnf_id in self.connections:
+            return
+        logging.info("VNF %s is ready.", vnf_id)
+        self.connect_to_vnf(vnf_id=vnf_id, addr=sfc[vnf_id])
+
+    def connect_to_vnf(self, vnf_id, addr):
+        """Connects to a VNF at the given address and stores the socket.
+
+        The SFC is only announced when its VNFs are ready, so there is no retry:
+        if the connection fails it is made again when the VNF announces vnf-ready"""
+        try:
+            s = socket.create_connection((addr, 2323), timeout=5)
+            s.settimeout(None)
+            self.send_locks[vnf_id] = threading.Lock()
+            self.connections[vnf_id] = s
+            logging.info("Connected to %s. Address: %s", vnf_id, addr)
+        except OSError as e:
+            logging.error("Connection to %s at %s failed: %s. Waiting for it to be ready",
+                          vnf_id, addr, e)
+
+    def disconnect_vnf(self, vnf_id):
+        """Closes the connection with a VNF, if any"""
+        conn = self.connections.pop(vnf_id, None)
+        self.send_locks.pop(vnf_id, None)
+        if conn is not None:
+            conn.close()
 
     def send_to_vnf(self, vnf_id, msg):
         """Sends a message to the connected VNF."""
-        if vnf_id not in self.connections:
-            print(f"VNF {vnf_id} is not connected.")
+        conn = self.connections.get(vnf_id)
+        lock = self.send_locks.get(vnf_id)
+        if conn is None or lock is None:
+            logging.warning("VNF %s is not connected.", vnf_id)
             return
         try:
-            self.connections[vnf_id].sendall(msg)
-            print(f"Sent to {vnf_id}: {msg}")
+            # Partial writes of two clients would interleave their records
+            with lock:
+                conn.sendall(msg)
+            logging.debug("Sent %d bytes to %s", len(msg), vnf_id)
         except Exception as e:
-            print(f"Failed to send message to {vnf_id}: {e}")
+            logging.error("Failed to send message to %s: %s", vnf_id, e)
+            # Connected again when the VNF announces vnf-ready
+            self.disconnect_vnf(vnf_id)
 
 
     def handle_client(self, client_socket, addr):
         # RabbitMQ support one connection per thread
         # Create internal channel just for publishing messages
+        buffer = RecordBuffer()
         with client_socket:
             while True:
                 try:
-                    data = client_socket.recv(1024)
-                    if not data:
+                    if not buffer.recv_into(client_socket):
                         break
-                    data.strip()
-                    sfc_id = self.route_to_sfc(data, addr)
-                    self.send_to_ids(data)
-                    if sfc_id is not None:
-                        logging.info("Sending data to vnf: %s", sfc_id)
-                        self.send_to_vnf(sfc_id, data) 
-                    else:
+                    # Only complete records are forwarded, all of them in one send
+                    data = buffer.frames()
+                    if not data:
+                        continue
+                    routes = self.route_to_sfc(data, addr)
+                    self.send_to_ids(data, flow=self.flow_keys.get(addr))
+                    for vnf_id, records in routes:
+                        logging.info("Sending data to vnf: %s", vnf_id)
+                        self.send_to_vnf(vnf_id, records)
+                    if not routes:
                         logging.warning("Got data, but no SFC is UP!")
 
                 except ConnectionResetError:
-                    logging.info("Client %s disconnected.", addr)
-                    del self.clients[addr]
                     break
+                except ValueError as e:
+                    # Framing error, e.g. a record larger than the buffer
+                    logging.error("Dropping client %s: %s", addr, e)
+                    break
+        logging.info("Client %s disconnected.", addr)
+        self.clients.pop(addr, None)
+        self.mirror_policy.forget(self.flow_keys.pop(addr, None))
 
     def connect_to_sniffer(self, address, port):
-        self.sniffing_thread = threading.Thread(target=self._connect_to_sniffer, args=(address, port), daemon=True)
-        self.sniffing_thread.start()
-    
-    def _connect_to_sniffer(self, address, port):
-        logging.info("Attempting to connected to IDS: %s", address)
-        while not self.sniffing:
-            try:
-                self.ids_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                self.ids_socket.connect((address, port))
-                self.sniffing = True
-                logging.info("Connected to IDS: %s", address)
-            except ConnectionRefusedError:
-                time.sleep(1)
+        # The mirror connects (and reconnects) to the IDS in its own thread
+        self.mirror = IDSMirror(address, port)
 
-
-    def send_to_ids(self, message):
-        if self.sniffing and self.ids_socket:
-            try:
-                self.ids_socket.sendall(message)
-                logging.info("Sending message %s to IDS.", message)
-            except Exception as e:
-                logging.debug("An error ocurred while sending message to IDS. [%s]", e)
-                self.connected = False
-                self.ids_socket.close()
-                self.ids_socket = None
+    def send_to_ids(self, message, flow=None):
+        """Mirrors the records of message selected by the mirror policy,
+        without waiting for them to be sent"""
+        message = self.mirror_policy.select(message, flow)
+        if message:
+            self.mirror.push(message)
 
 
     def route_to_sfc(self, data, addr):
-        """Given a package and an address, route to the correct SFC
-            @param data: Package received
+        """Given a package and an address, route to the correct SFCs
+            @param data: Package received (one or more complete records)
             @param addr: Client address
-            @returns a valid SFC ID, returns None if an error ocurred"""
-        # TODO: add some logic here, by now, returning a random sfc_id
-        try:
-            sfc_id = random.choice(list(self.connections.keys()))
-        except:
-            return None
-        return sfc_id
+            @returns list of (first VNF of an SFC, its records), records
+            without a valid SFC are dropped"""
+        if not self.flow_fields:
+            key_hash = self.flow_keys.get(addr)
+            target = self.balancer.choose(key_hash) if key_hash is not None else None
+            return [(target, data)] if target is not None else []
+        # A read can hold records of several flows, each one follows its own key
+        groups = {}
+        for record in split_frames(data):
+            record = bytes(record)
+            fields = record.split(b",")
+            try:
+                key = b",".join(fields[i] for i in self.flow_fields)
+            except IndexError:
+                continue
+            target = self.balancer.choose(flow_hash(key))
+            if target is not None:
+                groups.setdefault(target, []).append(frame(record))
+        return [(target, b"".join(records)) for target, records in groups.items()]
+
+    def vnf_load(self, vnf_id):
+        """Live load of the connection to a VNF: (outstanding bytes, rtt in seconds)"""
+        conn = self.connections.get(vnf_id)
+        if conn is None:
+            return NOT_CONNECTED
+        return socket_outstanding(conn), socket_rtt(conn)
                     
     def stop(self):
         self.running = False
         if self.server_socket:
             self.server_socket.close()
+        self.mirror.stop()
         self.channel.stop_consuming()
 
+class AsyncGateway(Gateway):
+    """Event loop version of the Gateway
+
+    All client, VNF and IDS sockets are multiplexed in a single asyncio loop,
+    so the number of clients is no longer bounded by the number of threads.
+    Writes never block the loop: every socket keeps its own write buffer
+    (the transport buffer). A client is only paused when the VNF socket it
+    writes to has more than GATEWAY_WRITE_BUFFER bytes pending, and IDS
+    mirroring is dropped instead of paused.
+
+    The listening socket uses SO_REUSEPORT, so AsyncGatewayWorkers can run
+    one gateway process per core on the same port."""
+    def __init__(self, host='192.168.18.11', port=GATEWAY_PORT, policy=GATEWAY_POLICY,
+                 reuse_port=True):
+        self.loop = None
+        self.server = None
+        self.reuse_port = reuse_port
+        super().__init__(host=host, port=port, policy=policy)
+
+    def start(self):
+        self.running = True
+        try:
+            asyncio.run(self._serve())
+        except asyncio.CancelledError:
+            pass
+
+    async def _serve(self):
+        self.loop = asyncio.get_running_loop()
+        # The RabbitMQ consumer needs the loop to schedule VNF connections
+        threading.Thread(target=self.start_rabbitmq, args=(), daemon=True).start()
+
+        self.server = await asyncio.start_server(self.handle_client_async,
+                                                 self.host, self.port,
+                                                 reuse_port=self.reuse_port)
+        logging.info("Gateway (async) listening on %s:%s", self.host, self.port)
+        async with self.server:
+            await self.server.serve_forever()
+
+    def connect_to_vnf(self, vnf_id, addr):
+        """Called from the RabbitMQ thread, the connection is made by the loop"""
+        if self.loop is None:
+            logging.error("Event loop not running, cannot connect to %s", vnf_id)
+            return
+        asyncio.run_coroutine_threadsafe(self._connect_to_vnf(vnf_id, addr), self.loop)
+
+    async def _connect_to_vnf(self, vnf_id, addr):
+        if vnf_id in self.connections:
+            return
+        try:
+            reader, writer = await asyncio.open_connection(addr, DEFAULT_IN_PORT)
+        except OSError as e:
+            # Connected again when the VNF announces vnf-ready
+            logging.error("Connection to %s at %s failed: %s. Waiting for it to be ready",
+                          vnf_id, addr, e)
+            return
+        self.connections[vnf_id] = writer
+        logging.info("Connected to %s. Address: %s", vnf_id, addr)
+        try:
+            # VNFs do not answer, reading only detects the connection closing
+            await reader.read()
+        except OSError:
+            pass
+        logging.info("Connection to %s closed.", vnf_id)
+        if self.connections.get(vnf_id) is writer:
+            del self.connections[vnf_id]
+        writer.close()
+
+    def vnf_load(self, vnf_id):
+        conn = self.connections.get(vnf_id)
+        if conn is None:
+            return NOT_CONNECTED
+        # Bytes still in the transport buffer are outstanding as well
+        sock = conn.get_extra_info("socket")
+        outstanding = conn.transport.get_write_buffer_size() + socket_outstanding(sock)
+        return outstanding, socket_rtt(sock)
+
+    def disconnect_vnf(self, vnf_id):
+        conn = self.connections.pop(vnf_id, None)
+        if conn is not None and self.loop is not None:
+            self.loop.call_soon_threadsafe(conn.close)
+
+    async def handle_client_async(self, reader, writer):
+        addr = writer.get_extra_info("peername")
+        self.clients[addr] = writer
+        self.flow_keys[addr] = flow_hash(f"{addr[0]}:{addr[1]}".encode())
+        logging.info("Client %s connected.", addr)
+        buffer = RecordBuffer()
+        try:
+            while True:
+                chunk = await reader.read(GATEWAY_WRITE_BUFFER)
+                if not chunk:
+                    break
+                buffer.feed(chunk)
+                # Transports may keep a reference, so the records are copied once
+                data = bytes(buffer.frames())
+                if not data:
+                    continue
+                routes = self.route_to_sfc(data, addr)
+                self.send_to_ids(data, flow=self.flow_keys.get(addr))
+                vnfs = [(self.connections.get(vnf_id), records) for vnf_id, records in routes]
+                vnfs = [(vnf, records) for vnf, records in vnfs if vnf is not None]
+                if not vnfs:
+                    logging.warning("Got data, but no SFC is UP!")
+                    continue
+                for vnf, records in vnfs:
+                    vnf.write(records)
+                # Backpressure only for this client, the loop keeps running
+                for vnf, _ in vnfs:
+                    if vnf.transport.get_write_buffer_size() > GATEWAY_WRITE_BUFFER:
+                        await vnf.drain()
+        except ConnectionError:
+            pass
+        except ValueError as e:
+            logging.error("Dropping client %s: %s", addr, e)
+        finally:
+            logging.info("Client %s disconnected.", addr)
+            self.clients.pop(addr, None)
+            self.mirror_policy.forget(self.flow_keys.pop(addr, None))
+            writer.close()
+
+    def send_to_ids(self, message, flow=None):
+        message = self.mirror_policy.select(message, flow)
+        # Blocking would stop the whole loop, so a full mirror always drops
+        if message:
+            self.mirror.push(message, block=False)
+
+    def stop(self):
+        self.running = False
+        if self.loop is not None and self.server is not None:
+            self.loop.call_soon_threadsafe(self.server.close)
+        self.mirror.stop()
+        self.channel.stop_consuming()
+
+def run_async_gateway(host, port, policy):
+    """Body of a worker process of AsyncGatewayWorkers"""
+    # The handlers of the parent would stop the sibling workers
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    try:
+        AsyncGateway(host=host, port=port, policy=policy).start()
+    except KeyboardInterrupt:
+        pass
+
+class AsyncGatewayWorkers:
+    """Runs several AsyncGateway processes, each with its own event loop
+
+    All of them listen on the same port (SO_REUSEPORT) and the kernel spreads
+    the client connections among them. Every worker consumes the gateway
+    exchange and connects to the SFCs by itself, so the first VNF of an SFC
+    has one connection per worker. A control RPC (mirror-policy,
+    mirror-stats...) is answered by the first worker that replies: policies
+    reach every worker, but mirror-stats only has the counters of one."""
+    def __init__(self, host='192.168.18.11', port=GATEWAY_PORT, policy=GATEWAY_POLICY,
+                 workers=GATEWAY_WORKERS):
+        self.host = host
+        self.port = port
+        self.policy = policy
+        self.workers = workers or os.cpu_count()
+        self.processes = []
+
+    def start(self):
+        ctx = multiprocessing.get_context("fork")
+        for i in range(self.workers):
+            process = ctx.Process(target=run_async_gateway, name=f"gateway-{i}",
+                                  args=(self.host, self.port, self.policy), daemon=True)
+            process.start()
+            self.processes.append(process)
+        logging.info("Started %d gateway workers on port %s", self.workers, self.port)
+        for process in self.processes:
+            process.join()
+
+    def stop(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join(timeout=5)
+
 # Example usage:
 if __name__ == "__main__":
     logging.basicConfig(
@@ -192,10 +452,23 @@ if __name__ == "__main__":
         datefmt="%m-%d %H:%M:%S"
     )
     port = GATEWAY_PORT
-    if len(sys.argv) == 2:
+    mode = GATEWAY_MODE
+    policy = GATEWAY_POLICY
+    workers = GATEWAY_WORKERS
+    if len(sys.argv) >= 2:
         port = int(sys.argv[1])
-    ap = Gateway(port=port)
-    import signal
+    if len(sys.argv) >= 3:
+        mode = sys.argv[2]
+    if len(sys.argv) >= 4:
+        policy = sys.argv[3]
+    if len(sys.argv) >= 5:
+        workers = int(sys.argv[4])
+    if mode == "async" and workers != 1:
+        ap = AsyncGatewayWorkers(port=port, policy=policy, workers=workers)
+    elif mode == "async":
+        ap = AsyncGateway(port=port, policy=policy)
+    else:
+        ap = Gateway(port=port, policy=policy)
 
     def shutdown(signum, frame):
         logging.info("Shutdown signal received (%s).", signum)
@@ -0,0 +1,200 @@
+"""
+Mirroring of the gateway traffic to the IDS
+
+The data path only appends the records to a bounded ring buffer. A writer
+thread drains the buffer and sends many records at once with a single
+vectored send (sendmsg), so a slow IDS never slows down the SFC traffic.
+When the buffer is full the policy decides what happens:
+    drop: the record is not mirrored and the drop counter is incremented
+    block: the data path waits until the writer frees space
+
+MirrorPolicy selects which records are mirrored, so the IDS load can be
+reduced: uniform sampling, the first N records of each flow and filters
+on CSV fields (e.g. only protocol_type tcp).
+"""
+import collections
+import logging
+import random
+import socket
+import threading
+import time
+import ids.internal_configuration as ids_config
+from config import IDS_MIRROR_CAPACITY, IDS_MIRROR_BATCH, IDS_MIRROR_POLICY
+from framing import frame, split_frames, sendmsg_all
+
+MIRROR_POLICIES = ("drop", "block")
+SAMPLING_MODES = ("all", "uniform", "flow")
+
+class MirrorPolicy:
+    def __init__(self, mode="all", rate=1.0, flow_records=0, filters=None, dataset="kdd99"):
+        """
+            @param mode: all, uniform (rate of the records) or flow (first flow_records of each flow)
+            @param rate: Fraction of records mirrored in uniform mode
+            @param flow_records: Number of records mirrored per flow in flow mode
+            @param filters: {field: [values]}, only records with one of the values are mirrored.
+                            The field is a column name of the dataset or its index
+            @param dataset: Dataset used to find the index of the fields
+        """
+        if mode not in SAMPLING_MODES:
+            raise ValueError(f"Invalid sampling mode: {mode}")
+        if not 0.0 <= rate <= 1.0:
+            raise ValueError("Sampling rate must be between 0 and 1")
+        self.mode = mode
+        self.rate = rate
+        self.flow_records = flow_records
+        self.filters = []
+        columns = list(ids_config.features[dataset]["features"].keys())
+        for field, values in (filters or {}).items():
+            idx = field if isinstance(field, int) else columns.index(field)
+            self.filters.append((idx, {str(v).encode() for v in values}))
+        self.flows = {} # flow -> number of records mirrored
+        self.counters = {
+            "sampled_out": 0,  # Records not selected by the sampling
+            "filtered_out": 0, # Records that did not match the filters
+        }
+
+    @classmethod
+    def from_message(cls, msg):
+        return cls(mode=msg.get("mode", "all"),
+                   rate=float(msg.get("rate", 1.0)),
+                   flow_records=int(msg.get("flow_records", 0)),
+                   filters=msg.get("filters"),
+                   dataset=msg.get("dataset", "kdd99"))
+
+    def keep(self, record, flow=None):
+        """Returns True if the record (without framing) must be mirrored"""
+        if self.filters:
+            fields = bytes(record).split(b",")
+            for idx, values in self.filters:
+                if idx >= len(fields) or fields[idx] not in values:
+                    self.counters["filtered_out"] += 1
+                    return False
+        if self.mode == "uniform":
+            if random.random() >= self.rate:
+                self.counters["sampled_out"] += 1
+                return False
+        elif self.mode == "flow" and flow is not None:
+            count = self.flows.get(flow, 0)
+            if count >= self.flow_records:
+                self.counters["sampled_out"] += 1
+                return False
+            self.flows[flow] = count + 1
+        return True
+
+    def select(self, data, flow=None):
+        """Returns the records of data (framing included) that must be mirrored"""
+        if self.mode == "all" and not self.filters:
+            return data
+        return b"".join(frame(bytes(record)) for record in split_frames(data)
+                        if self.keep(record, flow))
+
+    def forget(self, flow):
+        """The flow ended, its counter is no longer needed"""
+        self.flows.pop(flow, None)
+
+class IDSMirror:
+    def __init__(self, address, port, capacity=IDS_MIRROR_CAPACITY,
+                 batch=IDS_MIRROR_BATCH, policy=IDS_MIRROR_POLICY):
+        """
+            @param address, port: IDS sniffer address
+            @param capacity: Max number of writes waiting in the ring buffer
+            @param batch: Max number of writes sent in one sendmsg
+            @param policy: What to do when the buffer is full (drop or block)
+        """
+        if policy not in MIRROR_POLICIES:
+            raise ValueError(f"Invalid mirror policy: {policy}")
+        self.address = address
+        self.port = port
+        self.capacity = capacity
+        self.batch = batch
+        self.policy = policy
+        self.sock = None
+        self.connected = False
+        self.running = True
+        self.buffer = collections.deque()
+        self.cond = threading.Condition()
+        self.counters = {
+            "mirrored": 0,      # Writes sent to the IDS
+            "dropped": 0,       # Writes dropped because the IDS is behind
+            "disconnected": 0,  # Writes dropped because the IDS is not connected
+        }
+        self.thread = threading.Thread(target=self._writer, daemon=True)
+        self.thread.start()
+
+    def push(self, data, block=None):
+        """Queues data to be mirrored. Returns False if it was dropped
+
+            @param block: Overrides the policy (the async gateway never blocks)"""
+        if block is None:
+            block = self.policy == "block"
+        with self.cond:
+            if not self.connected:
+                self.counters["disconnected"] += 1
+                return False
+            while len(self.buffer) >= self.capacity:
+                if not block or not self.connected:
+                    self.counters["dropped"] += 1
+                    return False
+                self.cond.wait()
+            # data may be a view of a receive buffer that will be reused
+            self.buffer.append(bytes(data))
+            if len(self.buffer) == 1:
+                self.cond.notify_all()
+        return True
+
+    def stats(self):
+        with self.cond:
+            stats = dict(self.counters)
+            stats["queued"] = len(self.buffer)
+            stats["connected"] = self.connected
+        return stats
+
+    def _connect(self):
+        logging.info("Attempting to connected to IDS: %s", self.address)
+        while self.running:
+            try:
+                self.sock = socket.create_connection((self.address, self.port))
+                with self.cond:
+                    self.connected = True
+                logging.info("Connected to IDS: %s", self.address)
+                return
+            except OSError:
+                time.sleep(1)
+
+    def _disconnect(self):
+        with self.cond:
+            self.connected = False
+            self.counters["disconnected"] += len(self.buffer)
+            self.buffer.clear()
+            # Wake up blocked producers, they will drop
+            self.cond.notify_all()
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def _writer(self):
+        while self.running:
+            if not self.connected:
+                self._connect()
+                continue
+            with self.cond:
+                while not self.buffer and self.running:
+                    self.cond.wait()
+                n = min(len(self.buffer), self.batch)
+                batch = [self.buffer.popleft() for _ in range(n)]
+                self.cond.notify_all()
+            if not batch:
+                continue
+            try:
+                sendmsg_all(self.sock, batch)
+                self.counters["mirrored"] += len(batch)
+            except OSError as e:
+                logging.debug("An error ocurred while sending message to IDS. [%s]", e)
+                self._disconnect()
+
+    def stop(self):
+        self.running = False
+        with self.cond:
+            self.cond.notify_all()
+        if self.sock is not None:
+            self.sock.close()
@@ -0,0 +1,198 @@
+"""
+Routing of client flows to SFCs
+
+HashRing implements consistent hashing: every SFC is placed in the ring
+multiple times (virtual nodes, in proportion to its weight) and a flow is
+sent to the owner of the first virtual node after the hash of its key. Adding or removing an SFC only moves
+the flows that hash to the arcs owned by that SFC.
+
+To make lookups O(1), the ring is also kept as a table with 2^bits slots,
+indexed by the high bits of the flow hash. The table is updated only in the
+slots affected by the virtual nodes added or removed.
+
+LoadBalancer chooses between the SFCs with one of the policies:
+    hash: consistent hashing of the flow key (flow affinity)
+    least-outstanding: SFC with the lowest load score
+    p2c: lowest load score among two random SFCs (power of two choices)
+The load score uses live signals of the socket to the first VNF of each SFC
+(bytes not yet acknowledged and the smoothed RTT) and the SFC weight.
+"""
+import bisect
+import fcntl
+import random
+import socket
+import struct
+import termios
+from dataclasses import dataclass
+from hashlib import blake2b
+from config import GATEWAY_RING_REPLICAS, GATEWAY_RING_BITS, GATEWAY_POLICY
+
+HASH_BITS = 32
+POLICIES = ("hash", "least-outstanding", "p2c")
+# Offset of tcpi_rtt (microseconds) in struct tcp_info (linux/tcp.h)
+TCP_INFO_RTT = struct.Struct("I")
+TCP_INFO_RTT_OFFSET = 68
+TCP_INFO_SIZE = 104
+OUTQ = struct.Struct("i")
+
+def flow_hash(key):
+    """32 bits hash of key (bytes), stable across processes"""
+    return int.from_bytes(blake2b(key, digest_size=4).digest(), "big")
+
+class HashRing:
+    def __init__(self, replicas=GATEWAY_RING_REPLICAS, bits=GATEWAY_RING_BITS):
+        """
+            @param replicas: Number of virtual nodes of a member of weight 1
+            @param bits: The lookup table has 2^bits slots
+        """
+        self.replicas = replicas
+        self.shift = HASH_BITS - bits
+        self.n_slots = 1 << bits
+        self.members = {}  # name -> target returned by lookup
+        self._points = []  # Sorted hashes of all virtual nodes
+        self._owner = {}   # virtual node hash -> member name
+        self._table = [None] * self.n_slots
+
+    def __len__(self):
+        return len(self.members)
+
+    def __contains__(self, name):
+        return name in self.members
+
+    def _vnodes(self, name, weight):
+        for i in range(max(1, round(self.replicas * weight))):
+            point = flow_hash(f"{name}#{i}".encode())
+            # Collisions are rare, the first member keeps the point
+            if point not in self._owner:
+                yield point
+
+    def _fill(self, low, high, target):
+        """Sets target in the slots whose start is in (low, high] (may wrap)"""
+        first = (low >> self.shift) + 1
+        last = high >> self.shift
+        if low < high:
+            slots = range(first, last + 1)
+        else:
+            slots = list(range(first, self.n_slots)) + list(range(0, last + 1))
+        for slot in slots:
+            self._table[slot] = target
+
+    def _arc(self, idx):
+        """Returns the hash of the virtual node before self._points[idx]"""
+        return self._points[idx - 1] if len(self._points) > 1 else self._points[idx]
+
+    def add(self, name, target=None, weight=1.0):
+        """Adds a member to the ring. lookup returns target (or name)
+
+            @param weight: Scales the number of virtual nodes, so the share of
+            flows of the member"""
+        if name in self.members:
+            self.remove(name)
+        target = name if target is None else target
+        self.members[name] = target
+        for point in list(self._vnodes(name, weight)):
+            idx = bisect.bisect_left(self._points, point)
+            self._points.insert(idx, point)
+            self._owner[point] = name
+            if len(self._points) == 1:
+                self._table = [target] * self.n_slots
+            else:
+                self._fill(self._arc(idx), point, target)
+
+    def remove(self, name):
+        """Removes a member, its slots are given to the next virtual node"""
+        if name not in self.members:
+            return
+        points = [p for p, owner in self._owner.items() if owner == name]
+        for point in points:
+            idx = bisect.bisect_left(self._points, point)
+            low = self._arc(idx)
+            del self._points[idx]
+            del self._owner[point]
+            if not self._points:
+                self._table = [None] * self.n_slots
+                continue
+            successor = self._points[idx % len(self._points)]
+            self._fill(low, point, self.members[self._owner[successor]])
+        del self.members[name]
+
+    def lookup(self, key_hash):
+        """Returns the target responsible for key_hash, None if the ring is empty"""
+        return self._table[key_hash >> self.shift]
+
+def socket_outstanding(sock):
+    """Bytes written to sock that were not acknowledged by the peer yet"""
+    try:
+        buf = fcntl.ioctl(sock.fileno(), termios.TIOCOUTQ, bytes(OUTQ.size))
+    except (OSError, ValueError):
+        return 0
+    return OUTQ.unpack(buf)[0]
+
+def socket_rtt(sock):
+    """Smoothed round-trip time (seconds) measured by the kernel for sock"""
+    try:
+        info = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, TCP_INFO_SIZE)
+    except (OSError, ValueError):
+        return 0.0
+    if len(info) < TCP_INFO_RTT_OFFSET + TCP_INFO_RTT.size:
+        return 0.0
+    return TCP_INFO_RTT.unpack_from(info, TCP_INFO_RTT_OFFSET)[0] / 1e6
+
+@dataclass
+class SFCState:
+    """An SFC that can receive traffic"""
+    sfc_id: str
+    target: str # Returned by choose (first VNF of the SFC)
+    weight: float = 1.0
+
+class LoadBalancer:
+    def __init__(self, load, policy=GATEWAY_POLICY, base_rtt=0.001):
+        """
+            @param load: Callable(target) -> (outstanding bytes, rtt in seconds)
+            @param policy: One of POLICIES
+            @param base_rtt: Added to the RTT, so idle SFCs still differ by weight
+        """
+        if policy not in POLICIES:
+            raise ValueError(f"Invalid balancing policy: {policy}")
+        self.policy = policy
+        self.load = load
+        self.base_rtt = base_rtt
+        self.ring = HashRing()
+        self.sfcs = {}
+        self._states = () # Snapshot used by the data path, replaced on changes
+
+    def __len__(self):
+        return len(self.sfcs)
+
+    def add(self, sfc_id, target, weight=1.0):
+        if weight <= 0:
+            raise ValueError("SFC weight must be positive")
+        self.ring.add(sfc_id, target, weight)
+        self.sfcs[sfc_id] = SFCState(sfc_id, target, weight)
+        self._states = tuple(self.sfcs.values())
+
+    def remove(self, sfc_id):
+        self.ring.remove(sfc_id)
+        if self.sfcs.pop(sfc_id, None) is not None:
+            self._states = tuple(self.sfcs.values())
+
+    def score(self, state):
+        """Expected cost of sending to the SFC, lower is better"""
+        outstanding, rtt = self.load(state.target)
+        return (outstanding + 1) * (rtt + self.base_rtt) / state.weight
+
+    def choose(self, key_hash):
+        """Returns the target that must receive the flow with hash key_hash"""
+        if self.policy == "hash":
+            return self.ring.lookup(key_hash)
+        states = self._states
+        if len(states) < 2:
+            return states[0].target if states else None
+        if self.policy == "p2c":
+            i = random.randrange(len(states))
+            j = random.randrange(len(states) - 1)
+            if j >= i:
+                j += 1
+            a, b = states[i], states[j]
+            return a.target if self.score(a) <= self.score(b) else b.target
+        return min(states, key=self.score).target
@@ -4,13 +4,15 @@ This file contain the implementantion of a IDS (Intrusion Detection System)
 """
 import logging
 import threading
-import time
 import json
-from datetime import datetime
+import numpy as np
+from datetime import timedelta
 import ids.internal_configuration as ids_internal_config
 from ids.configuration.config import IDSConfig
 from ids.oad import OAD
 from ids.methods.anomaly_detection import AnomalyDetector
+from ids.methods.model_store import ModelStore
+from ids.methods.training import Training
 
 class IDS:
     """
@@ -42,6 +44,13 @@ class IDS:
 
         #self.detector = AnomalyDetector(method="if")
         self.detector = None
+        self.model_id = None # Stored model used by the detector
+        self.models = ModelStore(ids_internal_config.model_store,
+                                 ids_internal_config.model_store_budget)
+        # Model trained in background, swapped by the packets thread (see __swap_detector)
+        self.training = None
+        self.swap_lock = threading.Lock()
+        self.next_detector = None
         self.start_summary()
 
     def start_summary(self):
@@ -66,64 +75,162 @@ class IDS:
     def interface(self, msg):
         action = msg["action"]
         if action == "train":
-            logging.info("Training with method: %s.", msg["method"])
-            if self.detector is not None:
-                logging.warning("The detector is already trained. Erasing old model")
-                self.detector = None
-            self.start_summary()
-            start_time = datetime.now()
-            self.detector = AnomalyDetector(method=msg["method"],
-                                            dataset_name=msg["dataset"]) 
-                                            
-            self.detector.train_model(argument=msg["argument"])
-            # Done training, send message to queue
-            end_time = datetime.now()
-            runtime = str(end_time - start_time)
-
-            ret = {
-                "status": "training done",
-                "runtime": runtime
-            }
-            self.driver.send_message(json.dumps(ret), control=True, queue=msg["rqueue"])
-
+            ret = self.train(msg)
+            self.driver.send_message(json.dumps(ret), control=True, queue=msg["rqueue"],
+                                     correlation_id=msg.get("correlation_id"))
+        elif action == "train_status":
+            ret = self.train_status()
+            self.driver.send_message(json.dumps(ret, indent=4), control=True,
+                                     queue=msg["rqueue"],
+                                     correlation_id=msg.get("correlation_id"))
         elif action == "fetch_summary":
             print(self.summary)
             ret = self.fetch_summary()
-            self.driver.send_message(ret, control = True, queue=msg["rqueue"])
+            self.driver.send_message(ret, control = True, queue=msg["rqueue"],
+                                     correlation_id=msg.get("correlation_id"))
             logging.info("Sending summary back to %s.", msg["rqueue"])
         elif action == "clean_summary":
             self.start_summary()
             ret = "ok"
-            self.driver.send_message(ret, control = True, queue=msg["rqueue"])
+            self.driver.send_message(ret, control = True, queue=msg["rqueue"],
+                                     correlation_id=msg.get("correlation_id"))
             logging.info("Cleaning summary")
+        elif action == "load_model":
+            ret = self.load_model(msg["model_id"])
+            self.driver.send_message(json.dumps(ret), control=True, queue=msg["rqueue"],
+                                     correlation_id=msg.get("correlation_id"))
+        elif action == "list_models":
+            ret = self.models.list()
+            self.driver.send_message(json.dumps(ret), control=True, queue=msg["rqueue"],
+                                     correlation_id=msg.get("correlation_id"))
         elif action == "clear_model":
+            # A training finishing later must not set a model again
+            self.cancel_training()
             if self.detector is None:
                 logging.warning("No model set.")
             else:
                 logging.info("Cleaning current model.")
                 self.detector = None
+                self.model_id = None
         else:
             logging.error("Unknown action. [%s]", msg)
 
+    def train(self, msg):
+        """
+        Trains msg["method"] on msg["dataset"] in background (see Training).
+        The current model analyzes the packets until the new one is ready,
+        train_status follows the progress. A stored model with the same
+        dataset file, settings, method and arguments is used instead
+        """
+        logging.info("Training with method: %s.", msg["method"])
+        request = (msg["method"], msg["dataset"], msg.get("argument"))
+        training = self.training
+        if training is not None and training.state == "training":
+            if (training.method, training.dataset, training.argument) == request:
+                return {"status": "training started"}
+            self.cancel_training()
+        self.training = Training(*request, self.models, self.training_done)
+        return {"status": "training started"}
+
+    def cancel_training(self):
+        """The running training, if any, will not replace the model"""
+        training = self.training
+        if training is not None and training.state == "training":
+            logging.warning("Cancelling the training of %s on %s.",
+                            training.method, training.dataset)
+            training.cancel()
+
+    def training_done(self, training):
+        """Called by the Training thread when the artifact is in the store"""
+        if not training.cached:
+            self.models.register(training.model_id, {
+                "method": training.method,
+                "dataset": training.dataset,
+                "argument": training.argument,
+                "training_time": str(timedelta(seconds=training.training_time))
+            })
+        artifact = self.models.load(training.model_id)
+        try:
+            if artifact is None:
+                raise RuntimeError("the trained model is not in the store")
+            detector = AnomalyDetector(method=training.method, dataset_name=training.dataset,
+                                       load_data=False)
+            detector.restore(artifact)
+        except (RuntimeError, ValueError) as e:
+            logging.error("Could not load the trained model %s: %s", training.model_id, e)
+            training.error = str(e)
+            training.finish("failed")
+            return
+        with self.swap_lock:
+            if training.state == "training":
+                self.next_detector = (training, detector)
+
+    def __swap_detector(self):
+        """Uses the model trained in background. Runs between two batches, so
+        a batch is always analyzed by one model"""
+        with self.swap_lock:
+            training, detector = self.next_detector
+            self.next_detector = None
+            if training.state != "training":
+                return
+            training.finish("done")
+        self.start_summary()
+        self.detector = detector
+        self.model_id = training.model_id
+        logging.info("Now using model %s (%s, %s).", training.model_id,
+                     training.method, training.dataset)
+
+    def train_status(self):
+        """State of the last training and the model in use"""
+        status = {"state": "idle"} if self.training is None else self.training.status()
+        status["model_in_use"] = self.model_id
+        return status
+
+    def load_model(self, model_id):
+        """Uses a model of the store (see list_models) without training"""
+        meta = self.models.list().get(model_id)
+        artifact = self.models.load(model_id)
+        if meta is None or artifact is None:
+            logging.error("Model %s is not in the store.", model_id)
+            return {"status": "error", "error": f"Unknown model: {model_id}"}
+        # The running training would replace the model loaded here
+        self.cancel_training()
+        detector = AnomalyDetector(method=meta["method"], dataset_name=meta["dataset"],
+                                   load_data=False)
+        detector.restore(artifact)
+        self.start_summary()
+        self.detector = detector
+        self.model_id = model_id
+        logging.info("Loaded model %s (%s, %s).", model_id, meta["method"], meta["dataset"])
+        return {"status": "model loaded", "model_id": model_id}
+
     def __get_packets(self):
         """Internal thread used to fetch packages from the driver recv queue"""
         while True:
-            # get_packet is a non-blocking call implemented by the OAD
-            packet = self.driver.get_packet()
+            # Waits at most batch_timeout, so control packets are not delayed
+            packets = self.driver.get_packets(ids_internal_config.batch_size,
+                                              ids_internal_config.batch_timeout)
+
+            if self.next_detector is not None:
+                self.__swap_detector()
 
             control_packet = self.driver.get_control_packet()
 
             if control_packet:
                 self.interface(control_packet)
 
-            if packet:
-                self.process(packet)
-            else:
-                time.sleep(ids_internal_config.sleep_time)
+            if packets:
+                self.process_batch(packets)
+
+    def store_batch(self, packets):
+        """Same as store_data, with one write for all the packets"""
+        self.db_file.write("".join(packet + "\n" for packet in packets))
+        self.db_file.flush()
 
     def store_data(self, packet):
         """ Store a data obtained from the OAD for future referecing """
-        self.db_file.write(packet)
+        # Packets arrive without framing, one line per packet
+        self.db_file.write(packet + "\n")
         self.db_file.flush()
         pass
 
@@ -159,6 +266,54 @@ class IDS:
             self.alarm(json.dumps(message))
 
 
+    def process_batch(self, packages):
+        """
+        Process many packages with one call to the detector. Alarms are sent
+        for every intrusion, like process does
+        Args:
+            packages(list): Packages in bytes (or str) format
+        """
+        packages = [p.decode("utf-8") if isinstance(p, bytes) else p for p in packages]
+        self.store_batch(packages)
+
+        predicted = self.analyze_batch(packages)
+        if predicted is None:
+            return
+        for idx in np.flatnonzero(predicted == -1):
+            message = {
+                "action" : "alarm",
+                "package": packages[idx]
+            }
+            self.alarm(json.dumps(message))
+
+    def analyze_batch(self, packages):
+        """
+            Returns the predicted labels of the packages (-1 for an intrusion)
+
+            Args:
+                packages(list): Packages in str format
+        """
+        if self.detector is None:
+            logging.warning("Got data but no model is set!")
+            return None
+
+        try:
+            predicted, actual = self.detector.predict_batch(packages)
+        except ValueError as e:
+            # A malformed packet: only that packet is lost
+            logging.warning("Could not analyze the batch (%s), analyzing one by one", e)
+            results = []
+            for package in packages:
+                try:
+                    results.append(self.detector.predict_instance(package))
+                except ValueError as e:
+                    logging.warning("Could not analyze packet: %s", e)
+            if not results:
+                return None
+            predicted, actual = (np.array(r) for r in zip(*results))
+        self.count_batch(predicted, actual)
+        return predicted
+
     def analyze(self, package):
         """
             Process a package and return True if it's an Intrusion
@@ -182,6 +337,16 @@ class IDS:
         """Handle internal configuration"""
         pass
 
+    def count_batch(self, predicted, actual):
+        """Same as count, for arrays of labels"""
+        intrusion = predicted == -1
+        attack = actual == -1
+        self.summary["n_packets"] += len(predicted)
+        self.summary["t_positives"] += int(np.count_nonzero(intrusion & attack))
+        self.summary["f_positives"] += int(np.count_nonzero(intrusion & ~attack))
+        self.summary["f_negatives"] += int(np.count_nonzero(~intrusion & attack))
+        self.summary["t_negatives"] += int(np.count_nonzero(~intrusion & ~attack))
+
     def count(self, preditect_label, correct_label):
         self.summary["n_packets"] += 1
         if preditect_label == -1:
@@ -6,10 +6,16 @@ This configuration file should not be changeable
 
 db_file = "./ids/incoming_packets.csv"
 sleep_time = 0.01
+batch_size = 256 # Max number of packets analyzed with one call to the model
+batch_timeout = 0.005 # Max time (seconds) a packet waits for its batch to fill
+model_store = "./ids/models" # Folder of the trained models (see methods/model_store.py)
+model_store_budget = 2 * 1024 ** 3 # Max bytes used by the trained models
+train_start_method = "spawn" # The training process must not fork the threads of the IDS
 
 drop_duplicates = True # Whether or not duplicate in the dataset should be removed
 convert_labels = True # Convert all normal trafic to 0 and all atacks to 1
 oversample = False # Whether or not oversample should be used in the dataset
+dataset_cache = True # Keep the preprocessed datasets as .npy files (see methods/dataset_cache.py)
 # List all datasets
 datasets_names = ["kdd99", "cic-ids-2017"]
 
@@ -17,11 +17,19 @@ from imblearn.over_sampling import RandomOverSampler
 import ids.internal_configuration as config
 from ids.methods.read_data import ReadData
 
+def dataset_path(dataset_name):
+    """Path of the dataset file, according to ids.internal_configuration"""
+    filename = config.features[dataset_name]["filename"]
+    #sorry for the next line... did not want to hardcoded the path...
+    folder = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    return os.path.join(folder, "datasets", dataset_name, filename)
+
 class AnomalyDetector:
-    def __init__(self, method="iforest", dataset_name="kdd99"):
+    def __init__(self, method="iforest", dataset_name="kdd99", load_data=True):
         """Initializes the detector
             Args:
             @param method: Chooses the method used for anomaly detection
+            @param load_data: False when the model is restored from an artifact (see restore)
         """
         logging.info("[ANML] Starting module.")
         self.catalog = {
@@ -54,7 +62,8 @@ class AnomalyDetector:
         else:
             raise Warning(f"Dataset {dataset_name} not in the IDS configuration file.")
         logging.info("Using dataset: %s", dataset_name)
-        self.load_dataset()
+        if load_data:
+            self.load_dataset()
 
         self.is_trained = False
         self.model = None
@@ -66,16 +75,14 @@ class AnomalyDetector:
             Args:
                 fpath(str): Path of the dataset.
         """
-        filename = config.features[self.dataset_name]["filename"]
-        #sorry for the next line... did not want to hardcoded the path...
-        folder = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-        fpath = os.path.join(folder, "datasets", self.dataset_name, filename)
+        fpath = dataset_path(self.dataset_name)
         # Reads and preprocess the data according to ids.configuration
         self.data = ReadData(dataset_name=self.dataset_name,
                              fpath=fpath)
 
         # Now, scale the dataset and get three datasets as well as the encoder
-        self.train, self.x_train, self.y_train, self.scaler, self.label_encoders = self.data.scale_dataset()
+        (self.train, self.x_train, self.y_train, self.scaler,
+         self.label_encoders, self.encoder) = self.data.scale_dataset()
 
         
 
@@ -140,6 +147,29 @@ class AnomalyDetector:
 
 
             
+    def artifact(self):
+        """Everything needed to analyze packets with the trained model (see ModelStore)"""
+        if not self.is_trained:
+            raise RuntimeError("Model is not trained yet.")
+        return {
+            "method": self.method,
+            "dataset_name": self.dataset_name,
+            "model": self.model,
+            "scaler": self.scaler,
+            "label_encoders": self.label_encoders,
+            "encoder": self.encoder
+        }
+
+    def restore(self, artifact):
+        """Uses a trained model stored with artifact, the dataset is not needed"""
+        if artifact["method"] != self.method or artifact["dataset_name"] != self.dataset_name:
+            raise ValueError("The artifact was trained with another method or dataset.")
+        self.model = artifact["model"]
+        self.scaler = artifact["scaler"]
+        self.label_encoders = artifact["label_encoders"]
+        self.encoder = artifact["encoder"]
+        self.is_trained = True
+
     def predict_instance(self, raw_line: str):
         """
         Predicts the label of a new instance from a CSV-like string.
@@ -153,38 +183,29 @@ class AnomalyDetector:
         if not self.is_trained:
             raise RuntimeError("Model is not trained yet.")
 
-        # Column names must match dataset structure
-        # Parse string to values
-        values = raw_line.strip().split(',')
-        if len(values) != len(self.dataset_columns):
-            raise ValueError("Input string does not have the correct number of features.")
-
-        # Build Series
-        sample = pd.Series(values, index=self.dataset_columns)
-
-        # Store label and drop it
-        actual_label = sample["label"].strip('.')
-        print(actual_label, config.features[self.dataset_name]["normal_traffic"])
-        if actual_label == config.features[self.dataset_name]["normal_traffic"]:
-        #if actual_label == "normal":
-            actual_label = 1
-        else:
-            actual_label = -1
+        # One pass over the line: lookup tables, float conversion and scaling
+        sample, actual_label = self.encoder.encode(raw_line)
 
-        sample = sample.drop("label")
+        # Predict
+        predicted = self.model.predict(sample.reshape(1, -1))
+        return predicted[0], actual_label
 
-        # Apply LabelEncoders to symbolic columns
-        for col, le in self.label_encoders.items():
-            if col in sample:
-                sample[col] = le.transform([sample[col]])[0]
+    def predict_batch(self, raw_lines):
+        """
+        Predicts the labels of many instances with one call to the model.
 
-        # Convert to numeric and scale
-        sample = sample.astype(float)
-        sample_scaled = self.scaler.transform([sample.values])
+        Args:
+            raw_lines (list): Comma-separated lines like from a CSV row.
 
-        # Predict
-        predicted = self.model.predict(sample_scaled)
-        return predicted[0], actual_label
+        Returns:
+            tuple: (predicted labels, actual labels), numpy arrays of 1 or -1
+        """
+        if not self.is_trained:
+            raise RuntimeError("Model is not trained yet.")
+
+        samples, actual_labels = self.encoder.encode_batch(raw_lines)
+        predicted = self.model.predict(samples)
+        return predicted, actual_labels
 
  
         
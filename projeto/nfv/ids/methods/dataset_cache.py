@@ -0,0 +1,118 @@
+"""
+This file implements the columnar cache of the datasets read by ReadData.
+
+Parsing the CSV and removing the duplicates is done once per dataset file.
+The result is stored next to the file (<file>.npcache) as one .npy array
+per column, loaded later as memory maps:
+    - symbolic columns with text are stored as int32 codes, the symbols
+      (sorted, like LabelEncoder.classes_) are kept in meta.json
+    - continuous columns are stored as float64
+    - other columns (numeric symbolic columns, converted labels) keep
+      their integer type
+
+The cache is rebuilt when the file changes (size, or the sha256 when only
+the modification time changed) or when the preprocessing settings of
+ids.internal_configuration change.
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import numpy as np
+import ids.internal_configuration as internal_configuration
+
+CACHE_VERSION = 1
+META_FILE = "meta.json"
+HASH_CHUNK = 1024 * 1024
+
+def cache_dir(fpath):
+    return f"{fpath}.npcache"
+
+def settings(dataset_name):
+    """Everything besides the file that changes the preprocessed data"""
+    return {
+        "version": CACHE_VERSION,
+        "dataset": dataset_name,
+        "features": internal_configuration.features[dataset_name]["features"],
+        "drop_duplicates": internal_configuration.drop_duplicates,
+        "convert_labels": internal_configuration.convert_labels
+    }
+
+def file_hash(fpath):
+    digest = hashlib.sha256()
+    with open(fpath, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def columnar(df, dataset_name):
+    """Returns ({column: array}, {column: symbols}) of the preprocessed dataframe"""
+    features = internal_configuration.features[dataset_name]["features"]
+    columns = {}
+    categories = {}
+    for col in df.columns:
+        values = df[col].to_numpy()
+        if values.dtype == object:
+            # Same codes LabelEncoder.fit_transform gives
+            symbols, codes = np.unique(values, return_inverse=True)
+            columns[col] = codes.astype(np.int32)
+            categories[col] = symbols.tolist()
+        elif features.get(col) == "continuous":
+            columns[col] = values.astype(np.float64)
+        else:
+            columns[col] = values
+    return columns, categories
+
+def load(fpath, dataset_name):
+    """Returns the columns (memory maps) and the symbols of the cached dataset,
+    or None if there is no cache or it is stale"""
+    folder = cache_dir(fpath)
+    meta_path = os.path.join(folder, META_FILE)
+    if not os.path.isfile(meta_path):
+        return None
+    with open(meta_path) as f:
+        meta = json.load(f)
+    if meta["settings"] != settings(dataset_name):
+        logging.info("[DATA] Preprocessing settings changed, rebuilding the cache.")
+        return None
+    stat = os.stat(fpath)
+    if meta["size"] != stat.st_size or meta["mtime"] != stat.st_mtime:
+        if meta["size"] != stat.st_size or file_hash(fpath) != meta["hash"]:
+            logging.info("[DATA] %s changed, rebuilding the cache.", fpath)
+            return None
+        # Touched but not modified
+        meta["mtime"] = stat.st_mtime
+        with open(meta_path, "w") as f:
+            json.dump(meta, f)
+    columns = {col: np.load(os.path.join(folder, f"{idx}.npy"), mmap_mode="r")
+               for idx, col in enumerate(meta["columns"])}
+    return columns, meta["categories"]
+
+def build(fpath, dataset_name, df):
+    """Writes the preprocessed dataframe of the file to the cache and returns
+    what load returns"""
+    columns, categories = columnar(df, dataset_name)
+    stat = os.stat(fpath)
+    meta = {
+        "settings": settings(dataset_name),
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "hash": file_hash(fpath),
+        "rows": len(df),
+        "columns": list(columns),
+        "categories": categories
+    }
+    folder = cache_dir(fpath)
+    tmp = f"{folder}.tmp-{os.getpid()}"
+    os.makedirs(tmp, exist_ok=True)
+    for idx, array in enumerate(columns.values()):
+        np.save(os.path.join(tmp, f"{idx}.npy"), array)
+    with open(os.path.join(tmp, META_FILE), "w") as f:
+        json.dump(meta, f)
+    # Readers never see a partial cache
+    if os.path.isdir(folder):
+        shutil.rmtree(folder)
+    os.rename(tmp, folder)
+    logging.info("[DATA] Cached %s in %s.", fpath, folder)
+    return load(fpath, dataset_name)
@@ -0,0 +1,78 @@
+"""
+This file implements the FeatureEncoder class, which turns the CSV lines
+received by the IDS into the scaled feature vectors given to the models.
+
+It is compiled from the LabelEncoders and the StandardScaler fitted by
+ReadData.scale_dataset, so no pandas or scikit-learn object is used per
+packet:
+    - symbolic columns are looked up in a dict (symbol -> code). Symbols
+      not seen in the training set get an extra code (unknown bucket)
+      instead of raising an error
+    - the column order is fixed when the encoder is compiled
+    - scaling is fused in one multiply-add: x * scale + offset
+"""
+import numpy as np
+
+class FeatureEncoder:
+    def __init__(self, columns, tables, mean, std, normal_label, label="label"):
+        """
+        Args:
+            columns (list): Names of the CSV columns, in the order of the lines
+            tables (dict): {column: {symbol: code}} of the symbolic columns
+            mean, std (array): Mean and standard deviation of each feature
+            normal_label (str): Label of the normal traffic
+            label (str): Name of the label column, it is not a feature
+        """
+        self.columns = list(columns)
+        self.label_index = self.columns.index(label)
+        self.features = [col for col in self.columns if col != label]
+        self.normal_label = normal_label
+        # (index in the line, lookup table or None) of each feature, in order
+        self.plan = [(self.columns.index(col), tables.get(col)) for col in self.features]
+        self.unknown_symbols = 0 # Symbols not seen in the training set
+        std = np.asarray(std, dtype=np.float64)
+        self.scale = (1.0 / std).astype(np.float32)
+        self.offset = (-np.asarray(mean, dtype=np.float64) / std).astype(np.float32)
+
+    @classmethod
+    def compile(cls, columns, label_encoders, scaler, normal_label, label="label"):
+        """Builds the encoder from the fitted LabelEncoders and StandardScaler"""
+        tables = {col: {symbol: code for code, symbol in enumerate(le.classes_)}
+                  for col, le in label_encoders.items() if col != label}
+        return cls(columns, tables, scaler.mean_, scaler.scale_, normal_label, label)
+
+    def _fill(self, values, out):
+        """Writes the unscaled features of one line (split in values) to out"""
+        if len(values) != len(self.columns):
+            raise ValueError("Input string does not have the correct number of features.")
+        for idx, (src, table) in enumerate(self.plan):
+            value = values[src]
+            if table is None:
+                out[idx] = float(value)
+            else:
+                code = table.get(value)
+                if code is None:
+                    code = len(table)
+                    self.unknown_symbols += 1
+                out[idx] = code
+        return 1 if values[self.label_index].rstrip('.') == self.normal_label else -1
+
+    def encode(self, raw_line):
+        """Returns the scaled float32 feature vector and the actual label
+        (1 normal, -1 attack) of a CSV line"""
+        vector = np.empty(len(self.plan), dtype=np.float32)
+        label = self._fill(raw_line.strip().split(','), vector)
+        vector *= self.scale
+        vector += self.offset
+        return vector, label
+
+    def encode_batch(self, raw_lines):
+        """Same as encode for many lines: a (lines, features) matrix and an
+        array of labels"""
+        matrix = np.empty((len(raw_lines), len(self.plan)), dtype=np.float32)
+        labels = np.empty(len(raw_lines), dtype=np.int8)
+        for row, raw_line in enumerate(raw_lines):
+            labels[row] = self._fill(raw_line.strip().split(','), matrix[row])
+        matrix *= self.scale
+        matrix += self.offset
+        return matrix, labels
@@ -0,0 +1,139 @@
+"""
+This file implements the ModelStore class, a disk cache of trained models.
+
+A model is stored with everything needed to analyze packets (model,
+scaler, label encoders and FeatureEncoder) under a content-addressed id:
+the hash of the dataset file plus the method and its arguments. Training
+again with the same dataset and arguments, or restarting the IDS, loads
+the stored model instead of reading the dataset and fitting everything.
+
+The training process writes the artifact with write, then the IDS adds it
+to the index with register. The artifacts are joblib files without
+compression, so the numpy arrays are memory-mapped when loaded. When the
+files use more than the disk budget the least recently used ones are
+removed.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import joblib
+
+INDEX_FILE = "index.json"
+HASH_CHUNK = 1024 * 1024
+
+class ModelStore:
+    def __init__(self, folder, budget):
+        """
+        Args:
+            folder (str): Folder of the artifacts, created if needed
+            budget (int): Max bytes used by the artifacts
+        """
+        self.folder = folder
+        self.budget = budget
+        self.lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+        self.index = {"models": {}, "datasets": {}}
+        path = os.path.join(folder, INDEX_FILE)
+        if os.path.isfile(path):
+            with open(path) as f:
+                self.index = json.load(f)
+        # Files removed by hand are no longer in the store
+        self.index["models"] = {model_id: meta for model_id, meta in self.index["models"].items()
+                                if os.path.isfile(self._path(model_id))}
+
+    def __contains__(self, model_id):
+        with self.lock:
+            return model_id in self.index["models"]
+
+    def _path(self, model_id):
+        return os.path.join(self.folder, f"{model_id}.joblib")
+
+    def _save_index(self):
+        path = os.path.join(self.folder, INDEX_FILE)
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(self.index, f, indent=4)
+        os.replace(f"{path}.tmp", path)
+
+    def dataset_hash(self, fpath):
+        """sha256 of the dataset file. Kept in the index while the size and
+        the modification time of the file do not change"""
+        stat = os.stat(fpath)
+        known = self.index["datasets"].get(fpath)
+        if known and known["size"] == stat.st_size and known["mtime"] == stat.st_mtime:
+            return known["hash"]
+        digest = hashlib.sha256()
+        with open(fpath, "rb") as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK), b""):
+                digest.update(chunk)
+        with self.lock:
+            self.index["datasets"][fpath] = {"size": stat.st_size, "mtime": stat.st_mtime,
+                                             "hash": digest.hexdigest()}
+            self._save_index()
+        return digest.hexdigest()
+
+    def model_id(self, fpath, method, argument, settings=None):
+        """Id of the model trained with method(argument) on the dataset file
+
+        Args:
+            settings (dict): Preprocessing settings that change the fitted model
+        """
+        key = json.dumps({"dataset": self.dataset_hash(fpath), "method": method,
+                          "argument": argument, "settings": settings}, sort_keys=True)
+        return hashlib.sha256(key.encode()).hexdigest()[:32]
+
+    def write(self, model_id, artifact):
+        """Writes the artifact file only. Used by the training process, the
+        IDS keeps the index and adds the model with register"""
+        path = self._path(model_id)
+        joblib.dump(artifact, f"{path}.tmp-{os.getpid()}")
+        os.replace(f"{path}.tmp-{os.getpid()}", path)
+
+    def register(self, model_id, meta):
+        """Adds the written artifact of model_id to the index"""
+        path = self._path(model_id)
+        with self.lock:
+            self.index["models"][model_id] = dict(meta, size=os.path.getsize(path),
+                                                  created=time.time(), last_used=time.time())
+            self._evict(keep=model_id)
+            self._save_index()
+        logging.info("[STORE] Saved model %s.", model_id)
+
+    def load(self, model_id):
+        """Returns the stored artifact, or None if the model is not in the store"""
+        with self.lock:
+            if model_id not in self.index["models"]:
+                return None
+            self.index["models"][model_id]["last_used"] = time.time()
+            self._save_index()
+        try:
+            return joblib.load(self._path(model_id), mmap_mode="r")
+        except (OSError, EOFError, ValueError) as e:
+            logging.error("[STORE] Could not load model %s: %s", model_id, e)
+            with self.lock:
+                self.index["models"].pop(model_id, None)
+                self._save_index()
+            return None
+
+    def list(self):
+        """{model_id: meta} of the stored models"""
+        with self.lock:
+            return {model_id: dict(meta) for model_id, meta in self.index["models"].items()}
+
+    def _evict(self, keep=None):
+        """Removes the least recently used models until the budget is respected"""
+        models = self.index["models"]
+        used = sum(meta["size"] for meta in models.values())
+        for model_id in sorted(models, key=lambda m: models[m]["last_used"]):
+            if used <= self.budget:
+                break
+            if model_id == keep:
+                continue
+            used -= models.pop(model_id)["size"]
+            try:
+                os.remove(self._path(model_id))
+            except FileNotFoundError:
+                pass
+            logging.info("[STORE] Evicted model %s.", model_id)
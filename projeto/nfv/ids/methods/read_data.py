@@ -3,12 +3,15 @@ This file implements the ReadData class, which is responsible for
 reading datasets_name and preprocessing them for anomaly detection analysis.
 """
 import os
+import logging
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 from sklearn.preprocessing import LabelEncoder, StandardScaler
 from imblearn.over_sampling import RandomOverSampler
 import ids.internal_configuration as internal_configuration
+from ids.methods.feature_encoder import FeatureEncoder
+from ids.methods import dataset_cache
 
 class ReadData:
     def __init__(self, dataset_name, fpath):
@@ -25,49 +28,76 @@ class ReadData:
         if not os.path.isfile(fpath):
             raise RuntimeError(f"{fpath} is not a file. Aborting.")
 
+        self.dataset_name = dataset_name
         self.features_dict = internal_configuration.features[dataset_name]["features"]
         self.features = list(self.features_dict.keys())
         print(self.features)
-        
+        self.df = None
+
+        # The columns are memory-mapped from the cache, the CSV is only parsed once
+        cached = None
+        if internal_configuration.dataset_cache:
+            cached = dataset_cache.load(fpath, dataset_name)
+        if cached is None:
+            self.df = self.read_csv(fpath)
+            if internal_configuration.dataset_cache:
+                try:
+                    cached = dataset_cache.build(fpath, dataset_name, self.df)
+                except OSError as e:
+                    logging.warning("[DATA] Could not cache %s: %s", fpath, e)
+        if cached is None:
+            cached = dataset_cache.columnar(self.df, dataset_name)
+        # column -> array, and the symbols of the encoded symbolic columns
+        self.columns, self.categories = cached
+
+    def read_csv(self, fpath):
         # Read file and store in a dataframe
-        self.df = pd.read_csv(fpath, names=self.features)
+        df = pd.read_csv(fpath, names=self.features)
 
         # Apply the transformations according to IDS Configuration
         if internal_configuration.drop_duplicates:
-            self.df.drop_duplicates(keep='first', inplace=True) 
+            df.drop_duplicates(keep='first', inplace=True) 
         if internal_configuration.convert_labels:
-            normal_label = internal_configuration.features[dataset_name]["normal_traffic"]
-            self.df["label"] = (self.df["label"] != normal_label).astype(int)
+            normal_label = internal_configuration.features[self.dataset_name]["normal_traffic"]
+            df["label"] = (df["label"] != normal_label).astype(int)
+        return df
 
     def shape(self):
-        if self.df is not None:
-            return self.df.shape
+        return (len(self.columns[self.features[0]]), len(self.features))
 
     def get_df(self):
-        if self.df is not None:
-            return self.df
+        """The dataset as a dataframe (built from the columns if it was cached)"""
+        if self.df is None:
+            self.df = pd.DataFrame({
+                col: np.asarray(self.categories[col], dtype=object)[values]
+                if col in self.categories else values
+                for col, values in self.columns.items()})
+        return self.df
         
     from sklearn.preprocessing import LabelEncoder, StandardScaler
 
     def scale_dataset(self):
-        """Prepare the dataset and return encoders and scaler"""
-        df_copy = self.df.copy()
+        """Prepare the dataset and return encoders and scaler
 
-        # Encode symbolic columns
-        symbolic_cols = df_copy.select_dtypes(include=["object"]).columns.tolist()
+        The last value is a FeatureEncoder compiled from the encoders and the
+        scaler, used to encode the packets received by the IDS"""
+        # Symbolic columns are already encoded, the encoders only need the symbols
         label_encoders = {}
-        for col in symbolic_cols:
+        for col, symbols in self.categories.items():
             le = LabelEncoder()
-            df_copy[col] = le.fit_transform(df_copy[col])
+            le.classes_ = np.asarray(symbols, dtype=object)
             label_encoders[col] = le
 
         # Separate features and label
-        X = df_copy.iloc[:, :-1].values
-        y = df_copy.iloc[:, -1].values
+        X = np.column_stack([self.columns[col] for col in self.features[:-1]]).astype(np.float64)
+        y = np.asarray(self.columns[self.features[-1]])
 
         # Scale features
         scaler = StandardScaler()
         X = scaler.fit_transform(X)
+        encoder = FeatureEncoder.compile(
+            self.features, label_encoders, scaler,
+            internal_configuration.features[self.dataset_name]["normal_traffic"])
 
         # Oversample if needed
         if internal_configuration.oversample:
@@ -77,7 +107,7 @@ class ReadData:
         # Combine X and y for output
         data = np.hstack((X, np.reshape(y, (-1, 1))))
 
-        return data, X, y, scaler, label_encoders
+        return data, X, y, scaler, label_encoders, encoder
 
 
     def split_dataset(df, train_frac=0.6, valid_frac=0.2, random_state=None):
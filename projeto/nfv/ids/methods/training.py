@@ -0,0 +1,161 @@
+"""
+This file implements the Training class, which trains a model in another
+process so the IDS keeps analyzing packets with the current model.
+
+A thread of the Training first finds the id of the model, which hashes
+the dataset file (GBs for some datasets). A model already in the
+ModelStore is used as is. Otherwise the process reads the dataset, trains
+the AnomalyDetector and writes the artifact to the ModelStore. Its
+progress is sent through a pipe:
+    ("stage", name)     loading dataset, training, saving
+    ("done", seconds)   the artifact of the model is in the store
+    ("error", text)     the training failed
+When the artifact is ready, on_done is called by the thread that watches
+the pipe. The IDS registers the model and swaps the detector.
+"""
+import logging
+import multiprocessing
+import threading
+import time
+from datetime import timedelta
+import ids.internal_configuration as config
+from ids.methods import dataset_cache
+from ids.methods.anomaly_detection import AnomalyDetector, dataset_path
+from ids.methods.model_store import ModelStore
+
+def model_settings(dataset):
+    """Preprocessing settings of ids.internal_configuration that change the fitted model"""
+    return dict(dataset_cache.settings(dataset), oversample=config.oversample)
+
+def train_process(conn, method, dataset, argument, model_id, store_folder, store_budget):
+    """Target of the training process"""
+    try:
+        start = time.monotonic()
+        conn.send(("stage", "loading dataset"))
+        detector = AnomalyDetector(method=method, dataset_name=dataset)
+        conn.send(("stage", "training"))
+        detector.train_model(argument=argument)
+        conn.send(("stage", "saving"))
+        ModelStore(store_folder, store_budget).write(model_id, detector.artifact())
+        conn.send(("done", time.monotonic() - start))
+    except Exception as e:
+        conn.send(("error", f"{type(e).__name__}: {e}"))
+    finally:
+        conn.close()
+
+class Training:
+    def __init__(self, method, dataset, argument, store, on_done):
+        """Starts the training, without blocking
+
+        Args:
+            store (ModelStore): Store where the artifact is written
+            on_done (function): Called with the Training when the artifact is ready
+        """
+        self.model_id = None # Known once the dataset is hashed
+        self.method = method
+        self.dataset = dataset
+        self.argument = argument
+        self.state = "training" # training, done, failed or cancelled
+        self.stage = "starting"
+        self.cached = False
+        self.error = None
+        self.training_time = None
+        self.started = time.monotonic()
+        self.finished = None
+        self.process = None
+        self.conn = None
+        # The process is never started after a cancel
+        self.lock = threading.Lock()
+
+        self.thread = threading.Thread(target=self._run, args=(store, on_done), daemon=True)
+        self.thread.start()
+
+    def _run(self, store, on_done):
+        """Finds the model id and trains the model if it is not in the store"""
+        self.stage = "hashing dataset"
+        try:
+            self.model_id = store.model_id(dataset_path(self.dataset), self.method,
+                                           self.argument, model_settings(self.dataset))
+        except (OSError, KeyError) as e:
+            logging.error("[TRAIN] Could not read dataset %s: %s", self.dataset, e)
+            self.error = str(e)
+            self.finish("failed")
+            return
+        if self.model_id in store:
+            logging.info("[TRAIN] Using stored model %s.", self.model_id)
+            self.cached = True
+            self.training_time = time.monotonic() - self.started
+            self.stage = "loading model"
+            if self.state == "training":
+                on_done(self)
+            return
+
+        with self.lock:
+            if self.state != "training":
+                return
+            context = multiprocessing.get_context(config.train_start_method)
+            self.conn, child_conn = context.Pipe(duplex=False)
+            self.process = context.Process(target=train_process, daemon=True,
+                                           args=(child_conn, self.method, self.dataset,
+                                                 self.argument, self.model_id,
+                                                 store.folder, store.budget))
+            self.process.start()
+            child_conn.close()
+        logging.info("[TRAIN] Training %s on %s (model %s), pid %s.",
+                     self.method, self.dataset, self.model_id, self.process.pid)
+        self._watch(on_done)
+
+    def _watch(self, on_done):
+        """Follows the progress sent by the training process"""
+        while True:
+            try:
+                kind, value = self.conn.recv()
+            except EOFError:
+                kind, value = "error", "the training process exited without a result"
+            if kind != "stage":
+                break
+            self.stage = value
+            logging.info("[TRAIN] Model %s: %s.", self.model_id, value)
+        self.process.join()
+        self.conn.close()
+        if self.state == "cancelled":
+            return
+        if kind == "error":
+            logging.error("[TRAIN] Training of model %s failed: %s", self.model_id, value)
+            self.error = value
+            self.finish("failed")
+            return
+        self.training_time = value
+        self.stage = "loading model"
+        on_done(self)
+
+    def finish(self, state):
+        self.state = state
+        if state == "done":
+            self.stage = "model in use"
+        self.finished = time.monotonic()
+
+    def cancel(self):
+        """Kills the training process, its model is never used"""
+        with self.lock:
+            self.finish("cancelled")
+            if self.process is not None:
+                self.process.terminate()
+        logging.info("[TRAIN] Cancelled the training of %s on %s.", self.method, self.dataset)
+
+    def status(self):
+        elapsed = (self.finished or time.monotonic()) - self.started
+        status = {
+            "state": self.state,
+            "stage": self.stage,
+            "model_id": self.model_id,
+            "method": self.method,
+            "dataset": self.dataset,
+            "cached": self.cached,
+            "elapsed": round(elapsed, 3)
+        }
+        if self.training_time is not None:
+            status["runtime"] = str(timedelta(seconds=self.training_time))
+        if self.error is not None:
+            status["error"] = self.error
+        return status
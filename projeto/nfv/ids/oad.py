@@ -11,8 +11,11 @@ import json
 import queue
 import socket
 import threading
+import time
 from config import RABBITMQ_SERVER, IDS_EXCHANGE, VNFM_EXCHANGE
 from config import IDS_IP, IDS_PORT
+from framing import RecordBuffer
+from rpc import reply
 
 class OAD:
     """
@@ -70,13 +73,14 @@ class OAD:
                     self.client_socket = None
 
     def _handle_client(self, sock):
+        buffer = RecordBuffer()
         while self.sniffing:
-            data = sock.recv(1024)
-            if not data:
+            if not buffer.recv_into(sock):
                 print("[Sniffer] Client disconnected.")
                 break
             #message = data.decode('utf-8').strip()
-            self.packet_queue.put(data)
+            for record in buffer.records():
+                self.packet_queue.put(bytes(record))
 
 
     def __sniff(self, ch, method, properties, body):
@@ -96,6 +100,22 @@ class OAD:
         except queue.Empty:
             return None
 
+    def get_packets(self, max_packets, timeout):
+        """Used by the IDS to get up to max_packets packets at once. Waits at most
+        timeout seconds for them to arrive and returns the ones received (maybe none)"""
+        packets = []
+        deadline = time.monotonic() + timeout
+        while len(packets) < max_packets:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    packets.append(self.packet_queue.get(timeout=remaining))
+                else:
+                    packets.append(self.packet_queue.get_nowait())
+            except queue.Empty:
+                break
+        return packets
+
     def get_control_packet(self):
         """Used by the IDS to get control packets, if the recv queue is empty, None is returned"""
         try:
@@ -118,8 +138,7 @@ class OAD:
         action = msg["action"]
         if action == "heartbeat":
             logging.info("Received heartbeat. Returning to queue: %s", msg["rqueue"])
-            self.channel.basic_publish(exchange="", routing_key=msg["rqueue"],
-                                       body="ok")
+            reply(self.channel, msg, "ok", properties)
         elif action != "":
             logging.info("Received IDS config change.")
             self.control_queue.put(msg)
@@ -128,7 +147,7 @@ class OAD:
 
         
 
-    def __publish(self, message, control=False, queue=""):
+    def __publish(self, message, control=False, queue="", correlation_id=None):
         """Internal publish message function"""
         exchange = VNFM_EXCHANGE
         routing_key = queue
@@ -136,13 +155,16 @@ class OAD:
             exchange = ""
         
         self.channel.basic_publish(exchange=exchange, routing_key=routing_key,
+                                properties=pk.BasicProperties(correlation_id=correlation_id),
                                 body=message)
 
     
-    def send_message(self, message, control=False, queue=""):
-        """Function to allow the IDS to send a message to the operator"""
+    def send_message(self, message, control=False, queue="", correlation_id=None):
+        """Function to allow the IDS to send a message to the operator
+            @param correlation_id: Correlation id of the request answered (see rpc.py)"""
         self.connection.add_callback_threadsafe(
-            lambda: self.__publish(message, control=control, queue=queue)
+            lambda: self.__publish(message, control=control, queue=queue,
+                                   correlation_id=correlation_id)
         )
 
 
@@ -16,9 +16,10 @@ import json
 import pika as pk
 import logging
 from config import RABBITMQ_SERVER, NFVO_EXCHANGE, VIM_EXCHANGE, VNFM_EXCHANGE
-from config import GATEWAY_EXCHANGE, FORWARDER_EXCHANGE
+from config import GATEWAY_EXCHANGE, FORWARDER_EXCHANGE, VNFM_FUSE
 from mano.vnfm import VNFDescriptor
 from sfc.sfc import SFC
+from rpc import reply
 
 class NFVO():
     def __init__(self):
@@ -45,11 +46,13 @@ class NFVO():
         logging.info("Module started.")
         self.channel.start_consuming()
 
-    def create_sfc(self, sfc_id, types, n):
+    def create_sfc(self, sfc_id, types, n, weight=1.0, fuse=VNFM_FUSE):
         """ Creates a SFC
             @param sfc_id: Unique SFC identifier
             @param types: Specify each VNF type
-            @param n: Number of VNFs"""
+            @param n: Number of VNFs
+            @param weight: Share of the gateway traffic relative to other SFCs
+            @param fuse: Max number of consecutive VNFs running in one process"""
         vnfs = []
 
         # Create the VNF descriptors
@@ -70,7 +73,9 @@ class NFVO():
                 "vnf_id" : vnf.vnf_id,
                 "sfc_id" : sfc_id,
                 "vnf_num" : counter,
-                "sfc_size" : n
+                "sfc_size" : n,
+                "weight" : weight,
+                "fuse" : fuse
             }
             print(message)
             print("Ok, sending message")
@@ -83,11 +88,12 @@ class NFVO():
         """ Clean all the structure of a SFC"""
         for idx, (stored_id, sfc) in enumerate(self.sfc_list):
             if stored_id == sfc_id:
-                # Stop the containers
+                # Stop the containers, the VNFM only stops the group leaders
                 for vnf in sfc.vnfs:
                     msg = json.dumps({
                         "action" : "delete_vnf",
-                        "vnf_id": vnf.vnf_id
+                        "vnf_id": vnf.vnf_id,
+                        "sfc_id": sfc_id
                     })
                     self.channel.basic_publish(
                         exchange=VNFM_EXCHANGE,
@@ -127,14 +133,15 @@ class NFVO():
         elif action == "create_sfc":
             self.create_sfc(sfc_id=msg["sfc_id"],
                                  types=[],
-                                 n=msg["sfc_size"])
+                                 n=msg["sfc_size"],
+                                 weight=msg.get("weight", 1.0),
+                                 fuse=int(msg.get("fuse", VNFM_FUSE)))
         elif action == "delete_sfc":
             self.cleanup_sfc(sfc_id=msg["sfc_id"])
         elif action == "list_sfc":
-            self.list_sfc(msg["return_queue"])
+            reply(self.channel, msg, json.dumps(self.list_sfc(), indent=4), properties)
         elif action == "heartbeat":
-            self.channel.basic_publish(exchange="", routing_key=msg["rqueue"],
-                                       body="ok")
+            reply(self.channel, msg, "ok", properties)
         else:
             logging.info("Unknown message type: %s.", msg["action"])
 
@@ -142,7 +149,7 @@ class NFVO():
         print(sfc_list)
 
 
-    def list_sfc(self, ret_queue):
+    def list_sfc(self):
         """List all sfc"""
         sfcs = {}
         for (sfc_id, sfc) in self.sfc_list:
@@ -155,8 +162,6 @@ class NFVO():
             sfcs[sfc_id] = {"sfc": vnf_dict}
 
         print(json.dumps(sfcs, indent=4))
-        self.channel.basic_publish(exchange="", routing_key=ret_queue,
-                                   body=json.dumps(sfcs, indent=4))
         return sfcs
     
     def generate_id(self, prefix="vnf-", length=6, max_attempts=20):
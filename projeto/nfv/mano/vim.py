@@ -5,14 +5,189 @@ and managing the NFVI compute, storage and network resources
 - In this implementation is used containers
 """
 import docker # type: ignore
+import collections
 import logging
+import socket
+import threading
+import time
 import json
+import uuid
 import pika as pk
+from concurrent.futures import ThreadPoolExecutor
 from config import DOCKERFILE_DIR, IMAGE_NAME, VIM_EXCHANGE, RABBITMQ_SERVER
-from config import DEFAULT_IN_PORT
+from config import DEFAULT_IN_PORT, SHM_DIR, VIM_WORKERS, VIM_WARM_POOL_SIZE
+from config import VNF_EVENTS_EXCHANGE
 from config import net
+from rpc import reply
+
+# Label of the idle containers of the warm pool
+WARM_LABEL = "nfv.warm"
+# Key of the pool tasks that replenish the warm pool, so they never run in parallel
+WARM_POOL_KEY = "warm-pool"
+
+class OrderedPool:
+    """Thread pool that runs the tasks with the same key in submission order
+
+    Tasks with different keys run in parallel. The next task of a key is
+    only submitted when the previous one finishes, so workers never wait
+    for each other."""
+    def __init__(self, workers=VIM_WORKERS):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="vim")
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.waiting = {} # key -> tasks submitted while a task of the key runs
+
+    def submit(self, key, fn, *args):
+        with self.lock:
+            if key in self.waiting:
+                self.waiting[key].append((fn, args))
+                return
+            self.waiting[key] = collections.deque()
+        self._run(key, fn, args)
+
+    def _run(self, key, fn, args):
+        future = self.executor.submit(fn, *args)
+        future.add_done_callback(lambda f: self._done(key, f))
+
+    def _done(self, key, future):
+        if future.exception() is not None:
+            logging.error("Task of %s failed: %s", key, future.exception())
+        with self.lock:
+            if not self.waiting[key]:
+                del self.waiting[key]
+                if not self.waiting:
+                    self.idle.notify_all()
+                return
+            fn, args = self.waiting[key].popleft()
+        self._run(key, fn, args)
+
+    def shutdown(self):
+        """Waits for every task submitted, including the ones still waiting"""
+        with self.lock:
+            while self.waiting:
+                self.idle.wait()
+        self.executor.shutdown(wait=True)
+
+class ContainerRegistry:
+    """Containers of the VNFs indexed by vnf_id and sfc_id
+
+    The attributes (IP, status, limits) are read from docker when the
+    container is added and kept fresh by a thread that follows the docker
+    events stream, so lookups never call the daemon."""
+    def __init__(self, client):
+        self.client = client
+        self.lock = threading.Lock()
+        self.entries = {}  # vnf_id -> entry
+        self.by_sfc = {}   # sfc_id -> set of vnf_id
+        self.by_id = {}    # docker container id -> vnf_id
+        self.events = None
+        self.running = True
+        self.thread = threading.Thread(target=self._follow_events, daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def _attributes(container):
+        host = container.attrs.get("HostConfig", {})
+        return {
+            "ip": container.attrs.get("NetworkSettings", {}).get("IPAddress"),
+            "status": container.status,
+            "limits": {"cpu_count": host.get("CpuCount"), "memory": host.get("Memory")},
+        }
+
+    def add(self, vnf_id, container, sfc_id=None):
+        entry = {"vnf_id": vnf_id, "sfc_id": sfc_id, "container": container}
+        entry.update(self._attributes(container))
+        with self.lock:
+            self.entries[vnf_id] = entry
+            self.by_id[container.id] = vnf_id
+            if sfc_id is not None:
+                self.by_sfc.setdefault(sfc_id, set()).add(vnf_id)
+
+    def remove(self, vnf_id):
+        """Removes the VNF and returns its container (None if unknown)"""
+        with self.lock:
+            entry = self.entries.pop(vnf_id, None)
+            if entry is None:
+                return None
+            self.by_id.pop(entry["container"].id, None)
+            vnfs = self.by_sfc.get(entry["sfc_id"])
+            if vnfs is not None:
+                vnfs.discard(vnf_id)
+                if not vnfs:
+                    del self.by_sfc[entry["sfc_id"]]
+        return entry["container"]
+
+    def get(self, vnf_id):
+        with self.lock:
+            entry = self.entries.get(vnf_id)
+        return None if entry is None else entry["container"]
+
+    def info(self, vnf_id):
+        """Cached attributes of the VNF container (None if unknown)"""
+        with self.lock:
+            entry = self.entries.get(vnf_id)
+            if entry is None:
+                return None
+            return {key: value for key, value in entry.items() if key != "container"}
+
+    def ip(self, vnf_id):
+        info = self.info(vnf_id)
+        return None if info is None else info["ip"]
+
+    def sfc(self, sfc_id):
+        """vnf_ids of the SFC that have a container in this VIM"""
+        with self.lock:
+            return list(self.by_sfc.get(sfc_id, ()))
+
+    def items(self):
+        with self.lock:
+            return [(vnf_id, entry["container"]) for vnf_id, entry in self.entries.items()]
+
+    def _refresh(self, container_id, action):
+        with self.lock:
+            vnf_id = self.by_id.get(container_id)
+            if vnf_id is None:
+                return
+            container = self.entries[vnf_id]["container"]
+        if action == "destroy":
+            attributes = {"ip": None, "status": "removed"}
+        else:
+            try:
+                container.reload()
+            except docker.errors.APIError:
+                return
+            attributes = self._attributes(container)
+        with self.lock:
+            entry = self.entries.get(vnf_id)
+            if entry is not None and entry["container"] is container:
+                entry.update(attributes)
+        logging.debug("Container of %s: %s (%s)", vnf_id, action, attributes["status"])
+
+    def _follow_events(self):
+        """Updates the cached attributes on every event of a known container"""
+        while self.running:
+            try:
+                self.events = self.client.events(
+                    decode=True, filters={"type": ["container", "network"]})
+                for event in self.events:
+                    actor = event.get("Actor", {})
+                    if event.get("Type") == "network":
+                        # connect/disconnect change the IP of the container
+                        container_id = actor.get("Attributes", {}).get("container")
+                    else:
+                        container_id = actor.get("ID")
+                    if container_id:
+                        self._refresh(container_id, event.get("Action", ""))
+            except Exception as e:
+                if self.running:
+                    logging.warning("Docker events stream closed: %s", e)
+                    time.sleep(1)
+
+    def stop(self):
+        self.running = False
+        if self.events is not None:
+            self.events.close()
 
-dock_env = docker.from_env()
 class VIM:
     def __init__(self):
         """Start all services and internal structures"""
@@ -29,10 +204,19 @@ class VIM:
                                    on_message_callback=self.treat_vim,
                                    auto_ack=True)
 
+        self.channel.exchange_declare(exchange=VNF_EVENTS_EXCHANGE, exchange_type='topic')
+
         logging.info("Listening to controls in %s", queue_name)
         self.client = docker.from_env()
         self.image = IMAGE_NAME
-        self.running_containers = []
+        self.registry = ContainerRegistry(self.client)
+        self.warm_lock = threading.Lock()
+        # Docker operations run in the pool, in order for each VNF
+        self.pool = OrderedPool()
+        # Idle containers (already started, IP known) claimed by the start action
+        self.warm = collections.deque()
+        self.remove_warm_leftovers()
+        self.pool.submit(WARM_POOL_KEY, self.fill_warm_pool)
         self.start_service()
 
     def start_service(self):
@@ -41,8 +225,20 @@ class VIM:
             self.channel.start_consuming()
         except KeyboardInterrupt:
             logging.info("Received Interruption, turning off all VNFs...")
+            self.pool.shutdown()
             self.kill_all()
 
+    def publish(self, exchange, routing_key, body):
+        """Publishes from any thread, pika channels are not thread safe"""
+        self.connection.add_callback_threadsafe(
+            lambda: self.channel.basic_publish(exchange=exchange, routing_key=routing_key,
+                                               body=body))
+
+    def send_reply(self, msg, body, properties=None):
+        """Replies to the request msg from any thread"""
+        self.connection.add_callback_threadsafe(
+            lambda: reply(self.channel, msg, body, properties))
+
     def treat_vim(self, ch, method, properties, body):
         """Respond to commands receveid in VIM_EXCHANGE"""
         # Parse msg to json
@@ -56,61 +252,155 @@ class VIM:
         action = msg["action"]
         if action == "start":
             #cmd = f"python instance.py {msg["vnf_id"]} {msg["sfc_id"]} {msg["qin"]} {msg["qout"]}"
-            self.start_container(vnf_id=msg["vnf_id"])
+            self.pool.submit(msg["vnf_id"], self.start_container, msg["vnf_id"],
+                             msg.get("sfc_id"))
         elif action == "run_vnf":
-            cmd = f"python tcp.py {msg["vnf_id"]} {msg["sfc_id"]} {msg["in"]} {DEFAULT_IN_PORT} {msg["out"]} {DEFAULT_IN_PORT}"
-            self.run_command(vnf_id=msg["vnf_id"], cmd=cmd)
+            self.pool.submit(msg["vnf_id"], self.run_vnf, msg)
         elif action == "get_vnf_ip":
-            ip = self.get_container_ip(msg["vnf_id"])
-            message = {
-                "ip": ip
-            }
-            self.channel.basic_publish(exchange="", routing_key=msg["rqueue"],
-                                       body=json.dumps(message))
+            # Ordered after the start of the same VNF, so the container exists
+            self.pool.submit(msg["vnf_id"], self.send_vnf_ip, msg, properties)
         elif action == "stop":
-            self.stop_container(msg["vnf_id"])
+            self.pool.submit(msg["vnf_id"], self.stop_container, msg["vnf_id"])
+        elif action == "stop_sfc":
+            for vnf_id in self.registry.sfc(msg["sfc_id"]):
+                self.pool.submit(vnf_id, self.stop_container, vnf_id)
         elif action == "heartbeat":
-            self.channel.basic_publish(exchange="", routing_key=msg["rqueue"],
-                                       body="ok")
+            reply(self.channel, msg, "ok", properties)
 
-    def start_container(self, vnf_id=""):
-        """ Start the container
-        """
-        logging.info("Starting container with vnf_id: %s.", vnf_id)
+    def run_vnf(self, msg):
+        out_port = msg.get("out_port", DEFAULT_IN_PORT)
+        cmd = f"python tcp.py {msg["vnf_id"]} {msg["sfc_id"]} {msg["in"]} {DEFAULT_IN_PORT} {msg["out"]} {out_port}"
+        if len(msg.get("chain", [])) > 1:
+            # Fused VNFs run as a pipeline in the leader process
+            cmd += f" --chain {','.join(msg['chain'])}"
+        # Shared memory links with co-located VNFs
+        if msg.get("in_shm"):
+            cmd += f" --in-shm {msg['in_shm']}"
+        if msg.get("out_shm"):
+            cmd += f" --out-shm {msg['out_shm']}"
+        self.run_command(vnf_id=msg["vnf_id"], cmd=cmd)
+
+    def send_vnf_ip(self, msg, properties=None):
+        ip = self.get_container_ip(msg["vnf_id"])
+        message = {
+            "ip": ip,
+            # Every container of this VIM runs in this host
+            "host": socket.gethostname()
+        }
+        self.send_reply(msg, json.dumps(message), properties)
+
+    def announce_started(self, vnf_id, sfc_id):
+        """Publishes the vnf-started event, the VNFM does not need to ask for the IP"""
+        message = {
+            "event": "vnf-started",
+            "vnf_id": vnf_id,
+            "sfc_id": sfc_id,
+            "ip": self.get_container_ip(vnf_id),
+            "host": socket.gethostname()
+        }
+        self.publish(VNF_EVENTS_EXCHANGE, f"{sfc_id}.{vnf_id}.vnf-started",
+                     json.dumps(message))
+
+    def create_container(self, name, labels=None):
+        """Runs an idle VNF container. Returns None if docker fails"""
         try:
-            container = self.client.containers.run(
+            return self.client.containers.run(
                 self.image,
-                name=vnf_id,
+                name=name,
                 detach=True,
                 hostname="container_host",
                 cpu_count=4,
                 mem_limit='512m',
                 stdin_open=True,
+                labels=labels or {},
+                # Rings of the shared memory links between VNFs of this host
+                volumes={SHM_DIR: {"bind": SHM_DIR, "mode": "rw"}},
                 )
-
-            self.running_containers.append((vnf_id, container))
-            return container
         except docker.errors.APIError as e:
             logging.error(f"Failed to start container: {e}")
             return None
 
+    def start_container(self, vnf_id="", sfc_id=None):
+        """ Start the container
+
+        A container of the warm pool is used if there is one, otherwise
+        a new container is started (cold start)
+        """
+        container = self.claim_warm_container(vnf_id)
+        if container is None:
+            logging.info("Starting container with vnf_id: %s.", vnf_id)
+            container = self.create_container(vnf_id)
+            if container is None:
+                return None
+            # The attributes returned by run are read before the container starts
+            container.reload()
+        self.registry.add(vnf_id, container, sfc_id)
+        self.announce_started(vnf_id, sfc_id)
+        return container
+
+    def claim_warm_container(self, vnf_id):
+        """Takes a container of the warm pool and renames it to vnf_id
+
+        The pool is replenished in the background. Returns None if the pool is empty"""
+        with self.warm_lock:
+            container = self.warm.popleft() if self.warm else None
+        if VIM_WARM_POOL_SIZE:
+            self.pool.submit(WARM_POOL_KEY, self.fill_warm_pool)
+        if container is None:
+            return None
+        try:
+            container.rename(vnf_id)
+        except docker.errors.APIError as e:
+            logging.warning("Could not claim warm container %s: %s", container.name, e)
+            self.discard_container(container)
+            return None
+        logging.info("VNF %s claimed warm container %s.", vnf_id, container.short_id)
+        return container
+
+    def fill_warm_pool(self):
+        """Starts containers until the warm pool has VIM_WARM_POOL_SIZE of them"""
+        while True:
+            with self.warm_lock:
+                if len(self.warm) >= VIM_WARM_POOL_SIZE:
+                    return
+            container = self.create_container(f"warm-{uuid.uuid4().hex[:12]}",
+                                              labels={WARM_LABEL: "true"})
+            if container is None:
+                return
+            # The IP is only in the attributes after the container is attached
+            container.reload()
+            with self.warm_lock:
+                self.warm.append(container)
+            logging.info("Warm container %s ready.", container.short_id)
+
+    def remove_warm_leftovers(self):
+        """Removes idle containers left by a previous VIM"""
+        for container in self.client.containers.list(all=True,
+                                                     filters={"label": WARM_LABEL}):
+            if container.name.startswith("warm-"):
+                self.discard_container(container)
+
+    def discard_container(self, container):
+        try:
+            container.remove(force=True)
+        except docker.errors.APIError as e:
+            logging.warning("Could not remove container %s: %s", container.name, e)
+
     def get_container_ip(self, vnf_id):
-        return dock_env.containers.get(vnf_id).attrs['NetworkSettings']['IPAddress'] 
+        return self.registry.ip(vnf_id)
 
     def stop_container(self, vnf_id):
-        for idx, (stored_id, container) in enumerate(self.running_containers):
-            if stored_id == vnf_id:
-                try:
-                    #container.stop()  # Docker SDK: stop the container
-                    # killing instead of stopping
-                    container.kill()  # Docker SDK: stop the container
-                    del self.running_containers[idx]
-                    logging.info("Container for VNF %s stopped and removed from the list.", vnf_id)
-                except Exception as e:
-                    logging.error("Error stopping container for VNF %s: %s", vnf_id, e)
-                break
-        else:
+        container = self.registry.remove(vnf_id)
+        if container is None:
             logging.error("No container found for VNF %s", vnf_id)
+            return
+        try:
+            #container.stop()  # Docker SDK: stop the container
+            # killing instead of stopping
+            container.kill()  # Docker SDK: stop the container
+            logging.info("Container for VNF %s stopped and removed from the list.", vnf_id)
+        except Exception as e:
+            logging.error("Error stopping container for VNF %s: %s", vnf_id, e)
 
 
     def run_command(self, vnf_id, cmd):
@@ -126,10 +416,7 @@ class VIM:
         return False
 
     def get_running_container(self, vnf_id):
-        for vid, container in self.running_containers:
-            if vid == vnf_id:
-                return container
-        return None  # or raise an exception
+        return self.registry.get(vnf_id)
 
     def cleanup_container(self, container):
         try:
@@ -139,9 +426,12 @@ class VIM:
             logging.warning(f"Could not remove container: {e}")
     
     def kill_all(self):
-        for (vnf_id, container) in self.running_containers:
+        self.registry.stop()
+        for (vnf_id, container) in self.registry.items():
             logging.info("Stopping VNF: %s", vnf_id)
             container.kill()
+        while self.warm:
+            self.discard_container(self.warm.popleft())
 
 if __name__ == "__main__":
     logging.basicConfig(
@@ -15,19 +15,11 @@ from typing import Optional
 from sfc.sfc import SFC
 from vnf.vnf import VNF
 from config import RABBITMQ_SERVER, VNFM_EXCHANGE, VIM_EXCHANGE, GATEWAY_EXCHANGE
+from config import FORWARDER_EXCHANGE, FORWARDER_IP, FORWARDER_PORT, DEFAULT_IN_PORT
+from config import VNFM_FUSE, VNFM_SHM_LINKS, VNF_CONTROL_EXCHANGE
+from config import VNF_EVENTS_EXCHANGE, VNF_READY_TIMEOUT
 import json
-import time
-
-def wait_for_message(channel, queue, timeout=None):
-    start_time = time.time()
-    while True:
-        method_frame, header_frame, body = channel.basic_get(queue=queue, auto_ack=True)
-        if method_frame:
-            return json.loads(body.decode())
-        if timeout is not None and (time.time() - start_time) >= timeout:
-
-            return None
-        time.sleep(0.1)
+from rpc import RpcClient, reply
 
 @dataclass
 class VNFDescriptor:
@@ -59,12 +51,33 @@ class VNFM():
                                    on_message_callback=self.treat_vnfm,
                                    auto_ack=True)
 
-        ret_queue = self.channel.queue_declare(queue="", exclusive=True)
-        self.ret_queue = ret_queue.method.queue
+        self.channel.exchange_declare(exchange=VNF_CONTROL_EXCHANGE,
+                                      exchange_type='topic')
+
+        # The bring-up of the SFCs follows the lifecycle events of the VNFs
+        self.channel.exchange_declare(exchange=VNF_EVENTS_EXCHANGE,
+                                      exchange_type='topic')
+        events = self.channel.queue_declare(queue="", exclusive=True)
+        events_queue = events.method.queue
+        for event in ("vnf-started", "vnf-ready"):
+            self.channel.queue_bind(queue=events_queue, exchange=VNF_EVENTS_EXCHANGE,
+                                    routing_key=f"*.*.{event}")
+        self.channel.basic_consume(queue=events_queue,
+                                   on_message_callback=self.treat_event,
+                                   auto_ack=True)
+        # Requests to the VIM, many can be outstanding
+        self.rpc = RpcClient()
         logging.info("VNFM listening in queue: %s.", queue_name)
 
         self.__vnf_id = [] # Store all the current instantiated VNFs identifier
         self.sfc_list = {}
+        # sfc_id -> groups of consecutive VNFs, each group runs in one container
+        # (named after its first VNF, the leader)
+        self.sfc_groups = {}
+        self.vnf_addrs = {} # vnf_id -> (ip, host), from the vnf-started events
+        # sfc_id -> SFCs whose VNFs were all created but are not ready yet
+        self.bringup = {}
+        self.ip_requests = {} # vnf_id -> Future of the IP requested to the VIM
         logging.info("Module started.")
         self.channel.start_consuming()
     
@@ -81,30 +94,124 @@ class VNFM():
 
         action = msg["action"]
         if action == "create_vnf":
-            self.create_vnf(vnf_id=msg["vnf_id"], sfc_id=msg["sfc_id"])
+            self.create_vnf(vnf_id=msg["vnf_id"], sfc_id=msg["sfc_id"],
+                            fuse=int(msg.get("fuse", VNFM_FUSE)))
             sfc_size = int(msg["sfc_size"])
             vnf_num = int(msg["vnf_num"])
             print(f"criando {vnf_num} de {sfc_size}")
-            # if all VNFs were created, fetch all mesages
+            # if all VNFs were created, start them as soon as their containers run
             if vnf_num >= sfc_size:
-                sfc_forwarding = self.start_service(sfc_id=msg["sfc_id"]) 
-                msg = {
-                    "action" : "sfc-creation",
-                    "sfc_id" : msg["sfc_id"],
-                    "sfc" : sfc_forwarding
+                self.bringup[msg["sfc_id"]] = {
+                    "weight": msg.get("weight", 1.0),
+                    "started": False,
+                    "ready": set()
                 }
-                self.channel.basic_publish(exchange=GATEWAY_EXCHANGE, routing_key="",
-                                        body=json.dumps(msg))
+                sfc_id = msg["sfc_id"]
+                self.connection.call_later(VNF_READY_TIMEOUT,
+                                           lambda: self.ready_timeout(sfc_id))
+                self.try_start_service(sfc_id)
+                self.request_addresses(sfc_id)
 
+        elif action == "vnf-command":
+            self.send_command(msg["command"], sfc_id=msg.get("sfc_id", "all"),
+                              vnf_id=msg.get("vnf_id", "all"))
         elif action == "delete_vnf":
-            self.delete_vnf(sfc_id=msg["sfc_id"])
+            self.delete_vnf(vnf_id=msg["vnf_id"], sfc_id=msg["sfc_id"])
         elif action == "heartbeat":
-            self.channel.basic_publish(exchange="", routing_key=msg["rqueue"],
-                                       body="ok")
+            reply(self.channel, msg, "ok", properties)
         else:
             logging.info("Unknown message type!")
 
-    def create_vnf(self, vnf_id, sfc_id=""):
+    def treat_event(self, ch, method, properties, body):
+        """Lifecycle events: vnf-started (VIM) and vnf-ready (VNF)"""
+        try:
+            msg = json.loads(body.decode())
+        except ValueError:
+            logging.error("Could not parse event.")
+            return
+
+        sfc_id = msg.get("sfc_id")
+        if msg["event"] == "vnf-started":
+            self.vnf_addrs[msg["vnf_id"]] = (msg["ip"], msg.get("host"))
+            if sfc_id in self.bringup:
+                self.try_start_service(sfc_id)
+        elif msg["event"] == "vnf-ready" and sfc_id in self.bringup:
+            bringup = self.bringup[sfc_id]
+            bringup["ready"].add(msg["vnf_id"])
+            leaders = [group[0] for group in self.sfc_groups[sfc_id]]
+            if all(vnf in bringup["ready"] for vnf in leaders):
+                logging.info("Every VNF of SFC %s is ready.", sfc_id)
+                self.announce_sfc(sfc_id)
+
+    def try_start_service(self, sfc_id):
+        """Starts the SFC once the container of every leader is running"""
+        bringup = self.bringup[sfc_id]
+        leaders = [group[0] for group in self.sfc_groups[sfc_id]]
+        if bringup["started"] or not all(vnf in self.vnf_addrs for vnf in leaders):
+            return
+        bringup["started"] = True
+        bringup["sfc"] = self.start_service(sfc_id=sfc_id)
+
+    def request_addresses(self, sfc_id):
+        """Asks the VIM the IP of the leaders whose vnf-started event was not
+        received (e.g. published before the VNFM started). All the requests are
+        sent at once, each reply is handled by the VNFM thread"""
+        for vnf in [group[0] for group in self.sfc_groups[sfc_id]]:
+            if vnf in self.vnf_addrs or vnf in self.ip_requests:
+                continue
+            future = self.rpc.call_async(VIM_EXCHANGE, {"action": "get_vnf_ip", "vnf_id": vnf})
+            self.ip_requests[vnf] = future
+            future.add_done_callback(
+                lambda f, vnf=vnf: self.connection.add_callback_threadsafe(
+                    lambda: self.address_reply(sfc_id, vnf, f)))
+
+    def address_reply(self, sfc_id, vnf, future):
+        self.ip_requests.pop(vnf, None)
+        if future.cancelled() or not isinstance(future.result(), dict):
+            return
+        addr = future.result()
+        if addr.get("ip") and vnf not in self.vnf_addrs:
+            self.vnf_addrs[vnf] = (addr["ip"], addr.get("host"))
+        if sfc_id in self.bringup:
+            self.try_start_service(sfc_id)
+
+    def announce_sfc(self, sfc_id):
+        """Sends the SFC to the gateway and the forwarder, it can receive traffic"""
+        bringup = self.bringup.pop(sfc_id, None)
+        if bringup is None:
+            return
+        msg = {
+            "action" : "sfc-creation",
+            "sfc_id" : sfc_id,
+            "sfc" : bringup.get("sfc", {}),
+            "weight" : bringup["weight"]
+        }
+        self.channel.basic_publish(exchange=GATEWAY_EXCHANGE, routing_key="",
+                                body=json.dumps(msg))
+        # The forwarder terminates the last VNF of the chain
+        self.channel.basic_publish(exchange=FORWARDER_EXCHANGE, routing_key="",
+                                body=json.dumps(msg))
+
+    def ready_timeout(self, sfc_id):
+        bringup = self.bringup.get(sfc_id)
+        if bringup is None:
+            return
+        if not bringup["started"]:
+            for group in self.sfc_groups[sfc_id]:
+                if group[0] in self.ip_requests:
+                    self.rpc.cancel(self.ip_requests[group[0]])
+            logging.error("Containers of SFC %s did not start in %ss.", sfc_id, VNF_READY_TIMEOUT)
+            del self.bringup[sfc_id]
+            return
+        # The gateway connects to the first VNF when it announces that it is ready
+        logging.warning("SFC %s is not ready after %ss, announcing it anyway.",
+                        sfc_id, VNF_READY_TIMEOUT)
+        self.announce_sfc(sfc_id)
+
+    def create_vnf(self, vnf_id, sfc_id="", fuse=VNFM_FUSE):
+        """
+            @param fuse: Max number of consecutive VNFs running in one container
+        """
         # first, check to see if the id is duplicated
         if vnf_id not in self.__vnf_id:
             message = {
@@ -114,61 +221,106 @@ class VNFM():
             }
             if sfc_id not in self.sfc_list:
                 self.sfc_list[sfc_id] = []
+                self.sfc_groups[sfc_id] = []
+            self.__vnf_id.append(vnf_id)
             self.sfc_list[sfc_id].append(vnf_id)
+            groups = self.sfc_groups[sfc_id]
+            if groups and len(groups[-1]) < max(fuse, 1):
+                # Fused with the previous VNFs, runs in the leader container
+                groups[-1].append(vnf_id)
+                logging.info("VNF %s fused with %s", vnf_id, groups[-1][0])
+                return
+            groups.append([vnf_id])
             self.channel.basic_publish(exchange=VIM_EXCHANGE,
                                        body=json.dumps(message), routing_key="")
             return
 
         logging.error("VNF ID duplicate found. There is an error in NFVO!")
 
-    def delete_vnf(self, vnf_id):
-        """Deletes a vnf"""
-        if vnf_id in self.__vnf_id:
-            msg = json.dumps({
-                "action":"stop",
-                "vnf_id": vnf_id
-            })
-            self.channel.basic_publish(
-                exchange=VIM_EXCHANGE,
-                body=msg,
-                routing_key="")
-            logging.info("Stopping %s", vnf_id)
+    def send_command(self, command, sfc_id="all", vnf_id="all"):
+        """Sends a control command (see vnf/tcp.py) to a VNF, to every VNF of
+        an SFC (vnf_id "all") or to every VNF (sfc_id and vnf_id "all")"""
+        routing_key = f"{sfc_id}.{vnf_id}"
+        self.channel.basic_publish(exchange=VNF_CONTROL_EXCHANGE, routing_key=routing_key,
+                                   body=json.dumps(command))
+        logging.info("Sent command %s to %s", command.get("command"), routing_key)
+
+    def delete_vnf(self, vnf_id, sfc_id):
+        """Deletes a vnf
+        Only the leader of a group has a container, the VIM stops it with the
+        VNFs fused in it. The SFC is forgotten when its last VNF is deleted
+        """
+        if vnf_id not in self.__vnf_id:
             return
+        self.__vnf_id.remove(vnf_id)
+        groups = self.sfc_groups.get(sfc_id, [])
+        for group in groups:
+            if group[0] == vnf_id:
+                if vnf_id in self.ip_requests:
+                    self.rpc.cancel(self.ip_requests[vnf_id])
+                self.vnf_addrs.pop(vnf_id, None)
+                msg = json.dumps({
+                    "action":"stop",
+                    "vnf_id": vnf_id
+                })
+                self.channel.basic_publish(
+                    exchange=VIM_EXCHANGE,
+                    body=msg,
+                    routing_key="")
+                logging.info("Stopping %s", vnf_id)
+                break
+
+        vnfs = self.sfc_list.get(sfc_id, [])
+        if vnf_id in vnfs:
+            vnfs.remove(vnf_id)
+        if not vnfs:
+            self.sfc_list.pop(sfc_id, None)
+            self.sfc_groups.pop(sfc_id, None)
+            self.bringup.pop(sfc_id, None)
+            logging.info("SFC %s deleted.", sfc_id)
 
     def start_service(self, sfc_id):
         """
         Start a SFC with the service sfc_id
+        Only the leader of each group of fused VNFs has a container, so the
+        returned SFC (and the forward graph) contains only the leaders
         """
-        vnf_ips = {}
-        for vnf in self.sfc_list[sfc_id]:
-            msg = {
-                "action": "get_vnf_ip",
-                "vnf_id": vnf,
-                "rqueue": self.ret_queue
-            }
-            self.channel.basic_publish(exchange=VIM_EXCHANGE, routing_key="",
-                                    body=json.dumps(msg))
-            vnf_ip = wait_for_message(self.channel, self.ret_queue)
-            vnf_ips[vnf] = vnf_ip["ip"]
+        groups = {group[0]: group for group in self.sfc_groups[sfc_id]}
+        # Addresses announced by the VIM in the vnf-started events
+        vnf_ips = {vnf: self.vnf_addrs[vnf][0] for vnf in groups}
+        vnf_hosts = {vnf: self.vnf_addrs[vnf][1] for vnf in groups}
 
-        # Build the forward graph
+        # Build the forward graph: (ip, port, transport) of the next hop of each VNF
         forward_graph = {}
-        vnf_ids = self.sfc_list[sfc_id]
+        vnf_ids = list(groups)
         for i, vnf in enumerate(vnf_ids):
             if i < len(vnf_ids) - 1:
                 next_vnf = vnf_ids[i + 1]
-                forward_graph[vnf] = vnf_ips[next_vnf]
+                transport = "tcp"
+                if VNFM_SHM_LINKS and vnf_hosts[vnf] is not None \
+                        and vnf_hosts[vnf] == vnf_hosts[next_vnf]:
+                    transport = "shm"
+                forward_graph[vnf] = (vnf_ips[next_vnf], DEFAULT_IN_PORT, transport)
             else:
-                forward_graph[vnf] = "192.168.18.11"
-                #forward_graph[vnf] = "0.0.0.0"
+                # Last VNF sends to the egress forwarder
+                forward_graph[vnf] = (FORWARDER_IP, FORWARDER_PORT, "tcp")
+
+        for i, vnf in enumerate(vnf_ids):
             # Once this is established, send message to VIM to start the VNF
             message = {
                 "action": "run_vnf",
                 "vnf_id" : vnf,
                 "sfc_id" : sfc_id,
                 "in" : vnf_ips[vnf],
-                "out" : forward_graph[vnf]
+                "out" : forward_graph[vnf][0],
+                "out_port" : forward_graph[vnf][1],
+                "chain" : groups[vnf]
             }
+            # Rings are named after the consumer, the VNF also keeps its TCP address
+            if forward_graph[vnf][2] == "shm":
+                message["out_shm"] = f"{sfc_id}-{vnf_ids[i + 1]}"
+            if i > 0 and forward_graph[vnf_ids[i - 1]][2] == "shm":
+                message["in_shm"] = f"{sfc_id}-{vnf}"
             self.channel.basic_publish(exchange=VIM_EXCHANGE, routing_key="",
                                     body=json.dumps(message))
 
@@ -0,0 +1,118 @@
+"""
+Request/reply over RabbitMQ
+
+RpcClient publishes the requests with reply_to and a correlation id and
+matches every reply to its request, so many requests can be outstanding
+on one connection and a late reply never answers the wrong request.
+Each request returns a Future, resolved by the thread that consumes the
+reply queue.
+
+The servers answer with reply(). Older clients only set "rqueue" in the
+message, so the reply queue and the correlation id are also sent in the
+message ("rqueue" and "correlation_id") for servers that do not see the
+properties (e.g. requests forwarded through a Python queue).
+"""
+import json
+import logging
+import threading
+import uuid
+from concurrent import futures
+import pika as pk
+from config import RABBITMQ_SERVER, RPC_TIMEOUT
+
+def decode(body):
+    """Replies are JSON, except for plain strings such as "ok\""""
+    body = body.decode() if isinstance(body, bytes) else body
+    try:
+        return json.loads(body)
+    except ValueError:
+        return body
+
+def reply(channel, msg, body, properties=None):
+    """Publishes the reply of the request msg (received with properties)
+
+    Must be called by the thread that owns channel."""
+    routing_key = getattr(properties, "reply_to", None) or msg.get("rqueue") \
+        or msg.get("return_queue")
+    if not routing_key:
+        return
+    correlation_id = getattr(properties, "correlation_id", None) or msg.get("correlation_id")
+    channel.basic_publish(exchange="", routing_key=routing_key,
+                          properties=pk.BasicProperties(correlation_id=correlation_id),
+                          body=body)
+
+class RpcClient:
+    def __init__(self, server=RABBITMQ_SERVER):
+        """
+            @param server: RabbitMQ server, the client opens its own connection
+        """
+        self.connection = pk.BlockingConnection(pk.ConnectionParameters(server))
+        self.channel = self.connection.channel()
+        result = self.channel.queue_declare(queue="", exclusive=True)
+        self.queue = result.method.queue
+        self.channel.basic_consume(queue=self.queue,
+                                   on_message_callback=self._on_reply,
+                                   auto_ack=True)
+        self.lock = threading.Lock()
+        self.pending = {} # correlation_id -> Future
+        self.thread = threading.Thread(target=self.channel.start_consuming, daemon=True)
+        self.thread.start()
+
+    def _on_reply(self, ch, method, properties, body):
+        with self.lock:
+            future = self.pending.pop(properties.correlation_id, None)
+        if future is None:
+            # Reply of a request that timed out, or of another client
+            logging.debug("Dropping reply without request: %s", properties.correlation_id)
+            return
+        # cancel may run between the pop and here, set_result would then raise
+        if not future.set_running_or_notify_cancel():
+            return
+        future.set_result(decode(body))
+
+    def _publish(self, exchange, routing_key, body, properties=None):
+        # Channels are not thread safe, the consumer thread publishes
+        self.connection.add_callback_threadsafe(
+            lambda: self.channel.basic_publish(exchange=exchange, routing_key=routing_key,
+                                               properties=properties, body=body))
+
+    def send(self, exchange, msg, routing_key=""):
+        """Publishes msg without waiting for a reply"""
+        self._publish(exchange, routing_key, json.dumps(msg))
+
+    def call_async(self, exchange, msg, routing_key=""):
+        """Publishes the request msg and returns the Future of its reply"""
+        correlation_id = uuid.uuid4().hex
+        future = futures.Future()
+        future.correlation_id = correlation_id
+        with self.lock:
+            self.pending[correlation_id] = future
+        msg = dict(msg, rqueue=self.queue, correlation_id=correlation_id)
+        properties = pk.BasicProperties(reply_to=self.queue, correlation_id=correlation_id)
+        self._publish(exchange, routing_key, json.dumps(msg), properties)
+        return future
+
+    def call(self, exchange, msg, routing_key="", timeout=RPC_TIMEOUT):
+        """Sends the request msg and waits for the reply
+
+        Raises TimeoutError if there is no reply within timeout seconds."""
+        return self.result(self.call_async(exchange, msg, routing_key), timeout)
+
+    def result(self, future, timeout=RPC_TIMEOUT):
+        """Waits for the reply of future. On timeout the request is forgotten"""
+        try:
+            return future.result(timeout=timeout)
+        except futures.TimeoutError:
+            self.cancel(future)
+            raise TimeoutError(f"No reply within {timeout}s") from None
+
+    def cancel(self, future):
+        """A reply that arrives after cancel is dropped"""
+        with self.lock:
+            self.pending.pop(future.correlation_id, None)
+        future.cancel()
+
+    def close(self):
+        self.connection.add_callback_threadsafe(self.channel.stop_consuming)
+        self.thread.join(timeout=5)
+        self.connection.close()
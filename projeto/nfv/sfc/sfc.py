@@ -20,11 +20,11 @@ class SFC():
         self.channel = channel
         if self.channel is not None:
             self.channel.exchange_declare(exchange=VNF_CONTROL_EXCHANGE,
-                                          exchange_type="fanout")
+                                          exchange_type="topic")
     
     def clean_sfc(self):
         self.channel.basic_publish(exchange=VNF_CONTROL_EXCHANGE,
-                                   routing_key="",
+                                   routing_key=f"{self.sfc_id}.all",
                                    body=f"delete_sfc,{self.sfc_id}")
     def get_instances(self):
         return self.vnfs
@@ -0,0 +1,164 @@
+"""
+Shared memory transport between VNFs running on the same host
+
+ShmRing is a single-producer/single-consumer ring buffer of bytes stored
+in a file of a tmpfs directory (SHM_DIR) and mapped with mmap by both
+processes. The producer writes framed records (see framing.py) and the
+consumer reads them into a RecordBuffer, just like a TCP stream, but the
+records are copied once in user space instead of twice through the kernel.
+
+Layout of the file:
+    offset 0: magic and capacity
+    offset 64: head, total bytes written (only the producer changes it)
+    offset 128: tail, total bytes read (only the consumer changes it)
+    offset 256: data, capacity bytes (power of two)
+
+head and tail never wrap (64 bits), the position in the data area is the
+counter modulo the capacity. Each counter has its own cache line and is
+written with a single aligned 8 bytes store after the data it publishes.
+"""
+import mmap
+import os
+import struct
+import time
+from config import SHM_DIR, SHM_RING_SIZE
+
+MAGIC = 0x4E465652  # "NFVR"
+HEADER = struct.Struct("QQ")
+COUNTER = struct.Struct("Q")
+HEAD_OFFSET = 64
+TAIL_OFFSET = 128
+DATA_OFFSET = 256
+
+def ring_path(name):
+    return os.path.join(SHM_DIR, name)
+
+class ShmRing:
+    def __init__(self, path, mm, ino):
+        self.path = path
+        self._ino = ino
+        self._mm = mm
+        self._view = memoryview(mm)
+        magic, self.capacity = HEADER.unpack_from(mm, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a ring buffer")
+        self._mask = self.capacity - 1
+        self._data = self._view[DATA_OFFSET:DATA_OFFSET + self.capacity]
+        # struct.pack_into clears the field before writing it, a concurrent reader
+        # could see 0. Items of a memoryview are read and written with one access
+        self._counters = self._view[:DATA_OFFSET].cast("Q")
+
+    @classmethod
+    def create(cls, name, capacity=SHM_RING_SIZE):
+        """Creates the ring (consumer side). An old ring with the same name is replaced"""
+        if capacity & (capacity - 1):
+            raise ValueError("Ring capacity must be a power of two")
+        os.makedirs(SHM_DIR, exist_ok=True)
+        path = ring_path(name)
+        tmp = f"{path}.{os.getpid()}"
+        with open(tmp, "w+b") as f:
+            f.truncate(DATA_OFFSET + capacity)
+            mm = mmap.mmap(f.fileno(), DATA_OFFSET + capacity)
+            ino = os.fstat(f.fileno()).st_ino
+        HEADER.pack_into(mm, 0, MAGIC, capacity)
+        # The producer only finds the ring once it is initialized
+        os.replace(tmp, path)
+        return cls(path, mm, ino)
+
+    @classmethod
+    def attach(cls, name, timeout=0.0):
+        """Maps an existing ring (producer side). Raises FileNotFoundError after timeout"""
+        path = ring_path(name)
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                with open(path, "r+b") as f:
+                    mm = mmap.mmap(f.fileno(), 0)
+                    ino = os.fstat(f.fileno()).st_ino
+                break
+            except FileNotFoundError:
+                if time.monotonic() >= deadline:
+                    raise
+                time.sleep(0.1)
+        return cls(path, mm, ino)
+
+    def _get(self, offset):
+        return self._counters[offset // COUNTER.size]
+
+    def _set(self, offset, value):
+        self._counters[offset // COUNTER.size] = value
+
+    def free(self):
+        return self.capacity - (self._get(HEAD_OFFSET) - self._get(TAIL_OFFSET))
+
+    def write(self, data, timeout=None):
+        """Writes data, waiting while the ring is full (backpressure)
+
+        Returns the number of bytes written, less than len(data) if the
+        consumer did not free space before timeout."""
+        data = memoryview(data).cast("B")
+        total = len(data)
+        head = self._get(HEAD_OFFSET)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        delay = 0.00005
+        while data:
+            free = self.capacity - (head - self._get(TAIL_OFFSET))
+            if not free:
+                if deadline is not None and time.monotonic() >= deadline:
+                    return total - len(data)
+                time.sleep(delay)
+                delay = min(delay * 2, 0.001)
+                continue
+            delay = 0.00005
+            n = min(free, len(data))
+            start = head & self._mask
+            first = min(n, self.capacity - start)
+            self._data[start:start + first] = data[:first]
+            self._data[:n - first] = data[first:n]
+            head += n
+            data = data[n:]
+            self._set(HEAD_OFFSET, head)
+        return total
+
+    def read_into(self, buffer, timeout=0.0):
+        """Appends the bytes available to buffer (a RecordBuffer) and frees their space
+
+        Waits up to timeout (seconds) for data, polling with backoff.
+        Returns the number of bytes read."""
+        deadline = time.monotonic() + timeout
+        delay = 0.00005
+        tail = self._get(TAIL_OFFSET)
+        while True:
+            n = self._get(HEAD_OFFSET) - tail
+            if n or time.monotonic() >= deadline:
+                break
+            time.sleep(delay)
+            delay = min(delay * 2, 0.001)
+        if not n:
+            return 0
+        start = tail & self._mask
+        first = min(n, self.capacity - start)
+        buffer.feed(self._data[start:start + first])
+        if first < n:
+            buffer.feed(self._data[:n - first])
+        self._set(TAIL_OFFSET, tail + n)
+        return n
+
+    def stale(self):
+        """True if the consumer replaced the ring (e.g. it restarted)"""
+        try:
+            return os.stat(self.path).st_ino != self._ino
+        except FileNotFoundError:
+            return True
+
+    def close(self, unlink=False):
+        """Unmaps the ring. The consumer may unlink it"""
+        self._data.release()
+        self._counters.release()
+        self._view.release()
+        self._mm.close()
+        if unlink:
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,101 @@
+"""
+Compares FeatureEncoder with the per-packet path it replaced: a pandas
+Series encoded by the LabelEncoders and scaled by StandardScaler.transform.
+
+Run from projeto/nfv with: python -m pytest tests
+"""
+import io
+import pytest
+
+np = pytest.importorskip("numpy")
+pd = pytest.importorskip("pandas")
+preprocessing = pytest.importorskip("sklearn.preprocessing")
+
+import ids.internal_configuration as config
+from ids.methods.feature_encoder import FeatureEncoder
+
+COLUMNS = list(config.features["kdd99"]["features"].keys())
+NORMAL = config.features["kdd99"]["normal_traffic"]
+
+TRAIN = """\
+0,tcp,http,SF,181,5450,0,0,0,0,0,1,0,0,0,0,0,0,0,0,0,0,8,8,0.00,0.00,0.00,0.00,1.00,0.00,0.00,9,9,1.00,0.00,0.11,0.00,0.00,0.00,0.00,0.00,normal.
+0,tcp,http,SF,239,486,0,0,0,0,0,1,0,0,0,0,0,0,0,0,0,0,8,8,0.00,0.00,0.00,0.00,1.00,0.00,0.00,19,19,1.00,0.00,0.05,0.00,0.00,0.00,0.00,0.00,normal.
+0,udp,private,SF,105,146,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,1,1,0.00,0.00,0.00,0.00,1.00,0.00,0.00,255,254,1.00,0.01,0.00,0.00,0.00,0.00,0.00,0.00,snmpgetattack.
+0,icmp,ecr_i,SF,1032,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,511,511,0.00,0.00,0.00,0.00,1.00,0.00,0.00,255,255,1.00,0.00,1.00,0.00,0.00,0.00,0.00,0.00,smurf.
+0,tcp,private,S0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,123,6,1.00,1.00,0.00,0.00,0.05,0.07,0.00,255,26,0.10,0.05,0.00,0.00,1.00,1.00,0.00,0.00,neptune.
+2,tcp,ftp_data,SF,334,0,0,0,0,0,0,1,0,0,0,0,0,0,0,0,0,0,2,2,0.00,0.00,0.00,0.00,1.00,0.00,0.00,2,20,1.00,0.00,1.00,0.20,0.00,0.00,0.00,0.00,normal.
+"""
+
+@pytest.fixture(scope="module")
+def fitted():
+    """LabelEncoders and StandardScaler fitted the way ReadData did before the
+    dataset cache, and the FeatureEncoder compiled from them"""
+    df = pd.read_csv(io.StringIO(TRAIN), names=COLUMNS)
+    label_encoders = {}
+    for col in COLUMNS[:-1]:
+        if not pd.api.types.is_numeric_dtype(df[col]):
+            le = preprocessing.LabelEncoder()
+            df[col] = le.fit_transform(df[col])
+            label_encoders[col] = le
+    scaler = preprocessing.StandardScaler()
+    scaler.fit(df[COLUMNS[:-1]].values.astype(np.float64))
+    encoder = FeatureEncoder.compile(COLUMNS, label_encoders, scaler, NORMAL)
+    return label_encoders, scaler, encoder
+
+def reference(raw_line, label_encoders, scaler):
+    """The removed AnomalyDetector.predict_instance preprocessing"""
+    values = raw_line.strip().split(',')
+    if len(values) != len(COLUMNS):
+        raise ValueError("Input string does not have the correct number of features.")
+    # object dtype: pandas >= 3 infers str and rejects the encoded ints
+    sample = pd.Series(values, index=COLUMNS, dtype=object)
+    actual_label = 1 if sample["label"].strip('.') == NORMAL else -1
+    sample = sample.drop("label")
+    for col, le in label_encoders.items():
+        sample[col] = le.transform([sample[col]])[0]
+    return scaler.transform([sample.astype(float).values])[0], actual_label
+
+def test_encode_batch_matches_reference(fitted):
+    label_encoders, scaler, encoder = fitted
+    lines = TRAIN.splitlines()
+    matrix, labels = encoder.encode_batch(lines)
+    assert matrix.dtype == np.float32
+    assert matrix.shape == (len(lines), len(COLUMNS) - 1)
+    for row, line in enumerate(lines):
+        expected, label = reference(line, label_encoders, scaler)
+        np.testing.assert_allclose(matrix[row], expected, rtol=1e-5, atol=1e-5)
+        assert labels[row] == label
+        vector, single_label = encoder.encode(line)
+        np.testing.assert_array_equal(vector, matrix[row])
+        assert single_label == label
+    assert encoder.unknown_symbols == 0
+
+def test_unknown_symbol_uses_extra_code(fitted):
+    label_encoders, scaler, encoder = fitted
+    known = TRAIN.splitlines()[0]
+    unknown = known.replace(",http,", ",gopher,")
+    # The old path failed on symbols not seen in the training set
+    with pytest.raises(ValueError):
+        reference(unknown, label_encoders, scaler)
+
+    before = encoder.unknown_symbols
+    matrix, labels = encoder.encode_batch([known, unknown])
+    assert encoder.unknown_symbols == before + 1
+    service = COLUMNS.index("service")
+    classes = len(label_encoders["service"].classes_)
+    expected = (classes - scaler.mean_[service]) / scaler.scale_[service]
+    assert matrix[1, service] == pytest.approx(expected, rel=1e-5)
+    # Every other feature is encoded as usual
+    others = [idx for idx in range(matrix.shape[1]) if idx != service]
+    np.testing.assert_allclose(matrix[1, others], matrix[0, others], rtol=1e-5, atol=1e-5)
+    assert labels[1] == 1
+
+def test_malformed_line_raises(fitted):
+    label_encoders, scaler, encoder = fitted
+    malformed = "0,tcp,http,SF,181"
+    with pytest.raises(ValueError):
+        reference(malformed, label_encoders, scaler)
+    with pytest.raises(ValueError):
+        encoder.encode_batch([TRAIN.splitlines()[0], malformed])
+    with pytest.raises(ValueError):
+        encoder.encode(malformed)
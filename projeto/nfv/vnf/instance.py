@@ -1,7 +1,7 @@
 """
 Code running inside a container
 
-python3 instance.py [VNF_ID] [SFC_ID] [QUEUE_IN] [QUEUE_OUT]
+python3 instance.py [VNF_ID] [SFC_ID] [QUEUE_IN] [QUEUE_OUT] [BATCH_SIZE] [PREFETCH] [COALESCE]
 """
 import sys
 import signal
@@ -18,23 +18,37 @@ vnf_id = ""
 sfc_id = ""
 q_in = ""
 q_out = ""
+batch_size = 0
+prefetch = 0
+coalesce = 1
 
 try:
     vnf_id = sys.argv[1]
     sfc_id = sys.argv[2]
     q_in = sys.argv[3]
     q_out = sys.argv[4]
+    if len(sys.argv) > 5:
+        batch_size = int(sys.argv[5])
+    if len(sys.argv) > 6:
+        prefetch = int(sys.argv[6])
+    if len(sys.argv) > 7:
+        coalesce = int(sys.argv[7])
 except:
     print("Incorrect usage!")
-    print("python ./instance.py VNF_ID SFC_ID QUEUE_IN QUEUE_OUT")
+    print("python ./instance.py VNF_ID SFC_ID QUEUE_IN QUEUE_OUT [BATCH_SIZE] [PREFETCH] [COALESCE]")
 
 logging.info("QUEUES: %s %s", q_in, q_out)
 
 def nf(input):
     return input
 
+def batch_nf(inputs):
+    return inputs
 
-vnf = VNF(vnf_id, sfc_id, q_in, q_out, nf, create_queue=False)
+
+vnf = VNF(vnf_id, sfc_id, q_in, q_out, batch_nf if batch_size else nf,
+          create_queue=False, batch_size=batch_size, prefetch=prefetch, coalesce=coalesce,
+          registry={"identity": (nf, batch_nf)}, nf_name="identity")
 def handle_sigterm():
     logging.info("Received SIGTERM")
     vnf.stop_service()
@@ -1,18 +1,124 @@
+import argparse
+import collections
+import errno
+import json
 import logging
+import multiprocessing
+import os
+import selectors
 import socket
 import threading
 import time
-import sys
+from concurrent import futures
 import pika as pk
-from config import RABBITMQ_SERVER, VNF_CONTROL_EXCHANGE
+from config import RABBITMQ_SERVER, VNF_CONTROL_EXCHANGE, VNF_MODE, VNF_OUT_BUFFER
+from config import VNF_EVENTS_EXCHANGE, FRAMING_MODE
+from config import VNF_BATCH_SIZE, VNF_BATCH_TIMEOUT, VNF_WORKERS, SHM_ATTACH_TIMEOUT
+from framing import RecordBuffer, frame, sendmsg_all, count_records, DELIMITER
+from shmring import ShmRing
+import rpc
 logging.basicConfig(
     level=logging.INFO,
     format="%(asctime)s | %(levelname)s | VNFM | %(message)s",
     datefmt="%Y-%m-%d %H:%M:%S"
 )
+# Max bytes moved by one splice call
+SPLICE_CHUNK = 1024 * 1024
+# Max seconds a control command waits for the data plane (drain, workers)
+COMMAND_TIMEOUT = 30
+# Max seconds a write to a full ring waits before checking the next VNF is still there
+RING_WRITE_TIMEOUT = 0.5
+
+def parse_command(method, body):
+    """Returns the control message as a dict, with the VNF it targets in "target"
+    (None when the routing key is <sfc_id>.all or all.all)"""
+    try:
+        msg = json.loads(body.decode())
+    except ValueError:
+        logging.error("Could not parse control message: %s", body)
+        return None
+    if not isinstance(msg, dict) or "command" not in msg:
+        logging.error("Invalid control message: %s", msg)
+        return None
+    if method is not None and method.routing_key:
+        target = method.routing_key.split(".", 1)[-1]
+        msg["target"] = None if target == "all" else target
+    return msg
+
+def listen_socket(host, port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(5)
+    return sock
+
+def peer_closed(sock):
+    """True if the peer closed sock. The next hops never send data, so
+    anything readable is the end of the connection"""
+    try:
+        return not sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT)
+    except BlockingIOError:
+        return False
+    except OSError:
+        return True
+
+def passthrough(network_function):
+    """Marks a NF that returns its input unchanged. The VNF may relay the
+    traffic without calling it (and without copying it to user space)"""
+    network_function.passthrough = True
+    return network_function
+
+def control_connect(vnf_id, sfc_id, members, callback):
+    """Connects to the VNF control exchange, callback receives the control messages
+        @param members: Ids of the VNFs running in this process (fused chain)"""
+    conn = pk.BlockingConnection(pk.ConnectionParameters(RABBITMQ_SERVER))
+    channel = conn.channel()
+    channel.exchange_declare(exchange=VNF_CONTROL_EXCHANGE, exchange_type='topic')
+    channel.exchange_declare(exchange=VNF_EVENTS_EXCHANGE, exchange_type='topic')
+    result = channel.queue_declare(queue=f"control-{vnf_id}", exclusive=True)
+    queue_name = result.method.queue
+    for routing_key in [f"{sfc_id}.{member}" for member in members] + [f"{sfc_id}.all", "all.all"]:
+        channel.queue_bind(exchange=VNF_CONTROL_EXCHANGE, queue=queue_name,
+                           routing_key=routing_key)
+    channel.basic_consume(queue=queue_name,
+                          on_message_callback=callback,
+                          auto_ack=True)
+    return conn, channel
+
+def publish_ready(conn, channel, vnf_id, sfc_id, members):
+    """Publishes the vnf-ready event from any thread (conn is consumed by another one)"""
+    message = json.dumps({"event": "vnf-ready", "vnf_id": vnf_id, "sfc_id": sfc_id,
+                          "members": members})
+    conn.add_callback_threadsafe(
+        lambda: channel.basic_publish(exchange=VNF_EVENTS_EXCHANGE,
+                                      routing_key=f"{sfc_id}.{vnf_id}.vnf-ready",
+                                      body=message))
+    logging.info("VNF %s is ready", vnf_id)
 
 class VNF:
-    def __init__(self, vnf_id, sfc_id, listen_host, listen_port, send_host, send_port, network_function):
+    def __init__(self, vnf_id, sfc_id, listen_host, listen_port, send_host, send_port, network_function,
+                 batch_size=VNF_BATCH_SIZE, batch_timeout=VNF_BATCH_TIMEOUT,
+                 control=True, inbound=None, in_shm=None, out_shm=None, passthrough=None,
+                 registry=None, nf_name=None):
+        """
+            @param network_function: Called with one record (bytes) and returns the output,
+                                     if batch_size > 0 it is called with a list of records
+                                     and returns a list of outputs
+            @param batch_size: Max number of records per NF call (0 disables batching)
+            @param batch_timeout: Max time (seconds) a record waits for the batch to fill
+            @param control: Whether to consume the control exchange (workers do not)
+            @param inbound: Connected sockets read like accepted connections. The VNF
+                            does not listen when they are given (workers)
+            @param in_shm: Name of the shared memory ring written by the previous VNF.
+                           The TCP listener is kept for other senders
+            @param out_shm: Name of the ring of the next VNF, TCP is used if it
+                            does not appear within SHM_ATTACH_TIMEOUT
+            @param passthrough: Relay the traffic without calling the NF. None: only
+                                if the NF is marked with @passthrough
+            @param registry: {name: (network_function, batch_network_function)}, NFs that
+                             the set_nf control command can load
+            @param nf_name: Name of network_function in the registry
+        """
         self.vnf_id = vnf_id
         self.sfc_id = sfc_id
         self.listen_host = listen_host
@@ -20,40 +126,68 @@ class VNF:
         self.send_host = send_host
         self.send_port = send_port
         self.network_function = network_function
+        self.batch_size = batch_size
+        # The data path reads both at once, they change together
+        self.nf_mode = (network_function, batch_size)
+        self.batch_timeout = batch_timeout
+        self.registry = registry or {}
+        self.nf_name = nf_name
         self.send_socket = None
         self.send_lock = threading.Lock()
+        self.in_shm = in_shm
+        self.out_shm = out_shm
+        self.out_ring = None
+        self.passthrough_mode = passthrough
+        if passthrough is None:
+            passthrough = getattr(network_function, "passthrough", False)
+        self.passthrough = passthrough
+        self.resumed = threading.Event()
+        self.resumed.set()
+        # Records read and not sent yet, drain waits for them
+        self.flight = threading.Condition()
+        self.in_flight = 0
+        self.draining = False
+        self.counters = {
+            "records_in": 0,    # Records given to the NF
+            "records_out": 0,   # Records returned by the NF
+            "dropped": 0,       # Records not sent because the next hop is down
+            "relayed_bytes": 0, # Bytes relayed without calling the NF (passthrough)
+        }
 
         if not callable(network_function):
             logging.error("Invalid argument for network_function: Not callable.")
             raise TypeError("Invalid argument")
 
         # Setup RabbitMQ
-        self.control_conn = pk.BlockingConnection(pk.ConnectionParameters(RABBITMQ_SERVER))
-        self.control_channel = self.control_conn.channel()
-        self.control_channel.exchange_declare(exchange=VNF_CONTROL_EXCHANGE, exchange_type='fanout')
-        result = self.control_channel.queue_declare(queue=f"control-{vnf_id}", exclusive=True)
-        queue_name = result.method.queue
-        self.control_channel.queue_bind(exchange=VNF_CONTROL_EXCHANGE, queue=queue_name)
-        self.control_channel.basic_consume(queue=queue_name,
-                                           on_message_callback=self.treat_control_messages,
-                                           auto_ack=True)
+        self.control_conn = None
+        self.control_channel = None
+        if control:
+            self.control_conn, self.control_channel = control_connect(
+                vnf_id, sfc_id, self.members(), self.treat_control_messages)
 
         # Setup TCP listener
-        self.listener_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.listener_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.listener_socket.bind((self.listen_host, self.listen_port))
-        self.listener_socket.listen(5)
+        self.inbound_sockets = list(inbound or ())
+        self.listener_socket = None
+        if inbound is None:
+            self.listener_socket = listen_socket(self.listen_host, self.listen_port)
 
         self.running = True
 
-        logging.info("Started VNF id:%s listening on %s:%s sending to %s:%s",
-                     vnf_id, listen_host, listen_port, send_host, send_port)
+        logging.info("Started VNF id:%s listening on %s:%s sending to %s:%s%s",
+                     vnf_id, listen_host, listen_port, send_host, send_port,
+                     " (passthrough)" if passthrough else "")
 
         self.start_service()
 
     def start_service(self):
-        threading.Thread(target=self.control_channel.start_consuming, daemon=True).start()
-        threading.Thread(target=self.tcp_accept_loop, daemon=True).start()
+        if self.control_channel is not None:
+            threading.Thread(target=self.control_channel.start_consuming, daemon=True).start()
+        if self.listener_socket is not None:
+            threading.Thread(target=self.tcp_accept_loop, daemon=True).start()
+        for sock in self.inbound_sockets:
+            threading.Thread(target=self.handle_tcp_client, args=(sock,), daemon=True).start()
+        if self.in_shm:
+            threading.Thread(target=self.shm_reader_loop, daemon=True).start()
         threading.Thread(target=self.maintain_send_socket, daemon=True).start()
 
     def tcp_accept_loop(self):
@@ -67,39 +201,359 @@ class VNF:
                 logging.error("TCP accept error: %s", e)
 
     def handle_tcp_client(self, client_sock):
+        if self.passthrough:
+            if self.out_shm:
+                self.forward_tcp_client(client_sock)
+            else:
+                self.relay_tcp_client(client_sock)
+            return
+        buffer = RecordBuffer()
+        batch = []
+        batch_nf = None # NF of the pending batch, the NF may be replaced meanwhile
+        deadline = None
+        with client_sock:
+            while self.running:
+                try:
+                    if batch:
+                        # Wakes up in time to call the NF with an incomplete batch
+                        client_sock.settimeout(max(deadline - time.monotonic(), 0.0001))
+                    else:
+                        client_sock.settimeout(None)
+                    try:
+                        if not buffer.recv_into(client_sock):
+                            break
+                    except socket.timeout:
+                        pass
+                    records = [bytes(record) for record in buffer.records()]
+                    self.hold(len(records))
+                    if not self.resumed.is_set():
+                        # Paused: the pending batch leaves, the records just read wait
+                        # for the resume, or for a drain that sends them
+                        if batch:
+                            self.treat_batch(batch, batch_nf)
+                            self.release(len(batch))
+                            batch = []
+                        self.wait_resumed()
+                    network_function, batch_size = self.nf_mode
+                    if batch and (not batch_size or network_function is not batch_nf):
+                        self.treat_batch(batch, batch_nf)
+                        self.release(len(batch))
+                        batch = []
+                    if not batch_size:
+                        # The NF receives one complete record at a time
+                        for record in records:
+                            self.treat_messages(record, network_function)
+                        self.release(len(records))
+                        continue
+                    for record in records:
+                        if not batch:
+                            deadline = time.monotonic() + self.batch_timeout
+                            batch_nf = network_function
+                        batch.append(record)
+                        if len(batch) >= batch_size:
+                            self.treat_batch(batch, batch_nf)
+                            self.release(len(batch))
+                            batch = []
+                    if batch and time.monotonic() >= deadline:
+                        self.treat_batch(batch, batch_nf)
+                        self.release(len(batch))
+                        batch = []
+                except Exception as e:
+                    logging.error("Error in TCP client handler: %s", e)
+                    break
+        if batch:
+            self.treat_batch(batch, batch_nf)
+            self.release(len(batch))
+
+    def relay_tcp_client(self, client_sock):
+        """Relays a connection to its own connection to the next hop
+
+        The bytes are moved between the sockets by the kernel (splice through
+        a pipe) and never reach Python. As the upstream connection is not
+        shared, the record boundaries do not matter. When the next hop goes
+        away the relay connects again and skips the partial record."""
+        relayed = 0
+        unsent = None # Bytes read from the client when the last next hop failed
+        with client_sock:
+            while self.running:
+                upstream = self.connect_relay()
+                if upstream is None:
+                    break
+                with upstream:
+                    try:
+                        if unsent is not None:
+                            self._skip_partial_record(client_sock, upstream, unsent)
+                        n, unsent = self._relay(client_sock, upstream)
+                    except OSError as e:
+                        logging.error("Error in relay: %s", e)
+                        break
+                relayed += n
+                if unsent is None:
+                    break
+                self.counters["dropped"] += 1
+                logging.warning("Relay connection to %s:%s lost. Reconnecting...",
+                                self.send_host, self.send_port)
+        logging.info("Relay closed after %d bytes", relayed)
+
+    def connect_relay(self):
+        """Connects to the next hop, retrying every second. None once stopped"""
+        while self.running:
+            try:
+                upstream = socket.create_connection((self.send_host, self.send_port), timeout=5)
+                upstream.settimeout(None)
+                return upstream
+            except OSError as e:
+                logging.warning("Relay connection to %s:%s failed: %s. Retrying in 1 second...",
+                                self.send_host, self.send_port, e)
+                time.sleep(1)
+        return None
+
+    def _skip_partial_record(self, client_sock, upstream, data):
+        """After a reconnection the stream may continue in the middle of a
+        record, the bytes up to the next delimiter are dropped
+            @param data: Bytes read from the client and not sent"""
+        if FRAMING_MODE != "line":
+            # The next length header can not be found again
+            raise OSError("Can not resynchronize a length framed stream")
+        while self.running:
+            idx = data.find(DELIMITER)
+            if idx >= 0:
+                upstream.sendall(data[idx + 1:])
+                self.count_relayed(len(data) - idx - 1)
+                return
+            data = client_sock.recv(SPLICE_CHUNK)
+            if not data:
+                return
+
+    def _relay(self, src, dst):
+        """Moves the bytes of src to dst. Returns (bytes moved, None) when src
+        closes and (bytes moved, bytes not sent) when dst fails. Errors of
+        src are raised"""
+        if hasattr(os, "splice"):
+            return self._splice(src, dst)
+        total = 0
+        while self.running:
+            self.resumed.wait()
+            data = src.recv(SPLICE_CHUNK)
+            if not data:
+                break
+            self.hold(1)
+            try:
+                if peer_closed(dst):
+                    return total, data
+                dst.sendall(data)
+            except OSError:
+                # Part of data may have been sent, the resynchronization drops it
+                return total, data
+            finally:
+                self.release(1)
+            total += len(data)
+            self.count_relayed(len(data))
+        return total, None
+
+    def _splice(self, src, dst):
+        pipe_r, pipe_w = os.pipe()
+        total = 0
+        try:
+            while self.running:
+                self.resumed.wait()
+                n = os.splice(src.fileno(), pipe_w, SPLICE_CHUNK, flags=os.SPLICE_F_MOVE)
+                if not n:
+                    break
+                self.hold(1)
+                try:
+                    if peer_closed(dst):
+                        return total, os.read(pipe_r, n)
+                    while n:
+                        sent = os.splice(pipe_r, dst.fileno(), n, flags=os.SPLICE_F_MOVE)
+                        n -= sent
+                        total += sent
+                        self.count_relayed(sent)
+                except OSError:
+                    # The bytes left in the pipe are not sent
+                    return total, os.read(pipe_r, n) if n else b""
+                finally:
+                    self.release(1)
+        finally:
+            os.close(pipe_r)
+            os.close(pipe_w)
+        return total, None
+
+    def count_relayed(self, nbytes, data=None):
+        """Counts the traffic that skipped the NF
+            @param data: The frames relayed, when the VNF sees them (not with splice)"""
+        self.counters["relayed_bytes"] += nbytes
+        if isinstance(self.network_function, FusedChain):
+            self.network_function.relayed(nbytes, None if data is None else count_records(data))
+
+    def forward_tcp_client(self, client_sock):
+        """Passthrough to a shared memory ring: whole records are forwarded
+        without parsing them or calling the NF"""
+        buffer = RecordBuffer()
         with client_sock:
             while self.running:
                 try:
-                    data = client_sock.recv(4096)
-                    if not data:
+                    self.resumed.wait()
+                    if not buffer.recv_into(client_sock):
                         break
-                    self.treat_messages(data)
+                    self.hold(1)
+                    try:
+                        self.forward_frames(buffer.frames(), relayed=True)
+                    finally:
+                        self.release(1)
                 except Exception as e:
                     logging.error("Error in TCP client handler: %s", e)
                     break
 
-    def treat_messages(self, body):
+    def forward_frames(self, data, relayed=False):
+        """Sends records that are already framed
+            @param relayed: The records skipped the NF (passthrough)"""
+        if not data:
+            return
+        if relayed:
+            self.count_relayed(len(data), data)
+        with self.send_lock:
+            if self.out_ring is not None and self.write_ring(data):
+                return
+            if self.send_socket:
+                try:
+                    self.send_socket.sendall(data)
+                except Exception as e:
+                    logging.error("Error sending message: %s", e)
+                    self.send_socket.close()
+                    self.send_socket = None
+            else:
+                self.counters["dropped"] += 1
+                logging.warning("Send socket is not connected. Dropping messages.")
+
+    def shm_reader_loop(self):
+        """Reads the records written by the previous VNF in the shared memory ring"""
+        ring = ShmRing.create(self.in_shm)
+        logging.info("Receiving from shared memory ring %s", ring.path)
+        buffer = RecordBuffer()
+        while self.running:
+            try:
+                # While paused the ring fills up and the previous VNF blocks
+                self.resumed.wait()
+                if not ring.read_into(buffer, timeout=1):
+                    continue
+                if self.passthrough:
+                    self.hold(1)
+                    try:
+                        self.forward_frames(buffer.frames(), relayed=True)
+                    finally:
+                        self.release(1)
+                    continue
+                records = [bytes(record) for record in buffer.records()]
+                self.hold(len(records))
+                try:
+                    network_function, batch_size = self.nf_mode
+                    if not batch_size:
+                        for record in records:
+                            self.treat_messages(record, network_function)
+                        continue
+                    # The records already available are not delayed to fill a batch
+                    for i in range(0, len(records), batch_size):
+                        self.treat_batch(records[i:i + batch_size], network_function)
+                finally:
+                    self.release(len(records))
+            except Exception as e:
+                logging.error("Error in shared memory reader: %s", e)
+        ring.close(unlink=True)
+
+    def treat_messages(self, body, network_function=None):
         if not body:
             return
+        if network_function is None:
+            network_function = self.network_function
+        self.counters["records_in"] += 1
         try:
-            return_val = self.network_function(body)
+            return_val = network_function(body)
             if return_val:
-                logging.info("Forwarding message: %s", return_val)
+                self.counters["records_out"] += 1
+                logging.debug("Forwarding message: %s", return_val)
                 self.send_message(return_val)
             else:
-                logging.info("Network Function did not forward any message")
+                logging.debug("Network Function did not forward any message")
+        except Exception as e:
+            logging.error("NF internal error: %s", e)
+
+    def treat_batch(self, records, network_function=None):
+        """Calls the batch NF once for all records and sends the outputs together"""
+        if network_function is None:
+            network_function = self.network_function
+        self.counters["records_in"] += len(records)
+        try:
+            outputs = [out for out in network_function(records) or () if out]
         except Exception as e:
             logging.error("NF internal error: %s", e)
+            return
+        self.counters["records_out"] += len(outputs)
+        logging.debug("Forwarding %d of %d messages", len(outputs), len(records))
+        if outputs:
+            self.send_messages(outputs)
+
+    def attach_out_ring(self):
+        """Maps the ring of the next VNF. On failure the VNF falls back to TCP"""
+        try:
+            ring = ShmRing.attach(self.out_shm, timeout=SHM_ATTACH_TIMEOUT)
+        except (OSError, ValueError) as e:
+            logging.warning("Shared memory ring %s unavailable (%s). Using TCP.", self.out_shm, e)
+            self.out_shm = None
+            return
+        with self.send_lock:
+            old, self.out_ring = self.out_ring, ring
+        if old is not None:
+            old.close()
+        logging.info("Sending to shared memory ring %s", ring.path)
+        self.announce_ready()
+
+    def write_ring(self, data):
+        """Writes data to the ring of the next VNF, called with send_lock held
+
+        Waits while the ring is full, like sendall on a full socket. If the
+        next VNF replaced its ring (it restarted) the ring is released and
+        False is returned: the caller drops the data, maintain_send_socket
+        attaches the new ring."""
+        data = memoryview(data)
+        while data:
+            data = data[self.out_ring.write(data, timeout=RING_WRITE_TIMEOUT):]
+            if data and (self.out_ring.stale() or not self.running):
+                logging.warning("Shared memory ring %s was replaced, dropping the data.",
+                                self.out_ring.path)
+                self.out_ring.close()
+                self.out_ring = None
+                return False
+        return True
+
+    def relays_only(self):
+        """True when all the traffic leaves through relay_tcp_client"""
+        return self.passthrough and not self.out_shm and not self.in_shm
 
     def maintain_send_socket(self):
         """Persistent socket handler to send messages."""
+        relay_announced = False
         while self.running:
-            if self.send_socket is None:
+            if self.relays_only():
+                # Every inbound connection is relayed on its own connection to the
+                # next hop (relay_tcp_client), a persistent one would stay idle
+                if not relay_announced:
+                    self.announce_ready()
+                    relay_announced = True
+                time.sleep(1)
+            elif self.out_shm:
+                # The next VNF recreates its ring when it restarts
+                if self.out_ring is None or self.out_ring.stale():
+                    self.attach_out_ring()
+                else:
+                    time.sleep(1)
+            elif self.send_socket is None:
                 try:
                     logging.info("Trying to connect to %s:%s...", self.send_host, self.send_port)
                     sock = socket.create_connection((self.send_host, self.send_port), timeout=5)
                     self.send_socket = sock
                     logging.info("Connected to %s:%s", self.send_host, self.send_port)
+                    self.announce_ready()
                 except Exception as e:
                     logging.warning("Send socket connection failed: %s. Retrying in 1 second...", e)
                     time.sleep(1)
@@ -108,64 +562,833 @@ class VNF:
 
     def send_message(self, payload):
         with self.send_lock:
+            if self.out_ring is not None and self.write_ring(frame(payload)):
+                return
             if self.send_socket:
                 try:
-                    self.send_socket.sendall(payload)
+                    self.send_socket.sendall(frame(payload))
                 except Exception as e:
                     logging.error("Error sending message: %s", e)
                     self.send_socket.close()
                     self.send_socket = None
             else:
+                self.counters["dropped"] += 1
                 logging.warning("Send socket is not connected. Dropping message.")
 
+    def send_messages(self, payloads):
+        """Sends many messages with one vectored write"""
+        with self.send_lock:
+            if self.out_ring is not None and self.write_ring(b"".join(frame(p) for p in payloads)):
+                return
+            if self.send_socket:
+                try:
+                    sendmsg_all(self.send_socket, [frame(p) for p in payloads])
+                except Exception as e:
+                    logging.error("Error sending message: %s", e)
+                    self.send_socket.close()
+                    self.send_socket = None
+            else:
+                self.counters["dropped"] += len(payloads)
+                logging.warning("Send socket is not connected. Dropping %d messages.", len(payloads))
+
+    def announce_ready(self):
+        """The VNF listens and the next hop is connected (again after a reconnection)"""
+        if self.control_conn is not None:
+            publish_ready(self.control_conn, self.control_channel,
+                          self.vnf_id, self.sfc_id, self.members())
+
     def treat_control_messages(self, ch, method, properties, body):
         logging.info("Received CONTROL MESSAGE: %s", body.decode())
+        msg = parse_command(method, body)
+        if msg is None:
+            return
+        reply = self.apply_command(msg)
+        rpc.reply(ch, msg, json.dumps(reply), properties)
+
+    def members(self):
+        """Ids of the VNFs running in this process"""
+        if isinstance(self.network_function, FusedChain):
+            return [stage["vnf_id"] for stage in self.network_function.stages]
+        return [self.vnf_id]
+
+    def apply_command(self, msg):
+        """Applies a control command and returns the reply (a dict)
+
+        Commands:
+            stats: counters and current configuration
+            set_nf {nf}: loads the NF from the registry. In a fused chain only
+                         the stage of the target VNF changes (all if no target)
+            set_batch {batch_size, batch_timeout}: changes the batching
+            pause / resume: stops (or restarts) reading the inbound traffic
+            drain: pause and send everything that was already received
+            rebind {host, port}: sends to another next hop"""
+        command = msg["command"]
+        reply = {"vnf_id": self.vnf_id, "sfc_id": self.sfc_id, "command": command, "ok": True}
+        try:
+            if command == "stats":
+                reply["stats"] = self.stats()
+            elif command == "set_nf":
+                self.set_network_function(msg["nf"], msg.get("target"))
+            elif command == "set_batch":
+                self.set_batch(int(msg.get("batch_size", self.batch_size)),
+                               float(msg.get("batch_timeout", self.batch_timeout)))
+            elif command == "pause":
+                self.pause()
+            elif command == "resume":
+                self.resume()
+            elif command == "drain":
+                self.drain()
+            elif command == "rebind":
+                self.rebind(msg["host"], int(msg["port"]))
+            else:
+                raise ValueError(f"Unknown command: {command}")
+        except (KeyError, ValueError, TypeError, TimeoutError) as e:
+            logging.error("Control command %s failed: %s", command, e)
+            reply["ok"] = False
+            reply["error"] = str(e)
+        return reply
+
+    def stats(self):
+        stats = dict(self.counters)
+        stats.update(nf=self.nf_name, batch_size=self.batch_size,
+                     batch_timeout=self.batch_timeout, passthrough=self.passthrough,
+                     paused=not self.resumed.is_set(),
+                     upstream=[self.send_host, self.send_port],
+                     connected=self.send_socket is not None or self.out_ring is not None
+                     or self.relays_only())
+        if isinstance(self.network_function, FusedChain):
+            stats["chain"] = self.network_function.stats()
+        return stats
+
+    def resolve_nf(self, name, batch_size):
+        """Returns the variant of the registered NF name for batch_size"""
+        if name not in self.registry:
+            raise ValueError(f"Unknown network function: {name}")
+        single, batch = self.registry[name]
+        return batch if batch_size else single
+
+    def build_nf(self, name, target, batch_size):
+        """Returns the NF of the VNF after loading name (None: keep the names)"""
+        chain = self.network_function
+        if not isinstance(chain, FusedChain):
+            name = self.nf_name if name is None else name
+            return self.resolve_nf(name, batch_size), name
+        stages = []
+        for stage in chain.stages:
+            stage_name = stage["name"]
+            if name is not None and target in (None, stage["vnf_id"]):
+                stage_name = name
+            stages.append((stage["vnf_id"], self.resolve_nf(stage_name, batch_size), stage_name))
+        if target is not None and target not in self.members():
+            raise ValueError(f"{target} does not run in this VNF")
+        return chain.replace(stages, batch=bool(batch_size)), self.nf_name
+
+    def set_nf_mode(self, network_function, batch_size):
+        self.network_function = network_function
+        self.batch_size = batch_size
+        self.nf_mode = (network_function, batch_size)
+        passthrough = self.passthrough_mode
+        if passthrough is None:
+            passthrough = getattr(network_function, "passthrough", False)
+        # Connections being relayed keep relaying until they close
+        self.passthrough = passthrough
+
+    def set_network_function(self, name, target=None):
+        network_function, nf_name = self.build_nf(name, target, self.batch_size)
+        self.set_nf_mode(network_function, self.batch_size)
+        if not isinstance(network_function, FusedChain):
+            self.nf_name = nf_name
+        logging.info("Network function of %s is now %s", target or self.vnf_id, name)
+
+    def set_batch(self, batch_size, batch_timeout):
+        if batch_size < 0 or batch_timeout < 0:
+            raise ValueError("Batch size and timeout must not be negative")
+        network_function = self.network_function
+        if bool(batch_size) != bool(self.batch_size):
+            # The NF receives lists instead of records (or the opposite)
+            network_function, _ = self.build_nf(None, None, batch_size)
+        self.batch_timeout = batch_timeout
+        self.set_nf_mode(network_function, batch_size)
+        logging.info("Batch size is now %d (timeout %ss)", batch_size, batch_timeout)
+
+    def pause(self):
+        self.resumed.clear()
+        logging.info("Paused")
+
+    def resume(self):
+        with self.flight:
+            self.resumed.set()
+            self.flight.notify_all()
+        logging.info("Resumed")
+
+    def hold(self, n):
+        """n records were read, they are in flight until release"""
+        with self.flight:
+            self.in_flight += n
+
+    def release(self, n):
+        """n records in flight were sent (or dropped)"""
+        with self.flight:
+            self.in_flight -= n
+            if not self.in_flight:
+                self.flight.notify_all()
+
+    def wait_resumed(self):
+        """Blocks a handler holding records while paused. A drain wakes it up"""
+        with self.flight:
+            self.flight.wait_for(lambda: self.resumed.is_set() or self.draining)
+
+    def drain(self):
+        """Pauses and waits for the records already read to be sent
+
+        Handlers with a pending batch wake up by its deadline and send it,
+        handlers blocked by the pause send the records they hold."""
+        self.pause()
+        with self.flight:
+            self.draining = True
+            self.flight.notify_all()
+            drained = self.flight.wait_for(lambda: not self.in_flight, COMMAND_TIMEOUT)
+            self.draining = False
+        if not drained:
+            raise TimeoutError(f"{self.in_flight} records still in flight")
+
+    def rebind(self, host, port):
+        """Sends to another next hop, the current connection is closed"""
+        with self.send_lock:
+            self.send_host = host
+            self.send_port = port
+            if self.send_socket is not None:
+                self.send_socket.close()
+                self.send_socket = None
+            if self.out_ring is not None:
+                # A shared memory ring only links to the previous next hop
+                self.out_ring.close()
+                self.out_ring = None
+            self.out_shm = None
+        logging.info("Next hop is now %s:%s", host, port)
 
     def stop_service(self):
         logging.info("Stopping VNF service...")
         self.running = False
+        if isinstance(self.network_function, FusedChain):
+            logging.info("Fused chain stats: %s", self.network_function.stats())
         try:
             if self.send_socket:
                 self.send_socket.close()
-            self.listener_socket.close()
+            if self.out_ring is not None:
+                self.out_ring.close()
+            if self.listener_socket is not None:
+                self.listener_socket.close()
+            if self.control_channel is not None:
+                self.control_channel.stop_consuming()
+                self.control_conn.close()
+        except Exception as e:
+            logging.error("Error during cleanup: %s", e)
+
+class LoopVNF(VNF):
+    """Single threaded VNF data plane
+
+    Inbound reads, NF calls and outbound writes are multiplexed in one
+    selectors (epoll) loop. Output is appended to an outbound buffer that is
+    written when the socket is writable, so no lock is needed. While the
+    buffer is above VNF_OUT_BUFFER the inbound sockets are not read, which
+    propagates the backpressure to the previous hop.
+
+    Control commands are handed to the loop thread and applied between
+    events, so they never race with the data plane."""
+    def start_service(self):
+        self.selector = selectors.DefaultSelector()
+        self.inbound = {}  # socket -> RecordBuffer
+        self.paused = False # Inbound sockets are not being read
+        self.held = False   # Paused by a control command
+        self.out_buffer = bytearray()
+        self.reconnect_at = 0.0
+        self.connecting = None
+        self.batch = []
+        self.batch_deadline = None
+        self.commands = collections.deque() # (command, Future) waiting for the loop
+        self.draining = [] # (reply, Future) of drain commands waiting for the flush
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        if self.control_channel is not None:
+            threading.Thread(target=self.control_channel.start_consuming, daemon=True).start()
+        threading.Thread(target=self.event_loop, daemon=True).start()
+
+    def event_loop(self):
+        logging.info("Event loop started on %s:%s", self.listen_host, self.listen_port)
+        if self.listener_socket is not None:
+            self.listener_socket.setblocking(False)
+            self.selector.register(self.listener_socket, selectors.EVENT_READ, self._accept)
+        for sock in self.inbound_sockets:
+            self._add_inbound(sock)
+        self.selector.register(self._wakeup_r, selectors.EVENT_READ, self._run_commands)
+        while self.running:
+            if self.send_socket is None and time.monotonic() >= self.reconnect_at:
+                self._connect_upstream()
+            timeout = 1
+            if self.batch:
+                timeout = max(min(self.batch_deadline - time.monotonic(), timeout), 0)
+            for key, mask in self.selector.select(timeout=timeout):
+                key.data(key.fileobj, mask)
+            if self.batch and time.monotonic() >= self.batch_deadline:
+                self._treat_batch()
+                self._flush()
+
+    def _accept(self, sock, mask):
+        try:
+            client_sock, addr = sock.accept()
+        except BlockingIOError:
+            return
+        logging.info("Accepted TCP connection from %s", addr)
+        self._add_inbound(client_sock)
+
+    def _add_inbound(self, client_sock):
+        client_sock.setblocking(False)
+        self.inbound[client_sock] = RecordBuffer()
+        events = 0 if self.paused else selectors.EVENT_READ
+        if events:
+            self.selector.register(client_sock, events, self._read)
+
+    def _close_inbound(self, sock):
+        if not self.paused:
+            self.selector.unregister(sock)
+        del self.inbound[sock]
+        sock.close()
+
+    def _read(self, sock, mask):
+        buffer = self.inbound[sock]
+        try:
+            n = buffer.recv_into(sock)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            logging.error("Error in TCP client handler: %s", e)
+            n = 0
+        if not n:
+            self._close_inbound(sock)
+            return
+        if self.passthrough:
+            # No splice here: the upstream connection is shared, so only
+            # complete records are appended, without calling the NF
+            data = buffer.frames()
+            if self.send_socket is None:
+                self.counters["dropped"] += 1
+            else:
+                self.count_relayed(len(data), data)
+                self.out_buffer += data
+        elif not self.batch_size:
+            for record in buffer.records():
+                self.treat_messages(bytes(record))
+        else:
+            for record in buffer.records():
+                if not self.batch:
+                    self.batch_deadline = time.monotonic() + self.batch_timeout
+                self.batch.append(bytes(record))
+                if len(self.batch) >= self.batch_size:
+                    self._treat_batch()
+        # Everything produced by this read leaves in one send
+        self._flush()
+
+    def _treat_batch(self):
+        batch, self.batch = self.batch, []
+        self.treat_batch(batch)
+
+    def send_messages(self, payloads):
+        for payload in payloads:
+            self.send_message(payload)
+
+    def send_message(self, payload):
+        if self.send_socket is None:
+            self.counters["dropped"] += 1
+            logging.debug("Send socket is not connected. Dropping message.")
+            return
+        self.out_buffer += frame(payload)
+
+    def _connect_upstream(self):
+        logging.info("Trying to connect to %s:%s...", self.send_host, self.send_port)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        err = sock.connect_ex((self.send_host, self.send_port))
+        if err not in (0, errno.EINPROGRESS):
+            logging.warning("Send socket connection failed: %s. Retrying in 1 second...",
+                            errno.errorcode.get(err, err))
+            sock.close()
+            self.reconnect_at = time.monotonic() + 1
+            return
+        # Keeps the loop from trying again while connecting
+        self.reconnect_at = float("inf")
+        self.connecting = sock
+        self.selector.register(sock, selectors.EVENT_WRITE, self._connected)
+
+    def _connected(self, sock, mask):
+        self.selector.unregister(sock)
+        self.connecting = None
+        err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            logging.warning("Send socket connection failed: %s. Retrying in 1 second...",
+                            errno.errorcode.get(err, err))
+            sock.close()
+            self.reconnect_at = time.monotonic() + 1
+            return
+        logging.info("Connected to %s:%s", self.send_host, self.send_port)
+        self.send_socket = sock
+        # The next hop never sends data, reading only detects the connection closing
+        self.selector.register(sock, selectors.EVENT_READ, self._upstream_event)
+        self.announce_ready()
+
+    def _upstream_event(self, sock, mask):
+        if mask & selectors.EVENT_READ:
+            try:
+                closed = not sock.recv(4096)
+            except BlockingIOError:
+                closed = False
+            except OSError:
+                closed = True
+            if closed:
+                self._upstream_closed()
+                return
+        if mask & selectors.EVENT_WRITE:
+            self._flush()
+
+    def _upstream_closed(self):
+        logging.error("Connection to %s:%s lost", self.send_host, self.send_port)
+        self.selector.unregister(self.send_socket)
+        self.send_socket.close()
+        self.send_socket = None
+        # A partial record may have been sent, the rest can not be resent
+        self.counters["dropped"] += 1 if self.out_buffer else 0
+        self.out_buffer.clear()
+        self._set_paused(self.held)
+        self._drained()
+        self.reconnect_at = time.monotonic() + 1
+
+    def _flush(self):
+        if self.send_socket is None or not self.out_buffer:
+            self._drained()
+            return
+        try:
+            n = self.send_socket.send(self.out_buffer)
+            del self.out_buffer[:n]
+        except BlockingIOError:
+            pass
+        except OSError as e:
+            logging.error("Error sending message: %s", e)
+            self._upstream_closed()
+            return
+        events = selectors.EVENT_READ
+        if self.out_buffer:
+            events |= selectors.EVENT_WRITE
+        self.selector.modify(self.send_socket, events, self._upstream_event)
+        if len(self.out_buffer) > VNF_OUT_BUFFER:
+            self._set_paused(True)
+        elif len(self.out_buffer) <= VNF_OUT_BUFFER // 2:
+            self._set_paused(self.held)
+        if not self.out_buffer:
+            self._drained()
+
+    def _set_paused(self, paused):
+        """Stops (or resumes) reading the inbound sockets"""
+        if paused == self.paused:
+            return
+        self.paused = paused
+        for sock in self.inbound:
+            if paused:
+                self.selector.unregister(sock)
+            else:
+                self.selector.register(sock, selectors.EVENT_READ, self._read)
+
+    def apply_command(self, msg):
+        """Runs the command in the loop thread and waits for its reply"""
+        future = futures.Future()
+        self.commands.append((msg, future))
+        self._wakeup_w.send(b"\0")
+        try:
+            return future.result(timeout=COMMAND_TIMEOUT)
+        except futures.TimeoutError:
+            return {"vnf_id": self.vnf_id, "sfc_id": self.sfc_id, "command": msg["command"],
+                    "ok": False, "error": "timeout"}
+
+    def _run_commands(self, sock, mask):
+        try:
+            sock.recv(4096)
+        except BlockingIOError:
+            pass
+        while self.commands:
+            msg, future = self.commands.popleft()
+            reply = VNF.apply_command(self, msg)
+            if msg["command"] == "drain" and reply["ok"] and self.out_buffer:
+                # Replied once the outbound buffer is empty
+                self.draining.append((reply, future))
+            else:
+                future.set_result(reply)
+
+    def _drained(self):
+        draining, self.draining = self.draining, []
+        for reply, future in draining:
+            future.set_result(reply)
+
+    def stats(self):
+        stats = super().stats()
+        stats.update(paused=self.held, out_buffer=len(self.out_buffer))
+        return stats
+
+    def set_network_function(self, name, target=None):
+        # The pending batch is treated by the NF that received it
+        if self.batch:
+            self._treat_batch()
+        super().set_network_function(name, target)
+
+    def set_batch(self, batch_size, batch_timeout):
+        if self.batch:
+            self._treat_batch()
+        super().set_batch(batch_size, batch_timeout)
+
+    def pause(self):
+        self.held = True
+        self._set_paused(True)
+        logging.info("Paused")
+
+    def resume(self):
+        self.held = False
+        if len(self.out_buffer) <= VNF_OUT_BUFFER:
+            self._set_paused(False)
+        logging.info("Resumed")
+
+    def drain(self):
+        self.pause()
+        if self.batch:
+            self._treat_batch()
+        self._flush()
+
+    def rebind(self, host, port):
+        """Sends to another next hop. Records still in the outbound buffer are
+        dropped, drain first to avoid it"""
+        self.send_host = host
+        self.send_port = port
+        if self.connecting is not None:
+            self.selector.unregister(self.connecting)
+            self.connecting.close()
+            self.connecting = None
+        if self.send_socket is not None:
+            self.selector.unregister(self.send_socket)
+            self.send_socket.close()
+            self.send_socket = None
+            self.counters["dropped"] += 1 if self.out_buffer else 0
+            self.out_buffer.clear()
+            self._set_paused(self.held)
+            self._drained()
+        self.reconnect_at = 0.0
+        logging.info("Next hop is now %s:%s", host, port)
+
+def run_worker(vnf_class, kwargs, conn, feed, inherited):
+    """Body of a worker process: the data plane, fed by the supervisor through
+    feed, plus the control messages forwarded by the supervisor through conn"""
+    # Supervisor ends copied by fork, otherwise EOF never arrives
+    for parent_end in inherited:
+        parent_end.close()
+    vnf = vnf_class(control=False, inbound=[feed], **kwargs)
+    while vnf.running:
+        try:
+            msg = json.loads(conn.recv_bytes())
+            reply = vnf.apply_command(msg)
+            reply["worker"] = os.getpid()
+            conn.send_bytes(json.dumps(reply).encode())
+        except (EOFError, OSError):
+            break
+    vnf.stop_service()
+
+class VNFSupervisor:
+    """Runs the data plane of a VNF in multiple processes
+
+    The previous hop keeps a single connection to the VNF, so the supervisor
+    accepts the inbound connections and spreads their records among the
+    workers: every chunk of complete records read from a connection is
+    written to the feed (a socketpair) of the next worker, round robin. A
+    worker reads its feed like an accepted connection and keeps its own
+    connection to the next hop. Records of one connection may leave out of
+    order.
+
+    The supervisor also consumes the control exchange, forwards the commands
+    to all workers and replies with the replies of the workers (and their
+    summed counters for stats)."""
+    def __init__(self, vnf_class, workers, **kwargs):
+        self.vnf_id = kwargs["vnf_id"]
+        self.sfc_id = kwargs["sfc_id"]
+        self.running = True
+        self.workers = []
+        # Serializes the request/reply exchanges on the worker pipes
+        self.lock = threading.Lock()
+        # Workers are forked before any RabbitMQ connection exists
+        ctx = multiprocessing.get_context("fork")
+        parent_ends = []
+        for _ in range(workers):
+            parent_conn, child_conn = ctx.Pipe()
+            feed, worker_feed = socket.socketpair()
+            parent_ends += [parent_conn, feed]
+            process = ctx.Process(target=run_worker,
+                                  args=(vnf_class, kwargs, child_conn, worker_feed,
+                                        list(parent_ends)),
+                                  daemon=True)
+            process.start()
+            child_conn.close()
+            worker_feed.close()
+            self.workers.append((process, parent_conn))
+        # (feed, lock) of each worker, a chunk is written by one thread at a time
+        self.feeds = [(feed, threading.Lock()) for feed in parent_ends[1::2]]
+        self.next_feed = 0
+        self.dropped = 0 # Chunks not dispatched because every worker is gone
+        logging.info("Started VNF id:%s with %d workers", self.vnf_id, workers)
+
+        self.listener_socket = listen_socket(kwargs["listen_host"], kwargs["listen_port"])
+        threading.Thread(target=self.accept_loop, daemon=True).start()
+
+        self.members = [self.vnf_id]
+        if isinstance(kwargs["network_function"], FusedChain):
+            self.members = [stage["vnf_id"] for stage in kwargs["network_function"].stages]
+        self.control_conn, self.control_channel = control_connect(
+            self.vnf_id, self.sfc_id, self.members, self.treat_control_messages)
+        threading.Thread(target=self.control_channel.start_consuming, daemon=True).start()
+        threading.Thread(target=self.announce_when_ready, daemon=True).start()
+
+    def accept_loop(self):
+        while self.running:
+            try:
+                client_sock, addr = self.listener_socket.accept()
+            except OSError as e:
+                if self.running:
+                    logging.error("TCP accept error: %s", e)
+                continue
+            logging.info("Accepted TCP connection from %s", addr)
+            threading.Thread(target=self.dispatch, args=(client_sock,), daemon=True).start()
+
+    def dispatch(self, client_sock):
+        """Spreads the records read from client_sock among the workers"""
+        buffer = RecordBuffer()
+        with client_sock:
+            while self.running:
+                try:
+                    if not buffer.recv_into(client_sock):
+                        break
+                    data = buffer.frames()
+                except (OSError, ValueError) as e:
+                    logging.error("Error in TCP client handler: %s", e)
+                    break
+                if data:
+                    self.feed_workers(data)
+
+    def feed_workers(self, data):
+        """Writes data (complete records) to the next live worker. Blocks while
+        its feed is full, which propagates the backpressure to the client"""
+        for _ in range(len(self.feeds)):
+            feed, lock = self.feeds[self.next_feed % len(self.feeds)]
+            self.next_feed += 1
+            with lock:
+                try:
+                    feed.sendall(data)
+                    return
+                except OSError as e:
+                    logging.error("Worker feed failed: %s", e)
+        self.dropped += 1
+
+    def ask_workers(self, msg):
+        """Sends msg to the live workers and returns their replies"""
+        with self.lock:
+            alive = [conn for process, conn in self.workers if process.is_alive()]
+            for conn in alive:
+                conn.send_bytes(json.dumps(msg).encode())
+            replies = []
+            for conn in alive:
+                if conn.poll(COMMAND_TIMEOUT):
+                    replies.append(json.loads(conn.recv_bytes()))
+        return replies
+
+    def announce_when_ready(self):
+        """Publishes vnf-ready once every worker is connected to the next hop"""
+        while self.running:
+            replies = self.ask_workers({"command": "stats"})
+            if len(replies) == len(self.workers) and \
+                    all(r["stats"]["connected"] for r in replies):
+                publish_ready(self.control_conn, self.control_channel,
+                              self.vnf_id, self.sfc_id, self.members)
+                return
+            time.sleep(0.05)
+
+    def treat_control_messages(self, ch, method, properties, body):
+        logging.info("Received CONTROL MESSAGE: %s", body.decode())
+        msg = parse_command(method, body)
+        if msg is None:
+            return
+        replies = self.ask_workers(msg)
+        reply = {"vnf_id": self.vnf_id, "sfc_id": self.sfc_id, "command": msg["command"],
+                 "ok": len(replies) == len(self.workers) and all(r["ok"] for r in replies),
+                 "workers": replies}
+        if msg["command"] == "stats":
+            reply["stats"] = {counter: sum(r["stats"][counter] for r in replies)
+                              for counter in ("records_in", "records_out", "dropped",
+                                              "relayed_bytes")}
+            reply["stats"]["dispatch_dropped"] = self.dropped
+        rpc.reply(ch, msg, json.dumps(reply), properties)
+
+    def stop_service(self):
+        logging.info("Stopping VNF workers...")
+        self.running = False
+        self.listener_socket.close()
+        for feed, _ in self.feeds:
+            feed.close()
+        for process, conn in self.workers:
+            conn.close()
+            process.terminate()
+        for process, _ in self.workers:
+            process.join(timeout=5)
+        try:
             self.control_channel.stop_consuming()
             self.control_conn.close()
         except Exception as e:
             logging.error("Error during cleanup: %s", e)
 
+class FusedChain:
+    """NFs of consecutive VNFs running as a pipeline in one process
+
+    The records are passed in memory from one NF to the next, so the chain
+    pays a single network hop. Each stage keeps the identity of its VNF
+    and its own counters. The chain is used as the network_function."""
+    def __init__(self, stages, batch=False):
+        """
+            @param stages: List of (vnf_id, network_function, name), in chain order.
+                           name is the key of the NF in the registry (may be None)
+            @param batch: Whether the NFs receive lists of records
+        """
+        for vnf_id, nf, _ in stages:
+            if not callable(nf):
+                raise TypeError(f"Network function of {vnf_id} is not callable")
+        self.batch = batch
+        self.stages = [{"vnf_id": vnf_id, "nf": nf, "name": name, "in": 0, "out": 0, "errors": 0,
+                        "relayed_bytes": 0}
+                       for vnf_id, nf, name in stages]
+        self.passthrough = all(getattr(nf, "passthrough", False) for _, nf, _ in stages)
+
+    def replace(self, stages, batch):
+        """Returns a chain with other NFs, the counters of each VNF are kept"""
+        chain = FusedChain(stages, batch)
+        for new, old in zip(chain.stages, self.stages):
+            for counter in ("in", "out", "errors", "relayed_bytes"):
+                new[counter] = old[counter]
+        return chain
+
+    def __call__(self, data):
+        for stage in self.stages:
+            stage["in"] += len(data) if self.batch else 1
+            try:
+                data = stage["nf"](data)
+            except Exception:
+                stage["errors"] += 1
+                raise
+            if self.batch:
+                data = [out for out in data or () if out]
+            if not data:
+                logging.debug("%s did not forward any message", stage["vnf_id"])
+                return data
+            stage["out"] += len(data) if self.batch else 1
+        return data
+
+    def relayed(self, nbytes, records=None):
+        """Traffic relayed without calling the NFs (passthrough). The records
+        are only known when the VNF sees them, not when they are spliced"""
+        for stage in self.stages:
+            stage["relayed_bytes"] += nbytes
+            if records:
+                stage["in"] += records
+                stage["out"] += records
+
+    def stats(self):
+        return {stage["vnf_id"]: {"nf": stage["name"], "in": stage["in"],
+                                  "out": stage["out"], "errors": stage["errors"],
+                                  "relayed_bytes": stage["relayed_bytes"]}
+                for stage in self.stages}
+
 # Example NF
+@passthrough
 def my_network_function(data):
     return data
 
-vnf_id = None
-sfc_id = None
-listen_host = None
-listen_port = None
-send_host = None
-send_port = None
+# Example batch NF
+@passthrough
+def my_batch_network_function(records):
+    return records
 
-try:
-    vnf_id = sys.argv[1]
-    sfc_id = sys.argv[2]
-    listen_host = sys.argv[3]
-    listen_port = int(sys.argv[4])
-    send_host = sys.argv[5]
-    send_port = int(sys.argv[6])
-except:
-    print("Incorret usage")
-    print(f"python3 {sys.argv[0]} vnf_id sfc_id listen_host listen_port send_host send_port")
-    sys.exit(0)
+# NF that forwards nothing
+def drop_network_function(data):
+    return None
+
+def drop_batch_network_function(records):
+    return []
+
+# NFs that can be loaded with --nf or the set_nf control command
+NETWORK_FUNCTIONS = {
+    "identity": (my_network_function, my_batch_network_function),
+    "drop": (drop_network_function, drop_batch_network_function),
+}
+
+parser = argparse.ArgumentParser(description="TCP VNF")
+parser.add_argument("vnf_id")
+parser.add_argument("sfc_id")
+parser.add_argument("listen_host")
+parser.add_argument("listen_port", type=int)
+parser.add_argument("send_host")
+parser.add_argument("send_port", type=int)
+parser.add_argument("--mode", choices=["threaded", "loop"], default=VNF_MODE,
+                    help="threaded: one thread per connection. loop: single epoll loop")
+parser.add_argument("--batch-size", type=int, default=VNF_BATCH_SIZE,
+                    help="Records per NF call, 0 calls the NF once per record")
+parser.add_argument("--batch-timeout", type=float, default=VNF_BATCH_TIMEOUT,
+                    help="Max seconds a record waits for its batch")
+parser.add_argument("--workers", type=int, default=VNF_WORKERS,
+                    help="Number of data plane processes, the records are spread among them")
+parser.add_argument("--chain", default="",
+                    help="Comma separated ids of the VNFs fused in this process")
+parser.add_argument("--in-shm", default=None,
+                    help="Name of the shared memory ring written by the previous VNF")
+parser.add_argument("--out-shm", default=None,
+                    help="Name of the shared memory ring of the next VNF")
+parser.add_argument("--passthrough", choices=["auto", "on", "off"], default="auto",
+                    help="Relay without calling the NF. auto: if the NF is marked")
+parser.add_argument("--nf", choices=list(NETWORK_FUNCTIONS), default="identity",
+                    help="Network function of the VNF (of every VNF of a fused chain)")
+args = parser.parse_args()
+if (args.in_shm or args.out_shm) and (args.mode != "threaded" or args.workers > 1):
+    # A ring has a single producer and a single consumer thread
+    logging.warning("Shared memory links need --mode threaded and one worker. Using TCP.")
+    args.in_shm = args.out_shm = None
 
 # Instantiate
-vnf = VNF(
-    vnf_id=vnf_id,
-    sfc_id=sfc_id,
-    listen_host=listen_host,
-    listen_port=listen_port,
-    send_host=send_host,
-    send_port=send_port,
-    network_function=my_network_function
+vnf_class = LoopVNF if args.mode == "loop" else VNF
+network_function = NETWORK_FUNCTIONS[args.nf][1 if args.batch_size else 0]
+chain = [vnf_id for vnf_id in args.chain.split(",") if vnf_id]
+if len(chain) > 1:
+    network_function = FusedChain([(vnf_id, network_function, args.nf) for vnf_id in chain],
+                                  batch=bool(args.batch_size))
+    logging.info("Fused chain: %s", " -> ".join(chain))
+vnf_kwargs = dict(
+    vnf_id=args.vnf_id,
+    sfc_id=args.sfc_id,
+    listen_host=args.listen_host,
+    listen_port=args.listen_port,
+    send_host=args.send_host,
+    send_port=args.send_port,
+    network_function=network_function,
+    batch_size=args.batch_size,
+    batch_timeout=args.batch_timeout,
+    registry=NETWORK_FUNCTIONS,
+    nf_name=args.nf
 )
+if args.in_shm or args.out_shm:
+    vnf_kwargs.update(in_shm=args.in_shm, out_shm=args.out_shm)
+if args.passthrough != "auto":
+    vnf_kwargs["passthrough"] = args.passthrough == "on"
+if args.workers > 1:
+    vnf = VNFSupervisor(vnf_class, args.workers, **vnf_kwargs)
+else:
+    vnf = vnf_class(**vnf_kwargs)
 
 # Keep main thread alive
 try:
@@ -1,17 +1,61 @@
+import json
 import logging
 import pika as pk
 from config import RABBITMQ_SERVER, VNF_CONTROL_EXCHANGE
+from config import VNF_BATCH_SIZE, VNF_BATCH_TIMEOUT
+from config import VNF_PREFETCH, VNF_ACK_EVERY, VNF_COALESCE, VNF_CONFIRM, VNF_FLUSH_INTERVAL
+from framing import frame, split_frames
+import rpc
+
+# Header of a published message that carries many length-prefixed records
+RECORDS_HEADER = "x-records"
 
 class VNF():
-    def __init__(self, vnf_id, sfc_id, queue_in, queue_out, network_function, create_queue = False):
+    def __init__(self, vnf_id, sfc_id, queue_in, queue_out, network_function, create_queue = False,
+                 batch_size=VNF_BATCH_SIZE, batch_timeout=VNF_BATCH_TIMEOUT,
+                 prefetch=VNF_PREFETCH, ack_every=VNF_ACK_EVERY, coalesce=VNF_COALESCE,
+                 confirm=VNF_CONFIRM, flush_interval=VNF_FLUSH_INTERVAL,
+                 registry=None, nf_name=None):
         """Generic body of a VNF
             @param vnf_id: Given random identifier
-            @param network_function: Implementation of a Network Function"""
+            @param network_function: Implementation of a Network Function
+            @param batch_size: If > 0, network_function receives a list of up to batch_size
+                               messages and returns a list of outputs
+            @param batch_timeout: Max time (seconds) a message waits for the batch to fill
+            @param prefetch: Max unacked messages delivered (basic_qos). 0 uses auto_ack
+            @param ack_every: Processed messages acknowledged by one multiple ack
+            @param coalesce: Max outputs published together in one message
+            @param confirm: Use publisher confirms, a message is only acked once
+                            its outputs were confirmed by the broker
+            @param flush_interval: Max time (seconds) outputs and acks wait to be flushed
+            @param registry: {name: (network_function, batch_network_function)}, NFs that
+                             the set_nf control command can load
+            @param nf_name: Name of network_function in the registry"""
         self.vnf_id = vnf_id
         self.sfc_id = sfc_id
         # The network function must have one argument and return the output
         # If the output is None, is assumed that no message needs to be forwarded
         self.network_function = network_function
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+        self.batch = []
+        self.batch_timer = None
+        self.batch_tag = None
+        self.prefetch = prefetch
+        # Acks are only sent after all the outputs of the messages were published
+        self.ack_every = max(1, min(ack_every, prefetch)) if prefetch else 0
+        self.coalesce = max(1, coalesce)
+        self.outputs = []
+        self.unacked = 0
+        self.last_tag = None
+        self.delivered_tag = None # Last message delivered
+        self.settled_tag = 0      # Every message up to it was acked or nacked
+        self.flush_interval = flush_interval
+        self.flush_timer = None
+        self.registry = registry or {}
+        self.nf_name = nf_name
+        self.consumer_tag = None # None while paused
+        self.counters = {"records_in": 0, "records_out": 0}
 
         if hasattr(network_function, "__call__") is False:
             logging.error("Invalid argument for network_function: Not callable.")
@@ -29,17 +73,23 @@ class VNF():
         self.queue_in = queue_in 
         self.queue_out = queue_out
 
-        self.channel.basic_consume(queue=self.queue_in,
-                                   auto_ack=True,
-                                   on_message_callback=self.treat_messages)
+        if confirm:
+            # BlockingConnection waits for the confirm of each publish, coalescing
+            # makes it one round trip per coalesce outputs
+            self.channel.confirm_delivery()
+        if prefetch:
+            self.channel.basic_qos(prefetch_count=prefetch)
+        self.consume()
 
         # Start control queue
         self.channel.exchange_declare(exchange=VNF_CONTROL_EXCHANGE,
-                                      exchange_type='fanout')
+                                      exchange_type='topic')
         result = self.channel.queue_declare(queue=f"control-{vnf_id}", exclusive=True)  # Auto-delete queue
         queue_name = result.method.queue
 
-        self.channel.queue_bind(exchange=VNF_CONTROL_EXCHANGE, queue=queue_name)
+        for routing_key in (f"{sfc_id}.{vnf_id}", f"{sfc_id}.all", "all.all"):
+            self.channel.queue_bind(exchange=VNF_CONTROL_EXCHANGE, queue=queue_name,
+                                    routing_key=routing_key)
 
         self.channel.basic_consume(queue=queue_name,
                                    on_message_callback=self.treat_control_messages, 
@@ -48,30 +98,211 @@ class VNF():
                      vnf_id, self.queue_in, self.queue_out)
         self.start_service()
 
+    def consume(self):
+        self.consumer_tag = self.channel.basic_consume(queue=self.queue_in,
+                                                       auto_ack=not self.prefetch,
+                                                       on_message_callback=self.treat_messages)
+
     def treat_messages(self, ch, method, properties, body):
         """Function used to receive messages"""
         if body is None:
             return
-        try:
-            return_val = self.network_function(body)
+        self.delivered_tag = method.delivery_tag
+        records = [body]
+        if properties is not None and properties.headers and RECORDS_HEADER in properties.headers:
+            # Outputs coalesced by the previous VNF
+            records = [bytes(record) for record in split_frames(body, "length")]
+        if self.batch_size:
+            self.batch_tag = method.delivery_tag
+            for record in records:
+                self.add_to_batch(record)
+            if not self.batch:
+                # The last record of the message filled a batch
+                self.processed(method.delivery_tag)
+            return
+        for record in records:
+            self.counters["records_in"] += 1
+            try:
+                return_val = self.network_function(record)
 
-            if return_val is not None:
-                logging.info("Sending message: %s", return_val)
-                self.send_message(return_val)
-            else:
-                logging.info("Network Function did not forward any message")
+                if return_val is not None:
+                    self.counters["records_out"] += 1
+                    logging.debug("Sending message: %s", return_val)
+                    if not self.send_message(return_val):
+                        # The message was requeued
+                        return
+                else:
+                    logging.debug("Network Function did not forward any message")
+            except Exception as e:
+                logging.error("NF had an internal error: %s", {e})
+        self.processed(method.delivery_tag)
+
+    def add_to_batch(self, body):
+        self.batch.append(body)
+        if len(self.batch) >= self.batch_size:
+            # More records of the same message may follow, treat_messages acks it
+            self.treat_batch(ack=False)
+        elif self.batch_timer is None:
+            # Runs in the consumer thread, as the message callbacks
+            self.batch_timer = self.connection.call_later(self.batch_timeout, self.treat_batch)
+
+    def treat_batch(self, ack=True):
+        """Calls the batch NF once with all the messages waiting
+            @param ack: All the records of the messages up to batch_tag are in the batch"""
+        if self.batch_timer is not None:
+            self.connection.remove_timeout(self.batch_timer)
+            self.batch_timer = None
+        batch, self.batch = self.batch, []
+        if not batch:
+            return
+        self.counters["records_in"] += len(batch)
+        try:
+            outputs = self.network_function(batch) or ()
         except Exception as e:
             logging.error("NF had an internal error: %s", {e})
+            outputs = ()
+        for return_val in outputs:
+            if return_val is not None:
+                self.counters["records_out"] += 1
+                if not self.send_message(return_val):
+                    # The messages of the batch were requeued
+                    return
+        logging.debug("Batch of %d messages processed", len(batch))
+        if ack:
+            self.processed(self.batch_tag)
+
+    def processed(self, delivery_tag):
+        """All the messages up to delivery_tag were processed"""
+        if not self.prefetch or delivery_tag <= self.settled_tag:
+            return
+        self.last_tag = delivery_tag
+        self.unacked += 1
+        if self.unacked >= self.ack_every:
+            self.flush()
+        else:
+            self.schedule_flush()
 
-        #self.send_message(f"{body.decode()}->{self.vnf_id}")
+    def schedule_flush(self):
+        if self.flush_timer is None:
+            self.flush_timer = self.connection.call_later(self.flush_interval, self.flush)
+
+    def flush(self):
+        """Publishes the coalesced outputs and acks the messages that produced them"""
+        if self.flush_timer is not None:
+            self.connection.remove_timeout(self.flush_timer)
+            self.flush_timer = None
+        if not self.publish_outputs():
+            return
+        if self.unacked:
+            self.channel.basic_ack(delivery_tag=self.last_tag, multiple=True)
+            self.settled_tag = self.last_tag
+            self.unacked = 0
+
+    def reject(self):
+        """The broker did not take the outputs: every message not acked yet,
+        including the ones being treated, is delivered again"""
+        if self.coalesce == 1 and self.unacked:
+            # Outputs are published one by one, the processed messages are done
+            self.channel.basic_ack(delivery_tag=self.last_tag, multiple=True)
+            self.settled_tag = self.last_tag
+        self.unacked = 0
+        if not self.prefetch or self.delivered_tag is None \
+                or self.delivered_tag <= self.settled_tag:
+            return
+        self.channel.basic_nack(delivery_tag=self.delivered_tag, multiple=True, requeue=True)
+        self.settled_tag = self.delivered_tag
 
     def treat_control_messages(self, ch, method, properties, body):
-        # TODO: treat VNF control messages
-        print(f"received CONTROL MESSAGE! {body.decode()}")
+        """Control commands (same as the TCP VNF): stats, set_nf {nf},
+        set_batch {batch_size, batch_timeout}, pause, resume, drain and
+        rebind {queue}. The reply is published in rqueue, if given"""
+        logging.info("Received CONTROL MESSAGE: %s", body.decode())
+        try:
+            msg = json.loads(body.decode())
+            command = msg["command"]
+        except (ValueError, KeyError, TypeError):
+            logging.error("Invalid control message: %s", body)
+            return
+        reply = {"vnf_id": self.vnf_id, "sfc_id": self.sfc_id, "command": command, "ok": True}
+        try:
+            if command == "stats":
+                reply["stats"] = dict(self.counters, nf=self.nf_name, batch_size=self.batch_size,
+                                      paused=self.consumer_tag is None, queue_out=self.queue_out)
+            elif command == "set_nf":
+                self.set_network_function(msg["nf"], self.batch_size)
+            elif command == "set_batch":
+                batch_size = int(msg.get("batch_size", self.batch_size))
+                if bool(batch_size) != bool(self.batch_size):
+                    self.set_network_function(self.nf_name, batch_size)
+                self.batch_size = batch_size
+                self.batch_timeout = float(msg.get("batch_timeout", self.batch_timeout))
+            elif command == "pause":
+                self.pause()
+            elif command == "resume":
+                if self.consumer_tag is None:
+                    self.consume()
+            elif command == "drain":
+                self.pause()
+                self.flush()
+            elif command == "rebind":
+                self.flush()
+                self.queue_out = msg["queue"]
+            else:
+                raise ValueError(f"Unknown command: {command}")
+        except (KeyError, ValueError, TypeError) as e:
+            logging.error("Control command %s failed: %s", command, e)
+            reply["ok"] = False
+            reply["error"] = str(e)
+        rpc.reply(self.channel, msg, json.dumps(reply), properties)
+
+    def set_network_function(self, name, batch_size):
+        """Loads the NF name of the registry, in the variant for batch_size"""
+        if name not in self.registry:
+            raise ValueError(f"Unknown network function: {name}")
+        # The messages waiting are treated by the NF that received them
+        self.treat_batch()
+        self.network_function = self.registry[name][1 if batch_size else 0]
+        self.nf_name = name
+
+    def pause(self):
+        """Stops consuming queue_in. The pending batch is treated"""
+        if self.consumer_tag is not None:
+            self.channel.basic_cancel(self.consumer_tag)
+            self.consumer_tag = None
+        self.treat_batch()
 
     def send_message(self, payload):
-        """Send a message in queue_out"""
-        return self.channel.basic_publish(exchange="", routing_key=self.queue_out, body=payload)
+        """Send a message in queue_out. Returns False if it was not confirmed"""
+        if self.coalesce == 1:
+            return self.publish(payload)
+        if isinstance(payload, str):
+            payload = payload.encode()
+        self.outputs.append(payload)
+        if len(self.outputs) >= self.coalesce:
+            return self.publish_outputs()
+        self.schedule_flush()
+        return True
+
+    def publish_outputs(self):
+        """Publishes the outputs waiting as one message of length-prefixed records"""
+        if not self.outputs:
+            return True
+        outputs, self.outputs = self.outputs, []
+        body = b"".join(frame(payload, "length") for payload in outputs)
+        properties = pk.BasicProperties(headers={RECORDS_HEADER: len(outputs)})
+        return self.publish(body, properties)
+
+    def publish(self, body, properties=None):
+        """Publishes body in queue_out. With publisher confirms, returns False
+        if the broker did not take it, the inputs are then requeued (see reject)"""
+        try:
+            self.channel.basic_publish(exchange="", routing_key=self.queue_out,
+                                       body=body, properties=properties)
+        except (pk.exceptions.NackError, pk.exceptions.UnroutableError) as e:
+            logging.error("Outputs were not confirmed: %s", e)
+            self.reject()
+            return False
+        return True
 
     def cleanup_vnf(self):
         """Cleanup resources used from VNF"""
@@ -98,6 +329,8 @@ class VNF():
     
     def stop_service(self):
         self.channel.stop_consuming()
+        self.treat_batch()
+        self.flush()
         self.cleanup_vnf()
         logging.info("Finishing service")
 